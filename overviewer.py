@@ -66,6 +66,15 @@ def main():
     parser.add_option("-p", "--processes", dest="procs", action="store", type="int",
             help="The number of local worker processes to spawn. Defaults to the number of CPU cores your computer has")
 
+    # Options for spreading a render over several machines
+    parser.add_option("--listen", dest="listen", action="store", metavar="HOST:PORT",
+            help="Also hand out work to worker processes on other machines, which connect to this address. Requires --authkey.")
+    parser.add_option("--worker", dest="worker", action="store", metavar="HOST:PORT",
+            help="Run worker processes for the render listening on this address instead of rendering. Requires --authkey.")
+    parser.add_option("--authkey", dest="authkey", action="store",
+            default=os.environ.get("OVERVIEWER_AUTHKEY"),
+            help="The shared secret for --listen and --worker. Defaults to the OVERVIEWER_AUTHKEY environment variable.")
+
     # Options that only apply to the config-less render usage
     parser.add_option("--rendermodes", dest="rendermodes", action="store",
             help="If you're not using a config file, specify which rendermodes to render with this option. This is a comma-separated list.")
@@ -153,6 +162,25 @@ def main():
         logging.info("Hash of terrain.png file is: `%s`", h.hexdigest())
         return 0
 
+    if options.listen or options.worker:
+        if options.listen and options.worker:
+            logging.error("You cannot specify both --listen and --worker")
+            return 1
+        if not options.authkey:
+            logging.error("You must give an --authkey to use --listen or --worker")
+            return 1
+        try:
+            address = dispatcher.parse_address(options.listen or options.worker)
+        except ValueError as ex:
+            logging.error(str(ex))
+            return 1
+
+    if options.worker:
+        logging.info("Starting worker processes for %s:%d", *address)
+        procs = options.procs if options.procs is not None else -1
+        dispatcher.NetworkDispatcher.start_workers(address, options.authkey, procs)
+        return 0
+
     # if no arguments are provided, print out a helpful message
     if len(args) == 0 and not options.config:
         # first provide an appropriate error for bare-console users
@@ -246,7 +274,7 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
 
     # Add in the command options here, perhaps overriding values specified in
     # the config
-    if options.procs:
+    if options.procs is not None:
         mw_parser.set_config_item("processes", options.procs)
 
     # Now parse and return the validated config
@@ -296,6 +324,14 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
         logging.error("You must specify at least one render in your config file. See the docs if you're having trouble")
         return 1
 
+    # A negative number of processes means one for each CPU core
+    if config['processes'] < 0:
+        config['processes'] = cpus
+
+    if config['processes'] == 0 and not options.listen:
+        logging.error("You need at least one worker process, unless other machines connect with --listen")
+        return 1
+
     #####################
     # Do a few last minute things to each render dictionary here
     for rname, render in config['renders'].iteritems():
@@ -374,7 +410,31 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
 
     # Set up the cache objects to use
     caches = []
-    caches.append(cache.LRUCache(size=100))
+    memory_cache_size = config.get("memory_cache_size", None)
+    if memory_cache_size is None:
+        memory_cache_size = 64
+    caches.append(cache.LRUCache(size=None, maxbytes=memory_cache_size * 1024 * 1024))
+    # The worker processes each have their own copy of the cache above, so
+    # behind it is a cache they all share. It's only worth it with more than
+    # one worker process on this machine.
+    sharedcache = None
+    sharedcache_size = config.get("shared_cache_size", None)
+    if sharedcache_size is None:
+        sharedcache_size = 512
+    if config['processes'] > 1 and sharedcache_size > 0:
+        try:
+            sharedcache = cache.SharedMemoryCache(sharedcache_size)
+        except (ImportError, EnvironmentError), e:
+            logging.warning("Not using a shared chunk cache: %s", e)
+        else:
+            logging.info("Using a shared chunk cache of %d MB for the %d worker processes",
+                    sharedcache_size, config['processes'])
+            caches.append(sharedcache)
+    if config.get("chunk_cache_dir", None):
+        diskcache = cache.DiskCache(config['chunk_cache_dir'], config.get('chunk_cache_size', None))
+        caches.append(diskcache)
+    else:
+        diskcache = None
     if config.get("memcached_host", False):
         caches.append(cache.Memcached(config['memcached_host']))
     # TODO: optionally more caching layers here
@@ -432,38 +492,62 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
 
         # only pass to the TileSet the options it really cares about
         render['name'] = render_name # perhaps a hack. This is stored here for the asset manager
-        tileSetOpts = util.dict_subset(render, ["name", "imgformat", "renderchecks", "rerenderprob", "bgcolor", "defaultzoom", "imgquality", "optimizeimg", "rendermode", "worldname_orig", "title", "dimension", "changelist", "showspawn", "overlay", "base", "poititle", "maxzoom"])
+        tileSetOpts = util.dict_subset(render, ["name", "imgformat", "renderchecks", "rerenderprob", "bgcolor", "defaultzoom", "imgquality", "optimizeimg", "rendermode", "worldname_orig", "title", "dimension", "changelist", "showspawn", "overlay", "base", "poititle", "maxzoom", "batchlevels", "texturepath", "northdirection"])
         tileSetOpts.update({"spawn": w.find_true_spawn()}) # TODO find a better way to do this
         tset = tileset.TileSet(w, rset, assetMrg, tex, tileSetOpts, tileset_dir)
         tilesets.append(tset)
 
-    # Do tileset preprocessing here, before we start dispatching jobs
-    for ts in tilesets:
-        ts.do_preprocessing()
+    # multiprocessing dispatcher
+    if options.listen:
+        dispatch = dispatcher.NetworkDispatcher(address, options.authkey,
+            local_procs=config['processes'],
+            batch_size=config.get('job_batch_size', None) or 8)
+    elif config['processes'] == 1:
+        dispatch = dispatcher.Dispatcher()
+    else:
+        dispatch = dispatcher.LocalMultiprocessingDispatcher(
+            local_procs=config['processes'],
+            batch_size=config.get('job_batch_size', None) or 8)
+
+    # Do tileset preprocessing here, before we start dispatching jobs. The
+    # chunk scans are spread over the worker processes, and done once for all
+    # renders of the same world dimension.
+    logging.info("Scanning chunks...")
+    dispatch.preprocess_all(tilesets)
 
     # Output initial static data and configuration
     assetMrg.initialize(tilesets)
 
-    # multiprocessing dispatcher
-    if config['processes'] == 1:
-        dispatch = dispatcher.Dispatcher()
-    else:
-        dispatch = dispatcher.MultiprocessingDispatcher(
-            local_procs=config['processes'])
     dispatch.render_all(tilesets, config['observer'])
     dispatch.close()
 
-    assetMrg.finalize(tilesets)
+    if dispatch.failed_jobs:
+        # Leave the renders marked as in progress, with their journals, so
+        # the next run does what's missing
+        logging.error("Some tiles could not be rendered. Run again to "
+                "render them.")
+        for tset in tilesets:
+            tset.close_journal(completed=False)
+    else:
+        assetMrg.finalize(tilesets)
+        for tset in tilesets:
+            tset.close_journal(completed=True)
 
     for out in changelists.itervalues():
         logging.debug("Closing %s (%s)", out, out.fileno())
         out.close()
 
-    if config['processes'] == 1:
-        logging.debug("Final cache stats:")
-        for c in caches:
-            logging.debug("\t%s: %s hits, %s misses", c.__class__.__name__, c.hits, c.misses)
+    if diskcache:
+        diskcache.prune()
+    if sharedcache:
+        sharedcache.close()
+
+    # custom observers may not implement this
+    if hasattr(config['observer'], "report_cache_stats"):
+        config['observer'].report_cache_stats(dispatch.cache_stats)
 
+    if dispatch.failed_jobs:
+        return 1
     return 0
 
 def list_worlds():
@@ -44,7 +44,7 @@ def handleEntities(rset, outputdir, render, rname):
     rset._pois = dict(TileEntities=[], Entities=[])
 
     for (x,z,mtime) in rset.iterate_chunks():
-        data = rset.get_chunk(x,z)
+        data = rset.get_chunk(x, z, entities=True)
         rset._pois['TileEntities'] += data['TileEntities']
         rset._pois['Entities']     += data['Entities']
 
@@ -17,12 +17,25 @@
 
 Each cache class should implement the standard container type interface
 (__getitem__ and __setitem__), as well as provide a "hits" and "misses"
-attribute.
+attribute. Caches that drop items to stay within their size may also count
+them in an "evictions" attribute, and caches in memory may report their size
+in a "resident_bytes" attribute; see get_stats().
 
 """
+import atexit
 import functools
 import logging
 import cPickle
+import os
+import os.path
+import struct
+import tempfile
+import mmap
+import hashlib
+import time
+from collections import namedtuple
+
+import numpy
 
 class LRUCache(object):
     """A simple, generic, in-memory LRU cache that implements the standard
@@ -42,20 +55,26 @@ class LRUCache(object):
 
     """
     class _LinkNode(object):
-        __slots__ = ['left', 'right', 'key', 'value']
-        def __init__(self,l=None,r=None,k=None,v=None):
+        __slots__ = ['left', 'right', 'key', 'value', 'nbytes']
+        def __init__(self,l=None,r=None,k=None,v=None,n=0):
             self.left = l
             self.right = r
             self.key = k
             self.value = v
+            self.nbytes = n
 
-    def __init__(self, size=100, destructor=None):
-        """Initialize a new LRU cache with the given size.
+    def __init__(self, size=100, destructor=None, maxbytes=None):
+        """Initialize a new LRU cache with the given size. A size of None
+        means the number of items is not limited.
 
         destructor, if given, is a callable that is called upon an item being
         evicted from the cache. It takes one argument, the value stored in the
         cache.
 
+        maxbytes, if given, limits the total size of the values in the cache,
+        as measured by get_nbytes(). Items are evicted until a new item fits,
+        and items bigger than this are not cached at all.
+
         """
         self.cache = {}
 
@@ -68,16 +87,21 @@ class LRUCache(object):
 
         self.hits = 0
         self.misses = 0
+        self.evictions = 0
+        # total size of the cached values
+        self.resident_bytes = 0
 
         self.size = size
+        self.maxbytes = maxbytes
 
         self.destructor = destructor
 
     # Initialize an empty cache of the same size for worker processes
     def __getstate__(self):
-        return self.size
-    def __setstate__(self, size):
-        self.__init__(size)
+        return self.size, self.maxbytes
+    def __setstate__(self, state):
+        size, maxbytes = state
+        self.__init__(size, maxbytes=maxbytes)
 
     def __getitem__(self, key):
         try:
@@ -102,16 +126,27 @@ class LRUCache(object):
 
     def __setitem__(self, key, value):
         cache = self.cache
+        maxbytes = self.maxbytes
+        nbytes = get_nbytes(value) if maxbytes is not None else 0
         if key in cache:
             # Shortcut this case
-            cache[key].value = value
+            link = cache[key]
+            link.value = value
+            self.resident_bytes += nbytes - link.nbytes
+            link.nbytes = nbytes
+            return
+        if maxbytes is not None and nbytes > maxbytes:
+            # This would push everything else out, and still not fit
             return
-        if len(cache) >= self.size:
+        while cache and ((self.size is not None and len(cache) >= self.size) or
+                (maxbytes is not None and self.resident_bytes + nbytes > maxbytes)):
             # Evict a node
             link = self.listhead.right
             del cache[link.key]
             link.left.right = link.right
             link.right.left = link.left
+            self.resident_bytes -= link.nbytes
+            self.evictions += 1
             d = self.destructor
             if d:
                 d(link.value)
@@ -119,9 +154,10 @@ class LRUCache(object):
 
         # The node doesn't exist already, and we have room for it. Let's do this.
         tail = self.listtail
-        link = LRUCache._LinkNode(tail.left, tail,key,value)
+        link = LRUCache._LinkNode(tail.left, tail,key,value,nbytes)
         tail.left.right = link
         tail.left = link
+        self.resident_bytes += nbytes
 
         cache[key] = link
 
@@ -132,12 +168,471 @@ class LRUCache(object):
         del cache[key]
         link.left.right = link.right
         link.right.left = link.left
+        self.resident_bytes -= link.nbytes
         
         # Call the destructor
         d = self.destructor
         if d:
             d(link.value)
 
+def get_nbytes(value):
+    """Returns the approximate memory used by the data in the given value: the
+    total size of the numpy arrays and strings in it, found through any
+    dictionaries, lists and tuples.
+
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    elif isinstance(value, basestring):
+        return len(value)
+    elif isinstance(value, dict):
+        return sum(get_nbytes(v) for v in value.itervalues())
+    elif isinstance(value, (list, tuple)):
+        return sum(get_nbytes(v) for v in value)
+    return 0
+
+def get_stats(cache):
+    """Returns a dictionary of the statistics the given cache keeps: hits and
+    misses, and evictions and resident_bytes if it counts them.
+
+    """
+    return dict((name, getattr(cache, name))
+            for name in ("hits", "misses", "evictions", "resident_bytes")
+            if hasattr(cache, name))
+
+class DiskCache(object):
+    """A cache that keeps its items in files on disk, so they are available
+    to later runs too. It is meant for decoded chunks: dictionaries and lists
+    of numpy arrays and other picklable values.
+
+    Items are stored in a simple binary format (see _pack_value()), with the
+    raw data of the numpy arrays following a pickled description of the item.
+    Reading an item maps its file into memory and returns arrays that are
+    backed by the mapping, so the array data isn't copied. These arrays are
+    read-only.
+
+    Cached items are never invalidated, so keys must identify the content of
+    the item. (CachedRegionSet includes the chunk mtime in its keys for this
+    reason.) Keys must be strings that are valid filenames. Items that
+    haven't been used in a while are removed by prune() once the cache grows
+    past its size limit.
+
+    """
+    def __init__(self, cachedir, size=None):
+        """Initialize a cache in the given directory, which is created if it
+        doesn't exist. size is the size limit, in megabytes, used by prune().
+
+        """
+        self.cachedir = cachedir
+        if size is None:
+            size = 4096
+        self.size = size
+
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+
+    def __getstate__(self):
+        return self.cachedir, self.size
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _get_path(self, key):
+        # spread the files over subdirectories, to keep them reasonably small
+        return os.path.join(self.cachedir, key[:2], key + ".cache")
+
+    def __getitem__(self, key):
+        path = self._get_path(key)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            self.misses += 1
+            raise KeyError(key)
+
+        try:
+            try:
+                value = _unpack_value(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except Exception, e:
+                # Probably a file that got cut off somehow. Get rid of it.
+                logging.debug("Removing bad cache file %s: %s", path, e)
+                self.misses += 1
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                raise KeyError(key)
+        finally:
+            f.close()
+
+        # mark the file as recently used, for prune()
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        path = self._get_path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.mkdir(dirname)
+            except OSError:
+                # another process probably got here first
+                if not os.path.isdir(dirname):
+                    raise
+
+        # Other processes may be writing the same item at the same time, so
+        # write to a temporary file of our own and move it into place
+        fd, tmppath = tempfile.mkstemp(suffix=".tmp", dir=dirname)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for part in _pack_value(value):
+                    f.write(part)
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            # (on Windows, rename fails if the other process's file already
+            # exists. That's fine, it holds the same item.)
+            logging.debug("Couldn't write cache file %s", path, exc_info=1)
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+
+    def __delitem__(self, key):
+        try:
+            os.remove(self._get_path(key))
+        except OSError:
+            raise KeyError(key)
+
+    def prune(self):
+        """Removes the least recently used items until the cache is within
+        its size limit.
+
+        """
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.cachedir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        limit = self.size * 1024 * 1024
+        if total <= limit:
+            return
+        files.sort()
+        removed = 0
+        for mtime, size, path in files:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        logging.debug("Removed %d old items from the cache in %s", removed, self.cachedir)
+
+# The shared memory cache needs POSIX file locks to keep its processes from
+# stepping on each other
+try:
+    import fcntl
+except ImportError:
+    class SharedMemoryCache(object):
+        def __init__(*args, **kwargs):
+            raise ImportError("The shared memory cache is not available on this platform")
+else:
+    class SharedMemoryCache(object):
+        """A cache that is shared by all the worker processes on this machine.
+        Items are stored, in the same format as DiskCache, in a memory-mapped
+        file (in /dev/shm where available, so it's really just shared memory)
+        that each process maps.
+
+        The arena is divided into sets of _set_size bytes. An item can only go
+        in the set its key hashes to, where it takes up as many bytes as it
+        needs, and up to _ways items share a set. A decoded chunk takes about
+        20KB for each of its sections. To make room, the least recently used
+        items of the set are removed, and the rest are moved together if the
+        free space is split up. Items bigger than _max_item_size aren't
+        cached. Each set is protected by its own lock, a POSIX lock on a byte
+        of the file, so processes only wait for each other when they use the
+        same set.
+
+        Items are copied out of the arena when read, since they may be moved
+        or replaced by another process at any time.
+
+        The process that creates the cache owns the file, and removes it in
+        close(), or when it exits if close() wasn't called. Other processes
+        get a copy of the cache by unpickling it, which maps the same file. A
+        copy unpickled on another machine, where the file doesn't exist,
+        caches nothing.
+
+        """
+        # slot table entries: a hash of the key (in two halves), where the item
+        # is in its set, its length (0 for an empty slot), and the time it was
+        # last used
+        _slot_dtype = numpy.dtype([("key0", "<u8"), ("key1", "<u8"), ("offset", "<u4"),
+                ("length", "<u4"), ("stamp", "<f8")])
+        _set_size = 4 * 1024 * 1024
+        _ways = 128
+        _max_item_size = 1024 * 1024
+
+        def __init__(self, size=512):
+            """Creates a new shared cache of about the given size, in
+            megabytes. Raises an EnvironmentError if the memory can't be
+            allocated.
+
+            """
+            numsets = max(size * 1024 * 1024 // self._set_size, 1)
+
+            shmdir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            fd, path = tempfile.mkstemp(prefix="overviewer-cache-", dir=shmdir)
+            try:
+                # Write the whole file out now. On a full tmpfs, this fails
+                # here instead of crashing the workers later.
+                length = self._get_data_offset(numsets) + numsets * self._set_size
+                zeros = "\0" * (1024 * 1024)
+                written = 0
+                while written < length:
+                    n = min(len(zeros), length - written)
+                    os.write(fd, zeros[:n])
+                    written += n
+            except EnvironmentError:
+                os.close(fd)
+                os.remove(path)
+                raise
+            os.close(fd)
+
+            self._owner = True
+            self._open(path, numsets)
+            # Don't leave the file behind in /dev/shm if the render stops
+            # early
+            atexit.register(self.close)
+
+        def __getstate__(self):
+            return self.path, self.numsets
+        def __setstate__(self, state):
+            self._owner = False
+            try:
+                self._open(*state)
+            except EnvironmentError:
+                self._file = None
+                self._table = None
+
+        @classmethod
+        def _get_data_offset(cls, numsets):
+            tablesize = numsets * cls._ways * cls._slot_dtype.itemsize
+            return _align(tablesize, mmap.PAGESIZE)
+
+        def _open(self, path, numsets):
+            self.path = path
+            self.numsets = numsets
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+            self._file = open(path, "r+b")
+            self._mapping = mmap.mmap(self._file.fileno(), 0)
+            self._table = numpy.frombuffer(self._mapping, dtype=self._slot_dtype,
+                    count=numsets * self._ways).reshape((numsets, self._ways))
+            self._bytes = numpy.frombuffer(self._mapping, dtype=numpy.uint8)
+            self._data_offset = self._get_data_offset(numsets)
+
+        def close(self):
+            """Unmaps the cache. If this is the process that created it, the
+            cache is removed, so this should be done after all worker processes
+            are done with it.
+
+            """
+            if self._file is None:
+                return
+            self._table = None
+            self._bytes = None
+            self._mapping.close()
+            self._file.close()
+            self._file = None
+            if self._owner:
+                os.remove(self.path)
+
+        def _find(self, key):
+            """Returns the set index and the two halves of the key hash for
+            the given key"""
+            key0, key1 = struct.unpack("<QQ", hashlib.md5(key).digest())
+            return key0 % self.numsets, key0, key1
+
+        def _lock(self, setindex):
+            fcntl.lockf(self._file, fcntl.LOCK_EX, 1, setindex)
+        def _unlock(self, setindex):
+            fcntl.lockf(self._file, fcntl.LOCK_UN, 1, setindex)
+
+        def _set_offset(self, setindex):
+            return self._data_offset + setindex * self._set_size
+
+        def __getitem__(self, key):
+            if self._table is None:
+                self.misses += 1
+                raise KeyError(key)
+            setindex, key0, key1 = self._find(key)
+            slots = self._table[setindex]
+            self._lock(setindex)
+            try:
+                matches = numpy.flatnonzero((slots["key0"] == key0) &
+                        (slots["key1"] == key1) & (slots["length"] != 0))
+                if not len(matches):
+                    self.misses += 1
+                    raise KeyError(key)
+                way = matches[0]
+                offset = self._set_offset(setindex) + int(slots["offset"][way])
+                data = self._mapping[offset:offset+int(slots["length"][way])]
+                slots["stamp"][way] = time.time()
+            finally:
+                self._unlock(setindex)
+            self.hits += 1
+            return _unpack_value(data)
+
+        def __setitem__(self, key, value):
+            parts = _pack_value(value)
+            length = sum(len(part) for part in parts)
+            if length > self._max_item_size or self._table is None:
+                return
+
+            setindex, key0, key1 = self._find(key)
+            slots = self._table[setindex]
+            self._lock(setindex)
+            try:
+                # drop the old version of the item, if it's here, and then the
+                # least recently used items until there's room for this one
+                slots["length"][(slots["key0"] == key0) & (slots["key1"] == key1)] = 0
+                while True:
+                    used = slots["length"] != 0
+                    if not used.all() and int(slots["length"].sum()) + length <= self._set_size:
+                        break
+                    way = int(numpy.argmin(numpy.where(used, slots["stamp"], numpy.inf)))
+                    slots["length"][way] = 0
+                    self.evictions += 1
+
+                # the item goes after the last one in the set, unless the free
+                # space is split up between the items. Then they're moved
+                # together first.
+                setoffset = self._set_offset(setindex)
+                ways = numpy.flatnonzero(used)
+                ways = ways[numpy.argsort(slots["offset"][ways])]
+                end = int(slots["offset"][ways[-1]] + slots["length"][ways[-1]]) if len(ways) else 0
+                if end + length > self._set_size:
+                    end = 0
+                    for way in ways:
+                        itemoffset = int(slots["offset"][way])
+                        itemlength = int(slots["length"][way])
+                        if itemoffset != end:
+                            self._mapping.move(setoffset + end, setoffset + itemoffset, itemlength)
+                            slots["offset"][way] = end
+                        end += itemlength
+
+                way = int(numpy.flatnonzero(~used)[0])
+                offset = setoffset + end
+                for part in parts:
+                    if len(part):
+                        self._bytes[offset:offset+len(part)] = numpy.frombuffer(part, dtype=numpy.uint8)
+                        offset += len(part)
+                slots["key0"][way] = key0
+                slots["key1"][way] = key1
+                slots["offset"][way] = end
+                slots["length"][way] = length
+                slots["stamp"][way] = time.time()
+            finally:
+                self._unlock(setindex)
+
+# A placeholder for a numpy array in a value stored by _pack_value(). index is
+# the index of the array's data in the file.
+_ArrayRef = namedtuple("_ArrayRef", ["index", "dtype", "shape"])
+
+_cache_magic = "OVCACHE1"
+_cache_header = struct.Struct("<8sII")
+_array_offset = struct.Struct("<Q")
+
+def _align(n, alignment=16):
+    return (n + alignment - 1) // alignment * alignment
+
+def _pack_value(value):
+    """Serializes the given value for DiskCache. Returns a list of strings and
+    buffers to be written out, in order.
+
+    The format is a header (magic, layout length, number of arrays), the
+    pickled layout (the value with each numpy array replaced by an _ArrayRef),
+    a table with the file offset of each array, and the raw, aligned array
+    data.
+
+    """
+    arrays = []
+    def replace_arrays(obj):
+        if isinstance(obj, numpy.ndarray):
+            arrays.append(numpy.ascontiguousarray(obj))
+            return _ArrayRef(len(arrays)-1, obj.dtype.str, obj.shape)
+        elif isinstance(obj, dict):
+            return dict((k, replace_arrays(v)) for k, v in obj.iteritems())
+        elif isinstance(obj, list):
+            return [replace_arrays(v) for v in obj]
+        elif isinstance(obj, tuple):
+            return tuple(replace_arrays(v) for v in obj)
+        return obj
+    layout = cPickle.dumps(replace_arrays(value), cPickle.HIGHEST_PROTOCOL)
+
+    parts = [_cache_header.pack(_cache_magic, len(layout), len(arrays)), layout]
+    pos = _cache_header.size + len(layout)
+    offset = _align(pos + _array_offset.size * len(arrays))
+    for array in arrays:
+        parts.append(_array_offset.pack(offset))
+        offset = _align(offset + array.nbytes)
+    pos += _array_offset.size * len(arrays)
+
+    for array in arrays:
+        parts.append("\0" * (_align(pos) - pos))
+        pos = _align(pos)
+        parts.append(buffer(array))
+        pos += array.nbytes
+    return parts
+
+def _unpack_value(mapping):
+    """Reads a value written by _pack_value() from the given string, buffer or
+    memory mapping. The arrays in the value are read-only views of it.
+
+    """
+    magic, layoutlen, numarrays = _cache_header.unpack_from(mapping, 0)
+    if magic != _cache_magic:
+        raise ValueError("not a cache file")
+    pos = _cache_header.size
+    layout = cPickle.loads(mapping[pos:pos+layoutlen])
+    pos += layoutlen
+    offsets = [_array_offset.unpack_from(mapping, pos + i * _array_offset.size)[0]
+            for i in xrange(numarrays)]
+
+    def restore_arrays(obj):
+        if isinstance(obj, _ArrayRef):
+            dtype = numpy.dtype(obj.dtype)
+            count = int(numpy.prod(obj.shape))
+            if count == 0:
+                return numpy.zeros(obj.shape, dtype=dtype)
+            if offsets[obj.index] + count * dtype.itemsize > len(mapping):
+                raise ValueError("cache file is truncated")
+            array = numpy.frombuffer(mapping, dtype=dtype, count=count, offset=offsets[obj.index])
+            return array.reshape(obj.shape)
+        elif isinstance(obj, dict):
+            return dict((k, restore_arrays(v)) for k, v in obj.iteritems())
+        elif isinstance(obj, list):
+            return [restore_arrays(v) for v in obj]
+        elif isinstance(obj, tuple):
+            return tuple(restore_arrays(v) for v in obj)
+        return obj
+    return restore_arrays(layout)
+
 # memcached is an option, but unless your IO costs are really high, it just
 # ends up adding overhead and isn't worth it.
 try:
@@ -151,6 +646,8 @@ else:
         def __init__(self, conn='127.0.0.1:11211'):
             self.conn = conn
             self.mc = memcache.Client([conn], debug=0, pickler=cPickle.Pickler, unpickler=cPickle.Unpickler)
+            self.hits = 0
+            self.misses = 0
 
         def __getstate__(self):
             return self.conn
@@ -160,7 +657,9 @@ else:
         def __getitem__(self, key):
             v = self.mc.get(key)
             if not v:
+                self.misses += 1
                 raise KeyError()
+            self.hits += 1
             return v
 
         def __setitem__(self, key, value):
@@ -13,30 +13,134 @@
 #    You should have received a copy of the GNU General Public License along
 #    with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
 
-import util
+import cache
+import logging
+import select
+import sys
 import multiprocessing
-import multiprocessing.managers
-import cPickle as pickle
+import multiprocessing.connection
 import Queue
 import time
+import heapq
+import itertools
+import threading
+from collections import deque
 from signals import Signal
 
+# Pipes can be waited on with select(), except on Windows
+_can_select_pipes = sys.platform != "win32"
+
+def get_cache_stats(workers):
+    """Returns a list of (name, stats) tuples for the caches used by the
+    given workers, as returned by their get_caches() methods. stats is a
+    dictionary from cache.get_stats(). Caches shared between workers are
+    only listed once.
+
+    """
+    seen = set()
+    stats = []
+    for worker in workers:
+        if not hasattr(worker, "get_caches"):
+            continue
+        for c in worker.get_caches():
+            if id(c) in seen:
+                continue
+            seen.add(id(c))
+            stats.append((c.__class__.__name__, cache.get_stats(c)))
+    return stats
+
 class Dispatcher(object):
     """This class coordinates the work of all the TileSet objects
     among one worker process. By subclassing this class and
-    implementing setup_tilesets(), dispatch(), and close(), it is
-    possible to create a Dispatcher that distributes this work to many
-    worker processes.
+    implementing setup_tilesets(), dispatch(), dispatch_preprocessing(),
+    can_dispatch() and close(), it is possible to create a Dispatcher
+    that distributes this work to many worker processes.
     """
+    # How many ready jobs to collect, at most, so the most important
+    # of them can be dispatched first
+    ready_jobs_lookahead = 256
+
     def __init__(self):
         super(Dispatcher, self).__init__()
 
-        # list of (tileset, workitem) tuples
-        # keeps track of dispatched but unfinished jobs
-        self._running_jobs = []
-        # list of (tileset, workitem, dependencies) tuples
-        # keeps track of jobs waiting to run after dependencies finish
-        self._pending_jobs = []
+        # Jobs are (tileset, workitem) tuples.
+        # set of jobs that were added but haven't finished yet
+        self._unfinished_jobs = set()
+        # maps jobs waiting for dependencies to finish to the number of
+        # dependencies that haven't finished yet
+        self._waiting_jobs = {}
+        # maps unfinished jobs to a list of the jobs waiting for them
+        self._dependent_jobs = {}
+        # heap of jobs whose dependencies are met, as (-priority,
+        # sequence number, job) tuples. See _make_ready()
+        self._ready_jobs = []
+        self._ready_count = itertools.count()
+        # the phase render_all() is working on
+        self.current_phase = None
+        # jobs that a subclass gave up on, to be dropped along with the
+        # jobs that depend on them, see _abandon_jobs(). Jobs that were
+        # dropped are kept in _abandoned_jobs.
+        self.abandoned_jobs = []
+        self._abandoned_jobs = set()
+        # jobs that were given up on, as (tileset, workitem) tuples. A
+        # render with any of these is incomplete.
+        self.failed_jobs = []
+
+        # the tilesets given to the last setup_tilesets() call
+        self._tilesets = []
+        # list of the cache statistics of each worker process, as
+        # returned by get_cache_stats(). Filled in by close().
+        self.cache_stats = []
+
+    def preprocess_all(self, tilesetlist):
+        """Preprocess all of the tilesets in the given tilesetlist. The
+        preprocessing work items of tilesets that share a preprocessing
+        key are dispatched together, then each tileset's
+        do_preprocessing() is called.
+        """
+        # this may change how the work items are done, so it must happen
+        # before the tilesets are sent to the workers
+        for tileset in tilesetlist:
+            tileset.prepare_preprocessing()
+        self.setup_tilesets(tilesetlist)
+
+        # group the tilesets by their key, keeping the order they
+        # were given in
+        groups = []
+        groupkeys = {}
+        for tileset in tilesetlist:
+            key = tileset.get_preprocessing_key()
+            if key not in groupkeys:
+                groupkeys[key] = len(groups)
+                groups.append([])
+            groups[groupkeys[key]].append(tileset)
+
+        def add_results(finished_jobs):
+            for tilesets, workitem, results in finished_jobs:
+                for tileset, result in zip(tilesets, results):
+                    tileset.add_preprocessing_result(workitem, result)
+            return len(finished_jobs)
+
+        # dispatch the union of each group's work items. A tileset
+        # should handle items from the rest of its group that it
+        # doesn't know about.
+        outstanding = 0
+        for group in groups:
+            group = tuple(group)
+            seen = set()
+            for tileset in group:
+                for workitem in tileset.iterate_preprocessing_items():
+                    if workitem in seen:
+                        continue
+                    seen.add(workitem)
+                    outstanding += 1
+                    outstanding -= add_results(self.dispatch_preprocessing(group, workitem))
+
+        while outstanding > 0:
+            outstanding -= add_results(self.dispatch_preprocessing(None, None))
+
+        for tileset in tilesetlist:
+            tileset.do_preprocessing()
 
     def render_all(self, tilesetlist, observer):
         """Render all of the tilesets in the given
@@ -53,246 +157,390 @@ class Dispatcher(object):
         # iterate through all possible phases
         num_phases = [tileset.get_num_phases() for tileset in tilesetlist]
         for phase in xrange(max(num_phases)):
-            # construct a list of iterators to use for this phase
-            work_iterators = []
+            self.current_phase = phase
+            # construct a list of iterators to use for this phase, with
+            # how much work each tileset has left that hasn't been added
+            sources = []
+            total_jobs = 0
             for i, tileset in enumerate(tilesetlist):
                 if phase < num_phases[i]:
-                    def make_work_iterator(tset, p):
-                        return ((tset, workitem) for workitem in tset.iterate_work_items(p))
-                    work_iterators.append(make_work_iterator(tileset, phase))
+                    # workers that can hand out work as other work
+                    # finishes do so, see _finish_jobs()
+                    if hasattr(tileset, "finish_work_item"):
+                        items = tileset.iterate_work_items(phase, streaming=True)
+                    else:
+                        items = tileset.iterate_work_items(phase)
 
-            # keep track of total jobs, and how many jobs are done
-            total_jobs = 0
-            for tileset, phases in zip(tilesetlist, num_phases):
-                if phase < phases:
+                    # keep track of total jobs, and how many jobs are done
                     jobs_for_tileset = tileset.get_phase_length(phase)
                     # if one is unknown, the total is unknown
-                    if jobs_for_tileset is None:
+                    if jobs_for_tileset is None or total_jobs is None:
                         total_jobs = None
-                        break
                     else:
                         total_jobs += jobs_for_tileset
+                    sources.append([jobs_for_tileset or 0, tileset, items])
 
             observer.start(total_jobs)
-            # go through these iterators round-robin style
-            for tileset, (workitem, deps) in util.roundrobin(work_iterators):
-                self._pending_jobs.append((tileset, workitem, deps))
-                observer.add(self._dispatch_jobs())
-
-            # after each phase, wait for the work to finish
-            while len(self._pending_jobs) > 0 or len(self._running_jobs) > 0:
+            while True:
+                # hand out the most important ready jobs the workers
+                # can take
+                observer.add(self._dispatch_jobs(wait=False))
+
+                # add jobs until there are enough ready to choose from,
+                # taking them from the tileset with the most work left
+                # so no one tileset is left running alone at the end
+                if sources and len(self._ready_jobs) < self.ready_jobs_lookahead:
+                    source = max(sources, key=lambda source: source[0])
+                    try:
+                        workitem, deps = next(source[2])
+                    except StopIteration:
+                        sources.remove(source)
+                        continue
+                    source[0] -= getattr(workitem, "weight", 1)
+                    self._add_job(source[1], workitem, deps)
+                    continue
+
+                # after all jobs are in, wait for the work to finish
+                if not self._unfinished_jobs:
+                    break
                 observer.add(self._dispatch_jobs())
 
             observer.finish()
 
-    def _dispatch_jobs(self):
-        # helper function to dispatch pending jobs when their
-        # dependencies are met, and to manage self._running_jobs
-        dispatched_jobs = []
+    def _add_job(self, tileset, workitem, deps):
+        # helper function to add a job, which is ready to dispatch once
+        # those of its dependencies that are unfinished now have finished
+        job = (tileset, workitem)
+        count = 0
+        for dep in deps:
+            dep = (tileset, dep)
+            if dep in self._abandoned_jobs:
+                self.abandoned_jobs.append(job)
+                self._abandon_jobs()
+                return
+            if dep in self._unfinished_jobs:
+                self._dependent_jobs.setdefault(dep, []).append(job)
+                count += 1
+        self._unfinished_jobs.add(job)
+        if count:
+            self._waiting_jobs[job] = count
+        else:
+            self._make_ready(job)
+
+    def _make_ready(self, job):
+        # helper function to add a job whose dependencies are met to the
+        # ready jobs, which are dispatched highest priority first, then
+        # oldest first
+        tileset, workitem = job
+        if hasattr(tileset, "get_work_item_priority"):
+            priority = tileset.get_work_item_priority(workitem)
+        else:
+            priority = 0
+        heapq.heappush(self._ready_jobs, (-priority, next(self._ready_count), job))
+
+    def _finish_jobs(self, jobs):
+        # helper function to mark jobs as finished, readying the jobs
+        # that were waiting only for them, and adding the jobs the
+        # tileset hands out now that they're done
+        for job in jobs:
+            self._unfinished_jobs.discard(job)
+            for dependent in self._dependent_jobs.pop(job, ()):
+                if dependent in self._abandoned_jobs:
+                    continue
+                count = self._waiting_jobs[dependent] - 1
+                if count:
+                    self._waiting_jobs[dependent] = count
+                else:
+                    del self._waiting_jobs[dependent]
+                    self._make_ready(dependent)
+
+            tileset, workitem = job
+            if hasattr(tileset, "finish_work_item"):
+                for newitem, deps in tileset.finish_work_item(self.current_phase, workitem):
+                    self._add_job(tileset, newitem, deps)
+
+    def _abandon_jobs(self):
+        # helper function to drop the jobs in self.abandoned_jobs, and
+        # the jobs waiting for them, which can't be done without them.
+        # They didn't finish, so unlike _finish_jobs() this doesn't
+        # tell the tileset about them.
+        while self.abandoned_jobs:
+            job = self.abandoned_jobs.pop()
+            self._abandoned_jobs.add(job)
+            self._unfinished_jobs.discard(job)
+            self._waiting_jobs.pop(job, None)
+            for dependent in self._dependent_jobs.pop(job, ()):
+                if dependent not in self._abandoned_jobs:
+                    logging.error("Skipping %r of %s, which depends on %r",
+                            dependent[1], dependent[0], job[1])
+                    self.abandoned_jobs.append(dependent)
+
+    def _dispatch_jobs(self, wait=True):
+        # helper function to dispatch the most important ready jobs for
+        # as long as the workers can take them. If none are dispatched
+        # and wait is true, this waits for jobs to finish instead.
+        # Returns how much progress the finished jobs count for.
         finished_jobs = []
 
-        pending_jobs_nodeps = [(j[0], j[1]) for j in self._pending_jobs]
-
-        for pending_job in self._pending_jobs:
-            tileset, workitem, deps = pending_job
-
-            # see if any of the deps are in _running_jobs or _pending_jobs
-            for dep in deps:
-                if (tileset, dep) in self._running_jobs or (tileset, dep) in pending_jobs_nodeps:
-                    # it is! don't dispatch this item yet
-                    break
-            else:
-                # it isn't! all dependencies are finished
-                finished_jobs += self.dispatch(tileset, workitem)
-                self._running_jobs.append((tileset, workitem))
-                dispatched_jobs.append(pending_job)
+        while self._ready_jobs and self.can_dispatch():
+            tileset, workitem = heapq.heappop(self._ready_jobs)[2]
+            jobs = self.dispatch(tileset, workitem)
+            self._finish_jobs(jobs)
+            self._abandon_jobs()
+            finished_jobs += jobs
 
         # make sure to at least get finished jobs, even if we don't
         # submit any new ones...
-        if len(dispatched_jobs) == 0:
-            finished_jobs += self.dispatch(None, None)
-
-        # clean out the appropriate lists
-        for job in finished_jobs:
-            self._running_jobs.remove(job)
-        for job in dispatched_jobs:
-            self._pending_jobs.remove(job)
+        if wait and not finished_jobs:
+            finished_jobs = self.dispatch(None, None)
+            self._finish_jobs(finished_jobs)
+            self._abandon_jobs()
 
-        return len(finished_jobs)
+        # work items may count for more than one unit of progress
+        return sum(getattr(workitem, "weight", 1) for tileset, workitem in finished_jobs)
 
     def close(self):
         """Close the Dispatcher. This should be called when you are
         done with the dispatcher, to ensure that it cleans up any
-        processes or connections it may still have around.
+        processes or connections it may still have around. It also
+        fills in self.cache_stats.
         """
-        pass
+        self.cache_stats = [get_cache_stats(self._tilesets)]
 
     def setup_tilesets(self, tilesetlist):
         """Called whenever a new list of tilesets are being used. This
         lets subclasses distribute the whole list at once, instead of
         for each work item."""
-        pass
+        self._tilesets = tilesetlist
 
     def dispatch(self, tileset, workitem):
         """Dispatch the given work item. The end result of this call
         should be running tileset.do_work(workitem) somewhere. This
         function should return a list of (tileset, workitem) tuples
         that have completed since the last call. If tileset is None,
-        then returning completed jobs is all this function should do.
+        then returning completed jobs is all this function should do,
+        after waiting for one to complete if none have and some are
+        still running.
         """
         if not tileset is None:
             tileset.do_work(workitem)
             return [(tileset, workitem),]
         return []
 
-class MultiprocessingDispatcherManager(multiprocessing.managers.BaseManager):
-    """This multiprocessing manager is responsible for giving worker
-    processes access to the communication Queues, and also gives
-    workers access to the current tileset list.
-    """
-    def _get_job_queue(self):
-        return self.job_queue
-    def _get_results_queue(self):
-        return self.result_queue
-    def _get_signal_queue(self):
-        return self.signal_queue
-    def _get_tileset_data(self):
-        return self.tileset_data
-
-    def __init__(self, address=None, authkey=None):
-        self.job_queue = multiprocessing.Queue()
-        self.result_queue = multiprocessing.Queue()
-        self.signal_queue = multiprocessing.Queue()
-
-        self.tilesets = []
-        self.tileset_version = 0
-        self.tileset_data = [[], 0]
-
-        self.register("get_job_queue", callable=self._get_job_queue)
-        self.register("get_result_queue", callable=self._get_results_queue)
-        self.register("get_signal_queue", callable=self._get_signal_queue)
-        self.register("get_tileset_data", callable=self._get_tileset_data, proxytype=multiprocessing.managers.ListProxy)
-
-        super(MultiprocessingDispatcherManager, self).__init__(address=address, authkey=authkey)
-
-    @classmethod
-    def from_address(cls, address, authkey, serializer):
-        "Required to be implemented to make multiprocessing happy"
-        c = cls(address=address, authkey=authkey)
-        return c
-
-    def set_tilesets(self, tilesets):
-        """This is used in MultiprocessingDispatcher.setup_tilesets to
-        update the tilesets each worker has access to. It also
-        increments a `tileset_version` which is an easy way for
-        workers to see if their tileset list is out-of-date without
-        pickling and copying over the entire list.
+    def can_dispatch(self):
+        """Returns whether dispatch() can take another job now,
+        without waiting for others to finish. Jobs are held back
+        while it can't, so that the most important ones can go first
+        when it can.
         """
-        self.tilesets = tilesets
-        self.tileset_version += 1
-        data = self.get_tileset_data()
-        data[0] = self.tilesets
-        data[1] = self.tileset_version
-
+        return True
+
+    def dispatch_preprocessing(self, tilesets, workitem):
+        """Dispatch the given preprocessing work item for the given
+        tuple of tilesets. The end result of this call should be
+        running tileset.do_preprocessing_work(workitem) for each of
+        them, together, somewhere. This function should return a list
+        of (tilesets, workitem, results) tuples, with results in the
+        same order as tilesets, that have completed since the last
+        call. If tilesets is None, then returning completed jobs is all
+        this function should do.
+        """
+        if not tilesets is None:
+            results = [tileset.do_preprocessing_work(workitem) for tileset in tilesets]
+            return [(tilesets, workitem, results),]
+        return []
 
-class MultiprocessingDispatcherProcess(multiprocessing.Process):
-    """This class represents a single worker process. It is created
-    automatically by MultiprocessingDispatcher, but it can even be
-    used manually to spawn processes on different machines on the same
-    network.
+class LocalMultiprocessingDispatcherProcess(multiprocessing.Process):
+    """This class represents a single worker process of a
+    LocalMultiprocessingDispatcher or a NetworkDispatcher. It talks to
+    the dispatcher only through its end of a pipe or network
+    connection.
     """
-    def __init__(self, manager):
-        """Creates the process object. manager should be an instance
-        of MultiprocessingDispatcherManager connected to the one
-        created in MultiprocessingDispatcher.
+    # Seconds between the heartbeats the worker sends, so the
+    # dispatcher can tell a busy worker from a dead or unreachable one
+    heartbeat_interval = 5.0
+
+    def __init__(self, conn):
+        """Creates the process object. conn is the worker's end of a
+        multiprocessing.Pipe(), the other end of which is kept by the
+        dispatcher, or a connection to a NetworkDispatcher.
         """
-        super(MultiprocessingDispatcherProcess, self).__init__()
-        self.job_queue = manager.get_job_queue()
-        self.result_queue = manager.get_result_queue()
-        self.signal_queue = manager.get_signal_queue()
-        self.tileset_proxy = manager.get_tileset_data()
-
-    def update_tilesets(self):
-        """A convenience function to update our local tilesets to the
-        current version in use by the MultiprocessingDispatcher.
-        """
-        self.tilesets, self.tileset_version = self.tileset_proxy._getvalue()
+        super(LocalMultiprocessingDispatcherProcess, self).__init__()
+        self.conn = conn
+        self.tilesets = []
 
     def run(self):
-        """The main work loop. Jobs are pulled from the job queue and
-        executed, then the result is pushed onto the result
-        queue. Updates to the tilesetlist are recognized and handled
-        automatically. This is the method that actually runs in the
-        new worker process.
+        """The main work loop. Messages are received from the pipe and
+        handled in order: new tileset lists, batches of jobs, whose
+        results are sent back as one message, and finally the request
+        to exit. Each result includes how long the job took. Signals
+        are sent back through the pipe too, and a thread sends a
+        heartbeat every heartbeat_interval seconds. If the dispatcher
+        goes away, the worker just exits.
         """
-        # per-process job get() timeout
-        timeout = 1.0
-
-        # update our tilesets
-        self.update_tilesets()
+        conn = self.conn
+        lock = threading.Lock()
+        def send(message):
+            with lock:
+                conn.send(message)
 
         # register for all available signals
         def register_signal(name, sig):
             def handler(*args, **kwargs):
-                self.signal_queue.put((name, args, kwargs), False)
+                send(("signal", name, args, kwargs))
             sig.set_interceptor(handler)
         for name, sig in Signal.signals.iteritems():
             register_signal(name, sig)
 
-        # notify that we're starting up
-        self.result_queue.put(None, False)
-        while True:
-            try:
-                job = self.job_queue.get(True, timeout)
-                if job == None:
-                    # this is a end-of-jobs sentinel
+        stopped = threading.Event()
+        def send_heartbeats():
+            while not stopped.wait(self.heartbeat_interval):
+                try:
+                    send(("heartbeat",))
+                except (EOFError, IOError):
                     return
+        heartbeat = threading.Thread(target=send_heartbeats)
+        heartbeat.daemon = True
+        heartbeat.start()
 
-                # unpack job
-                tv, ti, workitem = job
-
-                if tv != self.tileset_version:
-                    # our tilesets changed!
-                    self.update_tilesets()
-                    assert tv == self.tileset_version
-
-                # do job
-                ret = self.tilesets[ti].do_work(workitem)
-                result = (ti, workitem, ret,)
-                self.result_queue.put(result, False)
-            except Queue.Empty:
-                pass
-
-class MultiprocessingDispatcher(Dispatcher):
-    """A subclass of Dispatcher that spawns worker processes and
-    distributes jobs to them to speed up processing.
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, IOError):
+                    return
+                kind = message[0]
+                if kind == "tilesets":
+                    self.tilesets = message[1]
+                elif kind == "jobs":
+                    # Preprocessing jobs are for a tuple of tilesets
+                    # instead of a single one
+                    results = []
+                    for ti, workitem in message[1]:
+                        start = time.time()
+                        if isinstance(ti, tuple):
+                            ret = [self.tilesets[i].do_preprocessing_work(workitem) for i in ti]
+                        else:
+                            ret = self.tilesets[ti].do_work(workitem)
+                        results.append((ti, workitem, ret, time.time() - start))
+                    send(("results", results))
+                elif kind == "exit":
+                    send(("exit", get_cache_stats(self.tilesets)))
+                    return
+        finally:
+            stopped.set()
+            heartbeat.join()
+            conn.close()
+
+class _WorkerConnection(object):
+    """The dispatcher's end of the connection to one worker process of a
+    LocalMultiprocessingDispatcher, and what it knows about the work it
+    has sent the worker. process is the worker's Process object, if it's
+    a local one.
+    """
+    def __init__(self, conn, name, process=None):
+        self.conn = conn
+        self.name = name
+        self.process = process
+        # how many jobs the worker has been sent that haven't finished,
+        # and their estimated time
+        self.jobs = 0
+        self.load = 0.0
+        # a (send time, estimated time, jobs) tuple for each of its
+        # unfinished batches
+        self.batches = deque()
+        # when the worker last sent results, and any message at all
+        self.last_result = 0.0
+        self.last_message = time.time()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+class LocalMultiprocessingDispatcher(Dispatcher):
+    """A subclass of Dispatcher that spawns worker processes on this
+    machine and distributes jobs to them over a pipe to each one, in
+    batches. NetworkDispatcher uses the same batches and messages over
+    network connections, for workers on other machines.
     """
-    def __init__(self, local_procs=-1, address=None, authkey=None):
+    # Weight of a new measurement in the moving averages of the
+    # service times and latency
+    ewma_weight = 0.2
+    # Service time assumed for jobs of a kind that hasn't finished yet,
+    # when no jobs have
+    default_service_time = 0.01
+    # The least work, in seconds, each worker is kept supplied with
+    min_prefetch_time = 0.01
+    # The most jobs sent to a worker at once, however quick they are
+    max_worker_jobs = 1000
+    # How long, in seconds, a worker may go without sending anything
+    # before it's given up for dead, and how often that is checked
+    worker_timeout = 60.0
+    check_interval = 1.0
+    # How long, in seconds, a job may take for each unit of its weight
+    # before its worker is taken to be hung
+    job_timeout = 300.0
+    # How many times a job may be lost along with its worker before
+    # it's given up on
+    max_job_failures = 3
+    # How many local workers may be started to replace lost ones
+    max_respawns = 16
+
+    def __init__(self, local_procs=-1, batch_size=8):
         """Creates the dispatcher. local_procs should be the number of
         worker processes to spawn. If it's omitted (or negative)
-        the number of available CPUs is used instead.
+        the number of available CPUs is used instead. Jobs are sent to
+        the workers in batches of up to batch_size jobs.
+
+        Instead of a fixed number of jobs, each worker is sent enough
+        work to keep it busy while its next batch is on the way, going
+        by how long jobs of the same tileset and phase have taken.
+
+        If a worker dies, isn't heard from for worker_timeout seconds,
+        or spends more than job_timeout seconds on a job, the jobs it
+        hadn't finished are sent to the others, one job per batch, and
+        a local worker is replaced. A job that keeps taking its workers
+        down is given up on, along with the jobs that depend on it, and
+        listed in failed_jobs.
         """
-        super(MultiprocessingDispatcher, self).__init__()
+        super(LocalMultiprocessingDispatcher, self).__init__()
 
         # automatic local_procs handling
         if local_procs < 0:
             local_procs = multiprocessing.cpu_count()
         self.local_procs = local_procs
+        self.batch_size = max(batch_size, 1)
 
+        self.tilesets = []
+        # whether the workers were asked to exit
+        self.closing = False
+        # jobs waiting to be sent to a worker in the next batch
+        self.job_batch = []
         self.outstanding_jobs = 0
-        self.num_workers = 0
-        self.manager = MultiprocessingDispatcherManager(address=address, authkey=authkey)
-        self.manager.start()
-        self.job_queue = self.manager.get_job_queue()
-        self.result_queue = self.manager.get_result_queue()
-        self.signal_queue = self.manager.get_signal_queue()
-
-        # create and fill the pool
+        # estimated time of the jobs in job_batch
+        self.job_batch_time = 0.0
+        # preprocessing jobs that finished, waiting to be returned
+        # by dispatch_preprocessing()
+        self.finished_preprocessing = []
+
+        # jobs of lost workers, waiting to be sent again
+        self.retry_jobs = deque()
+        # how many times each job was lost with its worker
+        self.job_failures = {}
+        self.respawns_left = self.max_respawns
+
+        # moving averages of the time a job takes for each unit of
+        # weight, keyed by (tileset, phase). See get_service_times()
+        self.service_times = {}
+        # moving average of the time a batch spends getting to a
+        # worker and back, besides the time its jobs take
+        self.latency = 0.0
+
+        # create and fill the pool. workers has a _WorkerConnection for
+        # each worker that's still running.
         self.pool = []
+        self.workers = []
         for i in xrange(self.local_procs):
-            proc = MultiprocessingDispatcherProcess(self.manager)
-            proc.start()
-            self.pool.append(proc)
+            self._start_local_worker()
 
     def close(self):
         # empty the queue
@@ -300,20 +548,42 @@ class MultiprocessingDispatcher(Dispatcher):
         while self.outstanding_jobs > 0:
             self._handle_messages()
 
-        # send of the end-of-jobs sentinel
-        for p in xrange(self.num_workers):
-            self.job_queue.put(None, False)
-
-        # TODO better way to be sure worker processes get the message
-        time.sleep(1)
-
-        # and close the manager
-        self.manager.shutdown()
-        self.manager = None
+        # ask the workers to exit, and wait for each of them to send
+        # back its statistics as it does
+        self.closing = True
+        for worker in list(self.workers):
+            self._send(worker, ("exit",))
+        while self.workers:
+            self._handle_messages()
+        for p in self.pool:
+            p.join()
         self.pool = None
 
+        if self.failed_jobs:
+            logging.error("%d jobs were given up on after they were lost with their workers",
+                    len(self.failed_jobs))
+        for (tileset, phase), seconds in sorted(self.get_service_times().items()):
+            logging.debug("Jobs for %s, phase %s took %.1f ms", tileset, phase, seconds * 1000)
+        logging.debug("Jobs took %.1f ms to get to the workers and back", self.latency * 1000)
+
+    def get_service_times(self):
+        """Returns a dictionary mapping (tileset, phase) tuples to the
+        average time in seconds a job of that phase for that tileset
+        has taken, for each unit of its weight. The phase is
+        "preprocessing" for preprocessing jobs, whose tileset is a
+        tuple of the tilesets they were for.
+        """
+        return dict(self.service_times)
+
     def setup_tilesets(self, tilesets):
-        self.manager.set_tilesets(tilesets)
+        # the queued jobs refer to the old tilesets
+        self._send_jobs()
+        self.tilesets = tilesets
+        for worker in list(self.workers):
+            self._send(worker, ("tilesets", tilesets))
+
+    def can_dispatch(self):
+        return not self._workers_full()
 
     def dispatch(self, tileset, workitem):
         # handle the no-new-work case
@@ -321,62 +591,431 @@ class MultiprocessingDispatcher(Dispatcher):
             return self._handle_messages()
 
         # create and submit the job
-        tileset_index = self.manager.tilesets.index(tileset)
-        self.job_queue.put((self.manager.tileset_version, tileset_index, workitem), False)
+        tileset_index = self.tilesets.index(tileset)
+        return self._submit_job(tileset_index, workitem)
+
+    def dispatch_preprocessing(self, tilesets, workitem):
+        # handle the no-new-work case
+        if tilesets is None:
+            self._handle_messages()
+        else:
+            tileset_indices = tuple(self.tilesets.index(tileset) for tileset in tilesets)
+            self._submit_job(tileset_indices, workitem)
+
+        finished = self.finished_preprocessing
+        self.finished_preprocessing = []
+        return finished
+
+    def _start_local_worker(self):
+        # starts a worker process on this machine
+        conn, child_conn = multiprocessing.Pipe()
+        proc = LocalMultiprocessingDispatcherProcess(child_conn)
+        proc.start()
+        child_conn.close()
+        self.pool.append(proc)
+        self._add_worker(conn, proc.name, proc)
+
+    def _add_worker(self, conn, name, process=None):
+        # starts sending jobs to a newly started worker
+        worker = _WorkerConnection(conn, name, process)
+        self.workers.append(worker)
+        if self.closing:
+            self._send(worker, ("exit",))
+        elif self.tilesets:
+            if self._send(worker, ("tilesets", self.tilesets)):
+                self._send_jobs()
+
+    def _send(self, worker, message):
+        # sends a message to a worker, and returns whether it could
+        try:
+            worker.conn.send(message)
+        except (EOFError, IOError) as e:
+            self._lose_worker(worker, "could not be reached (%s)" % e)
+            return False
+        return True
+
+    def _lose_worker(self, worker, reason):
+        # stops using a worker that died, hung or can't be reached,
+        # replacing it if it's a local one, and sends its unfinished
+        # jobs to the others
+        if worker not in self.workers:
+            return
+        self.workers.remove(worker)
+        try:
+            worker.conn.close()
+        except (EnvironmentError, EOFError):
+            pass
+        if worker.process is not None:
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.process.join()
+            self.pool.remove(worker.process)
+
+        jobs = [job for sent, estimate, batch in worker.batches for job in batch]
+        logging.warning("Worker %s %s; its %d unfinished jobs will be retried",
+                worker.name, reason, len(jobs))
+
+        # Any of the jobs could have been the cause, so each is retried
+        # on its own, to find out which
+        for job in jobs:
+            failures = self.job_failures.get(job, 0) + 1
+            self.job_failures[job] = failures
+            if failures >= self.max_job_failures:
+                self._give_up_job(job, failures)
+            else:
+                self.retry_jobs.append(job)
+
+        if worker.process is not None and not self.closing and self.respawns_left > 0:
+            self.respawns_left -= 1
+            self._start_local_worker()
+        if not self.workers and self.outstanding_jobs > 0:
+            self._no_workers_left()
+        self._send_jobs()
+
+    def _give_up_job(self, job, failures):
+        # gives up on a job that keeps failing. A preprocessing job is
+        # counted as done, with no results.
+        ti, workitem = job
+        if isinstance(ti, tuple):
+            tilesets = tuple(self.tilesets[i] for i in ti)
+            self.finished_preprocessing.append((tilesets, workitem, []))
+        else:
+            tilesets = self.tilesets[ti]
+            self.abandoned_jobs.append((tilesets, workitem))
+        logging.error("Giving up on %r of %s: %d workers were lost while doing it",
+                workitem, tilesets, failures)
+        self.failed_jobs.append((tilesets, workitem))
+        self.outstanding_jobs -= 1
+
+    def _no_workers_left(self):
+        # called when the last worker is lost while jobs are unfinished
+        raise RuntimeError("All the worker processes have died, with %d jobs unfinished" %
+                self.outstanding_jobs)
+
+    def _check_workers(self):
+        # called while waiting for messages. Gives up on the workers
+        # that exited, haven't been heard from for too long, or have
+        # been at their current batch for too long.
+        now = time.time()
+        for worker in list(self.workers):
+            if (worker.process is not None and not worker.process.is_alive() and
+                    not worker.conn.poll()):
+                self._lose_worker(worker, "exited with code %s" % worker.process.exitcode)
+            elif now - worker.last_message > self.worker_timeout:
+                self._lose_worker(worker, "has not been heard from for %d seconds" %
+                        (now - worker.last_message))
+            elif worker.batches:
+                sent, estimate, batch = worker.batches[0]
+                started = max(sent, worker.last_result)
+                weight = sum(getattr(workitem, "weight", 1) for ti, workitem in batch)
+                if now - started > self.job_timeout * weight:
+                    self._lose_worker(worker, "has been on a batch of %d jobs for %.1f seconds" %
+                            (len(batch), now - started))
+
+    def _submit_job(self, tileset_index, workitem):
+        self.job_batch.append((tileset_index, workitem))
+        self.job_batch_time += self._estimate_time(tileset_index, workitem)
         self.outstanding_jobs += 1
 
-        # make sure the queue doesn't fill up too much
+        # send a batch when it's full, or right away if a worker is
+        # running out of work
+        prefetch = self._get_prefetch_time()
+        if (len(self.job_batch) >= self.batch_size or
+                any(worker.jobs == 0 or worker.load + self.job_batch_time < prefetch
+                    for worker in self.workers)):
+            self._send_jobs()
+
+        # only keep each worker supplied with enough work for a bit
+        # more than it takes to send it more
         finished_jobs = self._handle_messages(timeout=0.0)
-        while self.outstanding_jobs > self.num_workers * 10:
+        while self._workers_full():
             finished_jobs += self._handle_messages()
         return finished_jobs
 
-    def _handle_messages(self, timeout=0.01):
-        # work function: takes results out of the result queue and
-        # keeps track of how many outstanding jobs remain
+    def _workers_full(self):
+        # returns whether every worker has all the work it should have
+        prefetch = self._get_prefetch_time()
+        return all(worker.jobs >= self.max_worker_jobs or
+                (worker.jobs >= 2 and worker.load >= prefetch)
+                for worker in self.workers)
+
+    def _get_job_key(self, tileset_index):
+        # returns the key of the service time of the jobs with the
+        # given tileset index
+        if isinstance(tileset_index, tuple):
+            return tuple(self.tilesets[i] for i in tileset_index), "preprocessing"
+        return self.tilesets[tileset_index], self.current_phase
+
+    def _estimate_time(self, tileset_index, workitem):
+        # returns how long the given job is expected to take
+        service_times = self.service_times
+        key = self._get_job_key(tileset_index)
+        if key in service_times:
+            seconds = service_times[key]
+        elif service_times:
+            seconds = sum(service_times.itervalues()) / len(service_times)
+        else:
+            seconds = self.default_service_time
+        return seconds * getattr(workitem, "weight", 1)
+
+    def _get_prefetch_time(self):
+        # returns how much work, in seconds, each worker should have:
+        # enough to cover getting it another batch, a few times over
+        return max(4 * self.latency, self.min_prefetch_time)
+
+    def _send_jobs(self):
+        # sends the jobs to retry, each on its own, and then the
+        # waiting jobs as one batch
+        while self.retry_jobs and self.workers:
+            job = self.retry_jobs.popleft()
+            self._send_batch([job], self._estimate_time(*job))
+        while self.job_batch and self.workers:
+            batch, estimate = self.job_batch, self.job_batch_time
+            self.job_batch = []
+            self.job_batch_time = 0.0
+            self._send_batch(batch, estimate)
+
+    def _send_batch(self, batch, estimate):
+        # sends a batch of jobs to the least busy worker. The batch is
+        # recorded first, so it's retried if the worker turns out to be
+        # gone.
+        worker = min(self.workers, key=lambda w: (w.load, w.jobs))
+        worker.jobs += len(batch)
+        worker.load += estimate
+        worker.batches.append((time.time(), estimate, batch))
+        self._send(worker, ("jobs", batch))
+
+    def _handle_messages(self, timeout=None):
+        # work function: takes messages out of the pipes and keeps
+        # track of how many outstanding jobs remain. Unless timeout is
+        # 0, this first waits up to timeout seconds for a message, or
+        # if it's None, for as long as there are messages to come.
         finished_jobs = []
 
-        result_empty = False
-        signal_empty = False
-        while not (result_empty and signal_empty):
-            if not result_empty:
-                try:
-                    result = self.result_queue.get(False)
+        # about to wait for results, so don't hold back a partial batch
+        if timeout != 0.0:
+            self._send_jobs()
+        if timeout is not None:
+            deadline = time.time() + timeout
 
-                    if result != None:
-                        # completed job
-                        ti, workitem, ret = result
-                        finished_jobs.append((self.manager.tilesets[ti], workitem))
-                        self.outstanding_jobs -= 1
-                    else:
-                        # new worker
-                        self.num_workers += 1
-                except Queue.Empty:
-                    result_empty = True
-            if not signal_empty:
+        while not self._receive_messages(finished_jobs):
+            self._check_workers()
+            if timeout is None:
+                if self.outstanding_jobs == 0 and not (self.closing and self.workers):
+                    break
+                wait = self.check_interval
+            else:
+                wait = min(deadline - time.time(), self.check_interval)
+                if wait <= 0:
+                    break
+            self._wait_for_messages(wait)
+
+        return finished_jobs
+
+    def _receive_messages(self, finished_jobs):
+        # handles all the messages that have arrived, and returns
+        # whether there were any
+        received = False
+        for worker in list(self.workers):
+            # stop at the exit message, after which the pipe is closed
+            while worker in self.workers:
                 try:
-                    if timeout > 0.0:
-                        name, args, kwargs = self.signal_queue.get(True, timeout)
-                    else:
-                        name, args, kwargs = self.signal_queue.get(False)
-                    # timeout should only apply once
-                    timeout = 0.0
+                    if not worker.conn.poll():
+                        break
+                    message = worker.conn.recv()
+                except (EOFError, IOError):
+                    self._lose_worker(worker, "exited unexpectedly")
+                    break
+                worker.last_message = time.time()
+                self._handle_message(worker, message, finished_jobs)
+                received = True
+        return received
+
+    def _wait_for_messages(self, timeout):
+        # waits until a message arrives from any of the workers, or up
+        # to timeout seconds
+        workers = self.workers
+        if workers and _can_select_pipes:
+            try:
+                select.select(workers, [], [], timeout)
+            except select.error:
+                # interrupted; the caller will ask again
+                pass
+            return
 
-                    sig = Signal.signals[name]
-                    sig.emit_intercepted(*args, **kwargs)
-                except Queue.Empty:
-                    signal_empty = True
+        # otherwise, poll each pipe in turn
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if any(worker.conn.poll() for worker in workers):
+                    return
+            except (EOFError, IOError):
+                # let _receive_messages() find out which one it was
+                return
+            time.sleep(0.001)
+
+    def _handle_message(self, worker, message, finished_jobs):
+        # handles one message from the given worker
+        kind = message[0]
+        if kind == "results":
+            w = self.ewma_weight
+            service_time = 0.0
+            for ti, workitem, ret, seconds in message[1]:
+                if isinstance(ti, tuple):
+                    tilesets = tuple(self.tilesets[i] for i in ti)
+                    self.finished_preprocessing.append((tilesets, workitem, ret))
+                else:
+                    finished_jobs.append((self.tilesets[ti], workitem))
+
+                key = self._get_job_key(ti)
+                seconds_per_unit = seconds / max(getattr(workitem, "weight", 1), 1)
+                if key in self.service_times:
+                    self.service_times[key] += w * (seconds_per_unit - self.service_times[key])
+                else:
+                    self.service_times[key] = seconds_per_unit
+                service_time += seconds
+            self.outstanding_jobs -= len(message[1])
+            worker.jobs -= len(message[1])
+
+            # the batch started when it arrived, or when the worker
+            # finished the one before, whichever was later
+            now = time.time()
+            sent, estimate, batch = worker.batches.popleft()
+            worker.load = max(worker.load - estimate, 0.0)
+            started = max(sent, worker.last_result)
+            worker.last_result = now
+            self.latency += w * (max(now - started - service_time, 0.0) - self.latency)
+        elif kind == "signal":
+            name, args, kwargs = message[1:]
+            Signal.signals[name].emit_intercepted(*args, **kwargs)
+        elif kind == "exit":
+            self.cache_stats.append(message[1])
+            self.workers.remove(worker)
+            worker.conn.close()
+
+def parse_address(address):
+    """Parses a "host:port" string into a (host, port) tuple, as taken by
+    NetworkDispatcher. A missing host means all of this machine's
+    addresses. Raises ValueError if there's no port number.
+    """
+    host, sep, port = address.rpartition(":")
+    if not sep:
+        raise ValueError("%r should be in the form host:port" % address)
+    return host or "0.0.0.0", int(port)
+
+def _run_network_worker(address, authkey, connect_timeout):
+    # the body of each worker process started by
+    # NetworkDispatcher.start_workers()
+    deadline = time.time() + connect_timeout
+    while True:
+        try:
+            conn = multiprocessing.connection.Client(address, authkey=authkey)
+            break
+        except multiprocessing.AuthenticationError:
+            logging.error("The dispatcher at %s:%d did not accept our authkey", *address)
+            return
+        except EnvironmentError as e:
+            # the dispatcher may not be listening yet
+            if time.time() > deadline:
+                logging.error("Could not connect to the dispatcher at %s:%d: %s",
+                        address[0], address[1], e)
+                return
+            time.sleep(1.0)
+    LocalMultiprocessingDispatcherProcess(conn).run()
+
+class NetworkDispatcher(LocalMultiprocessingDispatcher):
+    """A LocalMultiprocessingDispatcher that also takes worker
+    processes on other machines, which connect to it over the network
+    with start_workers(). Workers may connect (and go away) at any time
+    during the render.
+
+    The workers read the world and write the tiles themselves, so the
+    world and output directories have to be at the same paths on every
+    machine, as on a shared network filesystem. Each job is a whole
+    subtree of tiles when the tilesets batch their work items (see the
+    batchlevels option), so a worker renders all the tiles of a subtree
+    from the chunks it has cached.
+    """
+    def __init__(self, address, authkey, local_procs=0, batch_size=8):
+        """Creates the dispatcher, listening for workers on address, a
+        (host, port) tuple. Workers must give the same authkey, a
+        string. Any local_procs worker processes on this machine are
+        started too.
+        """
+        # connections are accepted by a thread, and picked up by the
+        # dispatcher the next time it checks on its workers
+        self.new_connections = Queue.Queue()
+        self.listener = multiprocessing.connection.Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.listening = True
+        accepter = threading.Thread(target=self._accept_connections)
+        accepter.daemon = True
+        accepter.start()
+        logging.info("Listening for workers on %s:%d", *self.address)
+
+        super(NetworkDispatcher, self).__init__(local_procs=local_procs, batch_size=batch_size)
 
-        return finished_jobs
+    def close(self):
+        super(NetworkDispatcher, self).close()
+        # The accepting thread keeps waiting for a connection, but will
+        # turn away any more workers
+        self.listening = False
+        self.listener.close()
+        self._add_new_workers()
+
+    def _accept_connections(self):
+        # the body of the thread that accepts connections from workers
+        while self.listening:
+            try:
+                conn = self.listener.accept()
+            except (multiprocessing.AuthenticationError, EnvironmentError, EOFError) as e:
+                if not self.listening:
+                    return
+                logging.warning("A worker failed to connect: %s", e)
+                continue
+            if not self.listening:
+                conn.close()
+                return
+            self.new_connections.put((conn, self.listener.last_accepted))
+
+    def _add_new_workers(self):
+        # starts using the workers that have connected
+        while True:
+            try:
+                conn, address = self.new_connections.get_nowait()
+            except Queue.Empty:
+                return
+            if not self.listening:
+                conn.close()
+                continue
+            name = "%s:%d" % address
+            logging.info("Worker %s connected", name)
+            self._add_worker(conn, name)
+
+    def _check_workers(self):
+        self._add_new_workers()
+        super(NetworkDispatcher, self)._check_workers()
+
+    def _no_workers_left(self):
+        # more workers may yet connect
+        logging.warning("No workers are left; waiting for more to connect to %s:%d",
+                *self.address)
 
     @classmethod
-    def start_manual_process(cls, address, authkey):
-        """A convenience method to start up a manual process, possibly
-        on another machine. Address is a (hostname, port) tuple, and
-        authkey must be the same as that provided to the
-        MultiprocessingDispatcher constructor.
+    def start_workers(cls, address, authkey, procs=-1, connect_timeout=60.0):
+        """Starts procs worker processes (or as many as there are CPUs,
+        if it's negative) on this machine for the NetworkDispatcher at
+        address, a (host, port) tuple, and returns when they have all
+        exited. The dispatcher doesn't have to be up yet; each process
+        keeps trying to connect to it for connect_timeout seconds.
         """
-        m = MultiprocessingDispatcherManager(address=address, authkey=authkey)
-        m.connect()
-        p = MultiprocessingDispatcherProcess(m)
-        p.run()
+        if procs < 0:
+            procs = multiprocessing.cpu_count()
+        pool = []
+        for i in xrange(procs):
+            proc = multiprocessing.Process(target=_run_network_worker,
+                    args=(address, authkey, connect_timeout))
+            proc.start()
+            pool.append(proc)
+        for proc in pool:
+            proc.join()
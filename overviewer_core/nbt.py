@@ -17,6 +17,9 @@ import gzip, zlib
 import struct
 import StringIO
 import functools
+import mmap
+
+import numpy
 
 # decorator that turns the first argument from a string into an open file
 # handle
@@ -73,13 +76,21 @@ class NBTFileReader(object):
     def __init__(self, fileobj, is_gzip=True):
         """Create a NBT parsing object with the given file-like
         object. Setting is_gzip to False parses the file as a zlib
-        stream instead."""
+        stream instead. The compressed data may also be given directly
+        as a string or buffer."""
+        in_memory = isinstance(fileobj, (str, buffer))
         if is_gzip:
+            if in_memory:
+                fileobj = StringIO.StringIO(fileobj)
             self._file = gzip.GzipFile(fileobj=fileobj, mode='rb')
         else:
             # pure zlib stream -- maybe later replace this with
             # a custom zlib file object?
-            data = zlib.decompress(fileobj.read())
+            if in_memory:
+                # decompress straight from the given memory
+                data = zlib.decompress(fileobj)
+            else:
+                data = zlib.decompress(fileobj.read())
             self._file = StringIO.StringIO(data)
 
         # mapping of NBT type ids to functions to read them out
@@ -98,6 +109,29 @@ class NBTFileReader(object):
             11:self._read_tag_int_array,
         }
 
+        # mapping of NBT type ids to functions to skip over them, used for
+        # tags the caller didn't ask for
+        self._skip_tagmap = {
+            0: self._skip_tag_end,
+            7: self._skip_tag_byte_array,
+            8: self._skip_tag_string,
+            9: self._skip_tag_list,
+            10:self._skip_tag_compound,
+            11:self._skip_tag_int_array,
+        }
+        for tagid, size in self._tag_sizes.iteritems():
+            self._skip_tagmap[tagid] = functools.partial(self._skip, size)
+
+    # payload sizes of the tags that always take up the same number of bytes
+    _tag_sizes = {
+        1: 1,
+        2: 2,
+        3: 4,
+        4: 8,
+        5: 4,
+        6: 8,
+    }
+
     # These private methods read the payload only of the following types
     def _read_tag_end(self):
         # Nothing to read
@@ -154,8 +188,10 @@ class NBTFileReader(object):
             l.append(read_method())
         return l
 
-    def _read_tag_compound(self):
-        # Build a dictionary of all the tag names mapping to their payloads
+    def _read_tag_compound(self, tagfilter=None):
+        # Build a dictionary of all the tag names mapping to their payloads.
+        # If a tagfilter is given (see _compile_tagpaths()), only the tags
+        # named in it are read, and all others are skipped.
         tags = {}
         while True:
             # Read a tag
@@ -165,17 +201,73 @@ class NBTFileReader(object):
                 break
 
             name = self._read_tag_string()
-            payload = self._read_tagmap[tagtype]()
+            if tagfilter is None:
+                payload = self._read_tagmap[tagtype]()
+            elif name not in tagfilter:
+                self._skip_tagmap[tagtype]()
+                continue
+            elif tagtype == 10:
+                payload = self._read_tag_compound(tagfilter[name])
+            else:
+                payload = self._read_tagmap[tagtype]()
             tags[name] = payload
 
         return tags
-    
-    def read_all(self):
+
+    # These private methods skip over the payload of the following types
+    # without decoding it
+    def _skip(self, length):
+        self._file.seek(length, 1)
+
+    def _skip_tag_end(self):
+        pass
+
+    def _skip_tag_byte_array(self):
+        self._skip(self._read_tag_int())
+
+    def _skip_tag_int_array(self):
+        self._skip(self._read_tag_int() * 4)
+
+    def _skip_tag_string(self):
+        self._skip(self._read_tag_short())
+
+    def _skip_tag_list(self):
+        tagid = self._read_tag_byte()
+        length = self._read_tag_int()
+
+        if tagid in self._tag_sizes:
+            # a list of fixed-size items can be skipped all at once
+            self._skip(self._tag_sizes[tagid] * length)
+            return
+        skip_method = self._skip_tagmap[tagid]
+        for _ in xrange(length):
+            skip_method()
+
+    def _skip_tag_compound(self):
+        while True:
+            tagtype = ord(self._file.read(1))
+            if tagtype == 0:
+                break
+            self._skip_tag_string()
+            self._skip_tagmap[tagtype]()
+
+    def read_all(self, tagpaths=None):
         """Reads the entire file and returns (name, payload)
         name is the name of the root tag, and payload is a dictionary mapping
         names to their payloads
 
+        tagpaths, if given, is a sequence of slash-separated tag paths relative
+        to the root compound, e.g. "Level/Sections". Only the tags on these
+        paths are decoded; every other tag is skipped over without building
+        its payload, so the returned dictionary only contains the requested
+        tags and the compounds that lead to them.
+
         """
+        if tagpaths is not None:
+            tagfilter = _compile_tagpaths(tagpaths)
+        else:
+            tagfilter = None
+
         # Read tag type
         try:
             tagtype = ord(self._file.read(1))
@@ -184,12 +276,34 @@ class NBTFileReader(object):
             
             # Read the tag name
             name = self._read_tag_string()
-            payload = self._read_tag_compound()
+            payload = self._read_tag_compound(tagfilter)
             
             return (name, payload)
         except (struct.error, ValueError), e:
             raise CorruptNBTError("could not parse nbt: %s" % (str(e),))
 
+def _compile_tagpaths(tagpaths):
+    """Turns a sequence of slash-separated tag paths into the nested filter
+    dictionaries used by NBTFileReader._read_tag_compound(). Each key maps to
+    the filter for that compound's children, or None to read the tag and
+    everything below it.
+
+    """
+    tagfilter = {}
+    for path in tagpaths:
+        node = tagfilter
+        names = path.strip("/").split("/")
+        for name in names[:-1]:
+            child = node.get(name, {})
+            if child is None:
+                # an ancestor is already being read in full
+                break
+            node[name] = child
+            node = child
+        else:
+            node[names[-1]] = None
+    return tagfilter
+
 # For reference, the MCR format is outlined at
 # <http://www.minecraftwiki.net/wiki/Beta_Level_Format>
 class MCRFileReader(object):
@@ -197,28 +311,48 @@ class MCRFileReader(object):
     Beta 1.3 update. It provides functions for opening individual
     chunks (as (name, data) tuples), getting chunk timestamps, and for
     listing chunks contained in the file.
+
+    Where possible, the region file is memory-mapped, and the header tables
+    and chunk payloads are read straight out of the mapping.
     """
     
-    _table_format = struct.Struct(">1024I")
     _chunk_header_format = struct.Struct(">I B")
     
     def __init__(self, fileobj):
         """This creates a region object from the given file-like
         object. Chances are you want to use load_region instead."""
         self._file = fileobj
-        
-        # read in the location table
-        location_data = self._file.read(4096)
-        if not len(location_data) == 4096:
+        self._data = None
+
+        try:
+            self._data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError, mmap.error):
+            # not a real file, or an empty one: read it all in instead,
+            # which str supports the same way as the mapping
+            self._data = fileobj.read()
+        else:
+            # the mapping holds its own descriptor, so the file object
+            # isn't needed any more
+            fileobj.close()
+            self._file = None
+
+        if len(self._data) < 4096:
             raise CorruptRegionError("invalid location table")
-        # read in the timestamp table
-        timestamp_data = self._file.read(4096)
-        if not len(timestamp_data) == 4096:
+        if len(self._data) < 8192:
             raise CorruptRegionError("invalid timestamp table")
 
-        # turn this data into a useful list
-        self._locations = self._table_format.unpack(location_data)
-        self._timestamps = self._table_format.unpack(timestamp_data)
+        # turn the location and timestamp tables into 32x32 arrays, indexed
+        # [z,x]. These are copied out of the mapping (and into native byte
+        # order) so they stay valid after close()
+        locations = numpy.frombuffer(self._data, dtype=">u4", count=1024, offset=0).reshape((32,32))
+        timestamps = numpy.frombuffer(self._data, dtype=">u4", count=1024, offset=4096).reshape((32,32))
+        # offset of each chunk in the file, in 4KiB sectors. 0 means the
+        # chunk doesn't exist
+        self.offsets = (locations >> 8).astype(numpy.uint32)
+        # number of sectors allocated to each chunk
+        self.sectors = (locations & 0xff).astype(numpy.uint8)
+        # modification time of each chunk
+        self.timestamps = timestamps.astype(numpy.uint32)
 
     def close(self):
         """Close the region file and free any resources associated
@@ -226,8 +360,12 @@ class MCRFileReader(object):
         results in undefined behaviour.
         """
         
-        self._file.close()
-        self._file = None
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
     def get_chunks(self):    
         """Return an iterator of all chunks contained in this region
@@ -236,8 +374,15 @@ class MCRFileReader(object):
         
         for x in xrange(32): 
             for z in xrange(32): 
-                if self._locations[x + z * 32] >> 8 != 0:
+                if self.offsets[z,x] != 0:
                     yield (x,z)
+
+    def get_chunk_arrays(self):
+        """Return all the chunks contained in this region file at once, as a
+        tuple of three numpy arrays (x, z, timestamp), one entry per chunk.
+        The coordinates are in the range [0, 31]."""
+        z, x = numpy.nonzero(self.offsets)
+        return x, z, self.timestamps[z,x]
         
     def get_chunk_timestamp(self, x, z):
         """Return the given chunk's modification time. If the given
@@ -246,38 +391,37 @@ class MCRFileReader(object):
         """
         x = x % 32
         z = z % 32        
-        return self._timestamps[x + z * 32]   
+        return int(self.timestamps[z,x])
     
     def chunk_exists(self, x, z):
         """Determines if a chunk exists."""
         x = x % 32
         z = z % 32
-        return self._locations[x + z * 32] >> 8 != 0
+        return bool(self.offsets[z,x] != 0)
 
-    def load_chunk(self, x, z):
+    def load_chunk(self, x, z, tagpaths=None):
         """Return a (name, data) tuple for the given chunk, or
         None if the given chunk doesn't exist in this region file. If
         you provide an x or z not between 0 and 31, it will be
         modulo'd into this range (x % 32, etc.) This is so you can
         provide chunk coordinates in global coordinates, and still
-        have the chunks load out of regions properly."""
+        have the chunks load out of regions properly.
+
+        tagpaths is passed on to NBTFileReader.read_all(), to only decode
+        the given parts of the chunk."""
         x = x % 32
         z = z % 32
-        location = self._locations[x + z * 32]
-        offset = (location >> 8) * 4096;
-        sectors = location & 0xff;
+        offset = int(self.offsets[z,x]) * 4096
         
         if offset == 0:
             return None
         
-        # seek to the data
-        self._file.seek(offset)
-        
         # read in the chunk data header
-        header = self._file.read(5)
-        if len(header) != 5:
-            raise CorruptChunkError("chunk header is invalid")
-        data_length, compression =  self._chunk_header_format.unpack(header)
+        if offset + 5 > len(self._data):
+            # this can also happen if the region file grew since it was
+            # opened; CorruptRegionError makes the caller re-open it
+            raise CorruptRegionError("chunk header is invalid")
+        data_length, compression = self._chunk_header_format.unpack_from(self._data, offset)
         
         # figure out the compression
         is_gzip = True
@@ -291,15 +435,14 @@ class MCRFileReader(object):
             # unsupported!
             raise CorruptRegionError("unsupported chunk compression type: %i (should be 1 or 2)" % (compression,))
         
-        # turn the rest of the data into a StringIO object
+        # the rest of the data, as a view into the file without copying
         # (using data_length - 1, as we already read 1 byte for compression)
-        data = self._file.read(data_length - 1)
-        if len(data) != data_length - 1:
+        if data_length < 1 or offset + 4 + data_length > len(self._data):
             raise CorruptRegionError("chunk length is invalid")
-        data = StringIO.StringIO(data)
+        data = buffer(self._data, offset + 5, data_length - 1)
         
         try:
-            return NBTFileReader(data, is_gzip=is_gzip).read_all()
+            return NBTFileReader(data, is_gzip=is_gzip).read_all(tagpaths)
         except CorruptionError:
             raise
         except Exception, e:
@@ -84,6 +84,37 @@ class Observer(object):
     def _set_max_value(self, max_value):
         self._max_value = max_value
 
+    def report_cache_stats(self, cache_stats):
+        """Called at the end of a run with the chunk cache statistics of each
+        worker process: a list with a list of (cache name, stats) tuples for
+        each worker, where stats is a dictionary of hits, misses and possibly
+        evictions and resident_bytes. By default, the totals over all workers
+        are logged.
+        """
+        totals = []
+        names = {}
+        for worker, stats in enumerate(cache_stats):
+            for name, counts in stats:
+                logging.debug("Worker %d: %s: %s", worker, name,
+                    ", ".join("%s %s" % item for item in sorted(counts.items())))
+                if name not in names:
+                    names[name] = len(totals)
+                    totals.append((name, {}))
+                total = totals[names[name]][1]
+                for key, value in counts.iteritems():
+                    total[key] = total.get(key, 0) + value
+
+        for name, total in totals:
+            hits = total.get("hits", 0)
+            lookups = hits + total.get("misses", 0)
+            msg = "%s: %d hits, %d misses (%.1f%% hit rate)" % (name, hits,
+                lookups - hits, hits * 100.0 / lookups if lookups else 0.0)
+            if "evictions" in total:
+                msg += ", %d evictions" % total["evictions"]
+            if "resident_bytes" in total:
+                msg += ", %.1f MB resident" % (total["resident_bytes"] / 1048576.0)
+            logging.info("Chunk cache stats: %s", msg)
+
 class LoggingObserver(Observer):
     """Simple observer that just outputs status through logging.
     """
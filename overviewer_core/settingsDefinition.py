@@ -86,6 +86,7 @@ renders = Setting(required=True, default=util.OrderedDict(),
             "poititle": Setting(required=False, validator=validateStr, default="Signs"),
             "customwebassets": Setting(required=False, validator=validateWebAssetsPath, default=None),
             "maxzoom": Setting(required=False, validator=validateInt, default=None),
+            "batchlevels": Setting(required=False, validator=validateInt, default=2),
             "manualpois": Setting(required=False, validator=validateManualPOIs, default=[]),
             # Remove this eventually (once people update their configs)
             "worldname": Setting(required=False, default=None,
@@ -100,10 +101,25 @@ outputdir = Setting(required=True, validator=validateOutputDir, default=None)
 
 processes = Setting(required=True, validator=int, default=-1)
 
+# How many jobs are sent to a worker process at a time
+job_batch_size = Setting(required=False, validator=validateInt, default=None)
+
 # memcached is an option, but unless your IO costs are really high, it just
 # ends up adding overhead and isn't worth it.
 memcached_host = Setting(required=False, validator=str, default=None)
 
+# The size in megabytes of the chunk cache in each process
+memory_cache_size = Setting(required=False, validator=validateInt, default=None)
+
+# The size in megabytes of the chunk cache shared by the worker processes, 0 to
+# disable it
+shared_cache_size = Setting(required=False, validator=validateInt, default=None)
+
+# A directory to keep decoded chunks in between runs, and its size limit in
+# megabytes
+chunk_cache_dir = Setting(required=False, validator=validateCacheDir, default=None)
+chunk_cache_size = Setting(required=False, validator=validateInt, default=None)
+
 # TODO clean up this ugly in sys.argv hack
 if platform.system() == 'Windows' or not sys.stdout.isatty() or "--simple" in sys.argv:
     obs = LoggingObserver()
@@ -204,6 +204,12 @@ def validateOutputDir(d):
         raise ValidationException("You must specify a valid output directory")
     return expand_path(d)
 
+def validateCacheDir(d):
+    _, d = checkBadEscape(d)
+    if not d.strip():
+        raise ValidationException("You must specify a valid cache directory")
+    return expand_path(d)
+
 def validateCrop(value):
     if len(value) != 4:
         raise ValidationException("The value for the 'crop' setting must be a tuple of length 4")
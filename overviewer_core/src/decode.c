@@ -0,0 +1,81 @@
+/* 
+ * This file is part of the Minecraft Overviewer.
+ *
+ * Minecraft Overviewer is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License as published
+ * by the Free Software Foundation, either version 3 of the License, or (at
+ * your option) any later version.
+ *
+ * Minecraft Overviewer is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License along
+ * with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include "overviewer.h"
+
+/* sizes of the byte arrays in an Anvil chunk section */
+#define SECTION_BLOCKS 4096
+#define SECTION_NIBBLES (SECTION_BLOCKS / 2)
+
+/* decodes the byte arrays of an Anvil chunk section into the given arrays in
+ * one pass: Blocks, with the extra bits from Add if it's there, into an array
+ * of unsigned shorts, and the packed nibbles of Data, SkyLight and
+ * BlockLight into one byte per block. The output arrays must be contiguous
+ * and hold 4096 items; they keep the section's Y,Z,X order. */
+PyObject *decode_section(PyObject *self, PyObject *args) {
+    const unsigned char *blocks, *add, *data, *skylight, *blocklight;
+    int blocks_len, add_len, data_len, skylight_len, blocklight_len;
+    unsigned short *blocks_out;
+    unsigned char *data_out, *skylight_out, *blocklight_out;
+    int blocks_out_len, data_out_len, skylight_out_len, blocklight_out_len;
+    int i;
+    
+    if (!PyArg_ParseTuple(args, "s#z#s#s#s#w#w#w#w#",
+                          &blocks, &blocks_len, &add, &add_len,
+                          &data, &data_len, &skylight, &skylight_len,
+                          &blocklight, &blocklight_len,
+                          &blocks_out, &blocks_out_len, &data_out, &data_out_len,
+                          &skylight_out, &skylight_out_len,
+                          &blocklight_out, &blocklight_out_len))
+        return NULL;
+    
+    if (blocks_len != SECTION_BLOCKS || (add && add_len != SECTION_NIBBLES) ||
+        data_len != SECTION_NIBBLES || skylight_len != SECTION_NIBBLES ||
+        blocklight_len != SECTION_NIBBLES) {
+        PyErr_SetString(PyExc_ValueError, "section arrays have the wrong size");
+        return NULL;
+    }
+    if (blocks_out_len != SECTION_BLOCKS * sizeof(unsigned short) ||
+        data_out_len != SECTION_BLOCKS || skylight_out_len != SECTION_BLOCKS ||
+        blocklight_out_len != SECTION_BLOCKS) {
+        PyErr_SetString(PyExc_ValueError, "output arrays have the wrong size");
+        return NULL;
+    }
+    
+    /* the even block of each pair is in the low nibble */
+    for (i = 0; i < SECTION_NIBBLES; i++) {
+        data_out[2*i] = data[i] & 0x0F;
+        data_out[2*i + 1] = data[i] >> 4;
+        skylight_out[2*i] = skylight[i] & 0x0F;
+        skylight_out[2*i + 1] = skylight[i] >> 4;
+        blocklight_out[2*i] = blocklight[i] & 0x0F;
+        blocklight_out[2*i + 1] = blocklight[i] >> 4;
+    }
+    
+    if (add) {
+        for (i = 0; i < SECTION_NIBBLES; i++) {
+            blocks_out[2*i] = blocks[2*i] | ((add[i] & 0x0F) << 8);
+            blocks_out[2*i + 1] = blocks[2*i + 1] | ((add[i] & 0xF0) << 4);
+        }
+    } else {
+        for (i = 0; i < SECTION_BLOCKS; i++) {
+            blocks_out[i] = blocks[i];
+        }
+    }
+    
+    Py_RETURN_NONE;
+}
@@ -18,6 +18,7 @@
 #include "overviewer.h"
 
 static PyObject *textures = NULL;
+static PyObject *corruption_error = NULL;
 
 unsigned int max_blockid = 0;
 unsigned int max_data = 0;
@@ -46,6 +47,15 @@ PyObject *init_chunk_render(void) {
     if ((!textures)) {
         return NULL;
     }
+
+    /* chunks that fail to load with this are skipped when rendering */
+    tmp = PyImport_ImportModule("overviewer_core.nbt");
+    if (!tmp)
+        return NULL;
+    corruption_error = PyObject_GetAttrString(tmp, "CorruptionError");
+    Py_DECREF(tmp);
+    if (!corruption_error)
+        return NULL;
     
     tmp = PyObject_GetAttrString(textures, "max_blockid");
     if (!tmp)
@@ -102,7 +112,7 @@ PyObject *init_chunk_render(void) {
     Py_RETURN_NONE;
 }
 
-/* helper for load_chunk, loads a section into a chunk */
+/* helper for load_grid_chunk, loads a section into a chunk */
 static inline void load_chunk_section(ChunkData *dest, int i, PyObject *section) {
     dest->sections[i].blocks = PyDict_GetItemString(section, "Blocks");
     dest->sections[i].data = PyDict_GetItemString(section, "Data");
@@ -114,21 +124,25 @@ static inline void load_chunk_section(ChunkData *dest, int i, PyObject *section)
     Py_INCREF(dest->sections[i].blocklight);
 }
 
-/* loads the given chunk into the chunks[] array in the state
+/* returns the given chunk column in the grid (absolute chunk coords) */
+static inline ChunkData *grid_chunk(ChunkGrid *grid, int x, int z) {
+    return &(grid->chunks[(x - grid->x) * grid->zsize + (z - grid->z)]);
+}
+
+/* loads the chunk at the given absolute coords into dest, which owns the
+ * references afterwards. dest is marked loaded even if this fails, so a
+ * missing chunk is only asked for once.
  * returns true on error
  *
  * if required is true, failure to load the chunk will raise a python
  * exception and return true.
  */
-int load_chunk(RenderState* state, int x, int z, unsigned char required) {
-    ChunkData *dest = &(state->chunks[1 + x][1 + z]);
+static int load_grid_chunk(PyObject *regionset, ChunkData *dest, int x, int z, unsigned char required) {
     int i;
+    PyObject *result = NULL;
     PyObject *chunk = NULL;
     PyObject *sections = NULL;
     
-    if (dest->loaded)
-        return 0;
-    
     /* set up reasonable defaults */
     dest->biomes = NULL;
     for (i = 0; i < SECTIONS_PER_CHUNK; i++)
@@ -138,13 +152,12 @@ int load_chunk(RenderState* state, int x, int z, unsigned char required) {
         dest->sections[i].skylight = NULL;
         dest->sections[i].blocklight = NULL;
     }
+    dest->rotation = 0;
     dest->loaded = 1;
     
-    x += state->chunkx;
-    z += state->chunkz;
-
-    chunk = PyObject_CallMethod(state->regionset, "get_chunk", "ii", x, z);
-    if (chunk == NULL) {
+    /* the chunk comes with its arrays unrotated, and how far to turn them */
+    result = PyObject_CallMethod(regionset, "get_unrotated_chunk", "ii", x, z);
+    if (result == NULL) {
         // An exception is already set. RegionSet.get_chunk sets
         // ChunkDoesntExist
         if (!required) {
@@ -152,6 +165,14 @@ int load_chunk(RenderState* state, int x, int z, unsigned char required) {
         }
         return 1;
     }
+    if (!PyArg_ParseTuple(result, "Oi;get_unrotated_chunk must return (chunk, rotation)", &chunk, &(dest->rotation))) {
+        Py_DECREF(result);
+        if (!required) {
+            PyErr_Clear();
+        }
+        return 1;
+    }
+    dest->rotation &= 3;
 
     sections = PyDict_GetItemString(chunk, "Sections");
     if (sections) {
@@ -159,7 +180,7 @@ int load_chunk(RenderState* state, int x, int z, unsigned char required) {
     }
     if (sections == NULL) {
         // exception set, again
-        Py_DECREF(chunk);
+        Py_DECREF(result);
         if (!required) {
             PyErr_Clear();
         }
@@ -182,29 +203,42 @@ int load_chunk(RenderState* state, int x, int z, unsigned char required) {
             load_chunk_section(dest, sectiony, section);
     }
     Py_DECREF(sections);
-    Py_DECREF(chunk);
+    Py_DECREF(result);
     
     return 0;
 }
 
-/* helper to unload all loaded chunks */
+/* loads the given chunk in the state's neighborhood (x,z relative), if it
+ * isn't already. The chunks live in the tile's grid, so each is read from the
+ * regionset at most once per tile.
+ * returns true on error
+ */
+int load_chunk(RenderState* state, int x, int z, unsigned char required) {
+    ChunkData *dest = state->chunks[1 + x][1 + z];
+    
+    if (dest->loaded)
+        return 0;
+    
+    return load_grid_chunk(state->regionset, dest, state->chunkx + x, state->chunkz + z, required);
+}
+
+/* helper to unload all chunks in a grid, and free it */
 static void
-unload_all_chunks(RenderState *state) {
-    unsigned int i, j, k;
-    for (i = 0; i < 3; i++) {
-        for (j = 0; j < 3; j++) {
-            if (state->chunks[i][j].loaded) {
-                Py_XDECREF(state->chunks[i][j].biomes);
-                for (k = 0; k < SECTIONS_PER_CHUNK; k++) {
-                    Py_XDECREF(state->chunks[i][j].sections[k].blocks);
-                    Py_XDECREF(state->chunks[i][j].sections[k].data);
-                    Py_XDECREF(state->chunks[i][j].sections[k].skylight);
-                    Py_XDECREF(state->chunks[i][j].sections[k].blocklight);
-                }
-                state->chunks[i][j].loaded = 0;
+free_chunk_grid(ChunkGrid *grid) {
+    int i, k;
+    for (i = 0; i < grid->xsize * grid->zsize; i++) {
+        ChunkData *chunk = &(grid->chunks[i]);
+        if (chunk->loaded) {
+            Py_XDECREF(chunk->biomes);
+            for (k = 0; k < SECTIONS_PER_CHUNK; k++) {
+                Py_XDECREF(chunk->sections[k].blocks);
+                Py_XDECREF(chunk->sections[k].data);
+                Py_XDECREF(chunk->sections[k].skylight);
+                Py_XDECREF(chunk->sections[k].blocklight);
             }
         }
     }
+    free(grid->chunks);
 }
 
 unsigned char
@@ -410,162 +444,91 @@ generate_pseudo_data(RenderState *state, unsigned char ancilData) {
 }
 
 
-/* TODO triple check this to make sure reference counting is correct */
-PyObject*
-chunk_render(PyObject *self, PyObject *args) {
-    RenderState state;
-    PyObject *modeobj;
-    PyObject *blockmap;
-
-    int xoff, yoff;
-    
-    PyObject *imgsize, *imgsize0_py, *imgsize1_py;
-    int imgsize0, imgsize1;
-    
+/* renders the section in state->chunks[1][1] at state->chunky, with its
+ * origin at xoff, yoff in the image */
+static void
+render_section(RenderState *state, PyObject *blockmap, int xoff, int yoff, int imgsize0, int imgsize1) {
+    RenderMode *rendermode = state->rendermode;
     PyObject *blocks_py;
-    PyObject *left_blocks_py;
-    PyObject *right_blocks_py;
-    PyObject *up_left_blocks_py;
-    PyObject *up_right_blocks_py;
-
-    RenderMode *rendermode;
-    
-    int i, j;
-
     PyObject *t = NULL;
     
-    if (!PyArg_ParseTuple(args, "OOiiiOiiOO",  &state.world, &state.regionset, &state.chunkx, &state.chunky, &state.chunkz, &state.img, &xoff, &yoff, &modeobj, &state.textures))
-        return NULL;
-    
-    /* set up the render mode */
-    state.rendermode = rendermode = render_mode_create(modeobj, &state);
-    if (rendermode == NULL) {
-        return NULL; // note that render_mode_create will
-                     // set PyErr.  No need to set it here
-    }
-
-    /* get the blockmap from the textures object */
-    blockmap = PyObject_GetAttrString(state.textures, "blockmap");
-    if (blockmap == NULL) {
-        render_mode_destroy(rendermode);
-        return NULL;
-    }
-    if (blockmap == Py_None) {
-        render_mode_destroy(rendermode);
-        PyErr_SetString(PyExc_RuntimeError, "you must call Textures.generate()");
-        return NULL;
-    }
-    
-    /* get the image size */
-    imgsize = PyObject_GetAttrString(state.img, "size");
-
-    imgsize0_py = PySequence_GetItem(imgsize, 0);
-    imgsize1_py = PySequence_GetItem(imgsize, 1);
-    Py_DECREF(imgsize);
-
-    imgsize0 = PyInt_AsLong(imgsize0_py);
-    imgsize1 = PyInt_AsLong(imgsize1_py);
-    Py_DECREF(imgsize0_py);
-    Py_DECREF(imgsize1_py);
-    
-    /* set all block data to unloaded */
-    for (i = 0; i < 3; i++) {
-        for (j = 0; j < 3; j++) {
-            state.chunks[i][j].loaded = 0;
-        }
-    }
-    
-    /* get the block data for the center column, erroring out if needed */
-    if (load_chunk(&state, 0, 0, 1)) {
-        render_mode_destroy(rendermode);
-        Py_DECREF(blockmap);
-        return NULL;
-    }
-    if (state.chunks[1][1].sections[state.chunky].blocks == NULL) {
-        /* this section doesn't exist, let's skeddadle */
-        render_mode_destroy(rendermode);
-        Py_DECREF(blockmap);
-        unload_all_chunks(&state);
-        Py_RETURN_NONE;
-    }
-    
-    /* set blocks_py, state.blocks, and state.blockdatas as convenience */
-    blocks_py = state.blocks = state.chunks[1][1].sections[state.chunky].blocks;
-    state.blockdatas = state.chunks[1][1].sections[state.chunky].data;
+    /* set blocks_py, state->blocks, and state->blockdatas as convenience */
+    blocks_py = state->blocks = state->chunks[1][1]->sections[state->chunky].blocks;
+    state->blockdatas = state->chunks[1][1]->sections[state->chunky].data;
 
     /* set up the random number generator again for each chunk
        so tallgrass is in the same place, no matter what mode is used */
     srand(1);
     
-    for (state.x = 15; state.x > -1; state.x--) {
-        for (state.z = 0; state.z < 16; state.z++) {
+    for (state->x = 15; state->x > -1; state->x--) {
+        for (state->z = 0; state->z < 16; state->z++) {
 
             /* set up the render coordinates */
-            state.imgx = xoff + state.x*12 + state.z*12;
+            state->imgx = xoff + state->x*12 + state->z*12;
             /* 16*12 -- offset for y direction, 15*6 -- offset for x */
-            state.imgy = yoff - state.x*6 + state.z*6 + 16*12 + 15*6;
+            state->imgy = yoff - state->x*6 + state->z*6 + 16*12 + 15*6;
             
-            for (state.y = 0; state.y < 16; state.y++) {
+            for (state->y = 0; state->y < 16; state->y++) {
                 unsigned char ancilData;
                 
-                state.imgy -= 12;
+                state->imgy -= 12;
 		
                 /* get blockid */
-                state.block = getArrayShort3D(blocks_py, state.x, state.y, state.z);
-                if (state.block == 0 || render_mode_hidden(rendermode, state.x, state.y, state.z)) {
+                state->block = getSectionShort3D(state, blocks_py, state->x, state->y, state->z);
+                if (state->block == 0 || render_mode_hidden(rendermode, state->x, state->y, state->z)) {
                     continue;
                 }
                 
                 /* make sure we're rendering inside the image boundaries */
-                if ((state.imgx >= imgsize0 + 24) || (state.imgx <= -24)) {
+                if ((state->imgx >= imgsize0 + 24) || (state->imgx <= -24)) {
                     continue;
                 }
-                if ((state.imgy >= imgsize1 + 24) || (state.imgy <= -24)) {
+                if ((state->imgy >= imgsize1 + 24) || (state->imgy <= -24)) {
                     continue;
                 }
                 
                 /* check for occlusion */
-                if (render_mode_occluded(rendermode, state.x, state.y, state.z)) {
+                if (render_mode_occluded(rendermode, state->x, state->y, state->z)) {
                     continue;
                 }
                 
                 /* everything stored here will be a borrowed ref */
                 
-                if (block_has_property(state.block, NODATA)) {
+                if (block_has_property(state->block, NODATA)) {
                     /* block shouldn't have data associated with it, set it to 0 */
                     ancilData = 0;
-                    state.block_data = 0;
-                    state.block_pdata = 0;
+                    state->block_data = 0;
+                    state->block_pdata = 0;
                 } else {
                     /* block has associated data, use it */
-                    ancilData = getArrayByte3D(state.blockdatas, state.x, state.y, state.z);
-                    state.block_data = ancilData;
+                    ancilData = getSectionByte3D(state, state->blockdatas, state->x, state->y, state->z);
+                    state->block_data = ancilData;
                     /* block that need pseudo ancildata:
                      * grass, water, glass, chest, restone wire,
                      * ice, fence, portal, iron bars, glass panes */
-                    if ((state.block ==  2) || (state.block ==  9) ||
-                        (state.block == 20) || (state.block == 54) ||
-                        (state.block == 55) || (state.block == 64) ||
-                        (state.block == 71) || (state.block == 79) ||
-                        (state.block == 85) || (state.block == 90) ||
-                        (state.block == 101) || (state.block == 102) ||
-                        (state.block == 113) || (state.block == 139)) {
-                        ancilData = generate_pseudo_data(&state, ancilData);
-                        state.block_pdata = ancilData;
+                    if ((state->block ==  2) || (state->block ==  9) ||
+                        (state->block == 20) || (state->block == 54) ||
+                        (state->block == 55) || (state->block == 64) ||
+                        (state->block == 71) || (state->block == 79) ||
+                        (state->block == 85) || (state->block == 90) ||
+                        (state->block == 101) || (state->block == 102) ||
+                        (state->block == 113) || (state->block == 139)) {
+                        ancilData = generate_pseudo_data(state, ancilData);
+                        state->block_pdata = ancilData;
                     } else {
-                        state.block_pdata = 0;
+                        state->block_pdata = 0;
                     }
                 }
                 
                 /* make sure our block info is in-bounds */
-                if (state.block >= max_blockid || ancilData >= max_data)
+                if (state->block >= max_blockid || ancilData >= max_data)
                     continue;
                 
                 /* get the texture */
-                t = PyList_GET_ITEM(blockmap, max_data * state.block + ancilData);
+                t = PyList_GET_ITEM(blockmap, max_data * state->block + ancilData);
                 /* if we don't get a texture, try it again with 0 data */
                 if ((t == NULL || t == Py_None) && ancilData != 0)
-                    t = PyList_GET_ITEM(blockmap, max_data * state.block);
+                    t = PyList_GET_ITEM(blockmap, max_data * state->block);
                 
                 /* if we found a proper texture, render it! */
                 if (t != NULL && t != Py_None)
@@ -579,31 +542,213 @@ chunk_render(PyObject *self, PyObject *args) {
                     if (mask == Py_None)
                         mask = src;
 
-                    if (state.block == 31) {
+                    if (state->block == 31) {
                         /* add a random offset to the postion of the tall grass to make it more wild */
                         randx = rand() % 6 + 1 - 3;
                         randy = rand() % 6 + 1 - 3;
-                        state.imgx += randx;
-                        state.imgy += randy;
+                        state->imgx += randx;
+                        state->imgy += randy;
                     }
                     
                     render_mode_draw(rendermode, src, mask, mask_light);
                     
-                    if (state.block == 31) {
+                    if (state->block == 31) {
                         /* undo the random offsets */
-                        state.imgx -= randx;
-                        state.imgy -= randy;
+                        state->imgx -= randx;
+                        state->imgy -= randy;
                     }
                 }               
             }
         }
     }
+}
 
+/* renders a sequence of (chunkx, chunky, chunkz, xoff, yoff) chunk sections
+ * onto state->img in the given order. The render mode, blockmap and image
+ * size are set up once, and chunks are shared between sections through a
+ * grid covering all of them and their neighbors.
+ *
+ * Sections in chunks that turn out to be corrupt are skipped (world.py has
+ * already warned about those); any other error in loading a section's own
+ * chunk is raised. */
+static PyObject*
+render_sections(RenderState *state, PyObject *sections, PyObject *modeobj) {
+    PyObject *blockmap;
+    PyObject *imgsize, *imgsize0_py, *imgsize1_py;
+    int imgsize0, imgsize1;
+    RenderMode *rendermode;
+    ChunkGrid grid;
+    int *coords;
+    Py_ssize_t count, n;
+    int i, j;
+    int minx, maxx, minz, maxz;
+    PyObject *ret = NULL;
+    
+    sections = PySequence_Fast(sections, "sections must be a sequence");
+    if (sections == NULL)
+        return NULL;
+    count = PySequence_Fast_GET_SIZE(sections);
+    if (count == 0) {
+        Py_DECREF(sections);
+        Py_RETURN_NONE;
+    }
+    
+    /* unpack the section list, and find the chunks it covers */
+    coords = malloc(count * 5 * sizeof(int));
+    if (coords == NULL) {
+        Py_DECREF(sections);
+        return PyErr_NoMemory();
+    }
+    minx = minz = INT_MAX;
+    maxx = maxz = INT_MIN;
+    for (n = 0; n < count; n++) {
+        int *c = &(coords[n * 5]);
+        if (!PyArg_ParseTuple(PySequence_Fast_GET_ITEM(sections, n), "iiiii;sections must be (chunkx, chunky, chunkz, xoff, yoff) tuples",
+                              &c[0], &c[1], &c[2], &c[3], &c[4])) {
+            free(coords);
+            Py_DECREF(sections);
+            return NULL;
+        }
+        if (c[1] < 0 || c[1] >= SECTIONS_PER_CHUNK) {
+            free(coords);
+            Py_DECREF(sections);
+            PyErr_SetString(PyExc_ValueError, "section y coordinate out of range");
+            return NULL;
+        }
+        minx = MIN(minx, c[0]);
+        maxx = MAX(maxx, c[0]);
+        minz = MIN(minz, c[2]);
+        maxz = MAX(maxz, c[2]);
+    }
+    Py_DECREF(sections);
+    
+    /* leave room for the neighbors of the outermost chunks */
+    grid.x = minx - 1;
+    grid.z = minz - 1;
+    grid.xsize = maxx - minx + 3;
+    grid.zsize = maxz - minz + 3;
+    grid.chunks = calloc(grid.xsize * grid.zsize, sizeof(ChunkData));
+    if (grid.chunks == NULL) {
+        free(coords);
+        return PyErr_NoMemory();
+    }
+    state->grid = &grid;
+    
+    /* set up the render mode */
+    state->rendermode = rendermode = render_mode_create(modeobj, state);
+    if (rendermode == NULL) {
+        // note that render_mode_create will
+        // set PyErr.  No need to set it here
+        free(grid.chunks);
+        free(coords);
+        return NULL;
+    }
+
+    /* get the blockmap from the textures object */
+    blockmap = PyObject_GetAttrString(state->textures, "blockmap");
+    if (blockmap == NULL)
+        goto done;
+    if (blockmap == Py_None) {
+        PyErr_SetString(PyExc_RuntimeError, "you must call Textures.generate()");
+        goto done;
+    }
+    
+    /* get the image size */
+    imgsize = PyObject_GetAttrString(state->img, "size");
+    if (imgsize == NULL)
+        goto done;
+
+    imgsize0_py = PySequence_GetItem(imgsize, 0);
+    imgsize1_py = PySequence_GetItem(imgsize, 1);
+    Py_DECREF(imgsize);
+
+    imgsize0 = PyInt_AsLong(imgsize0_py);
+    imgsize1 = PyInt_AsLong(imgsize1_py);
+    Py_DECREF(imgsize0_py);
+    Py_DECREF(imgsize1_py);
+    
+    for (n = 0; n < count; n++) {
+        int *c = &(coords[n * 5]);
+        ChunkData *center;
+        
+        state->chunkx = c[0];
+        state->chunky = c[1];
+        state->chunkz = c[2];
+        
+        /* get the block data for the center column, erroring out if needed */
+        center = grid_chunk(&grid, state->chunkx, state->chunkz);
+        if (!(center->loaded)) {
+            if (load_grid_chunk(state->regionset, center, state->chunkx, state->chunkz, 1)) {
+                if (corruption_error && PyErr_ExceptionMatches(corruption_error)) {
+                    PyErr_Clear();
+                    continue;
+                }
+                goto done;
+            }
+        }
+        if (center->sections[state->chunky].blocks == NULL) {
+            /* this section doesn't exist, let's skeddadle */
+            continue;
+        }
+        
+        /* point the neighborhood into the grid, loading what the tile
+           hasn't needed yet */
+        for (i = 0; i < 3; i++) {
+            for (j = 0; j < 3; j++) {
+                state->chunks[i][j] = grid_chunk(&grid, state->chunkx + i - 1, state->chunkz + j - 1);
+                load_chunk(state, i - 1, j - 1, 0);
+            }
+        }
+        
+        render_section(state, blockmap, c[3], c[4], imgsize0, imgsize1);
+    }
+    
+    Py_INCREF(Py_None);
+    ret = Py_None;
+    
+done:
     /* free up the rendermode info */
     render_mode_destroy(rendermode);
     
-    Py_DECREF(blockmap);
-    unload_all_chunks(&state);
+    Py_XDECREF(blockmap);
+    free_chunk_grid(&grid);
+    state->grid = NULL;
+    free(coords);
+    
+    return ret;
+}
+
+/* renders a single chunk section */
+PyObject*
+chunk_render(PyObject *self, PyObject *args) {
+    RenderState state;
+    PyObject *modeobj;
+    PyObject *sections;
+    PyObject *ret;
+    int chunkx, chunky, chunkz;
+    int xoff, yoff;
+    
+    if (!PyArg_ParseTuple(args, "OOiiiOiiOO",  &state.world, &state.regionset, &chunkx, &chunky, &chunkz, &state.img, &xoff, &yoff, &modeobj, &state.textures))
+        return NULL;
+    
+    sections = Py_BuildValue("((iiiii))", chunkx, chunky, chunkz, xoff, yoff);
+    if (sections == NULL)
+        return NULL;
+    ret = render_sections(&state, sections, modeobj);
+    Py_DECREF(sections);
+    return ret;
+}
 
-    Py_RETURN_NONE;
+/* renders a whole tile, given its chunk sections in back-to-front order as
+ * (chunkx, chunky, chunkz, xoff, yoff) tuples */
+PyObject*
+tile_render(PyObject *self, PyObject *args) {
+    RenderState state;
+    PyObject *modeobj;
+    PyObject *sections;
+    
+    if (!PyArg_ParseTuple(args, "OOOOOO",  &state.world, &state.regionset, &sections, &state.img, &modeobj, &state.textures))
+        return NULL;
+    
+    return render_sections(&state, sections, modeobj);
 }
@@ -32,6 +32,12 @@ static PyMethodDef COverviewerMethods[] = {
     {"render_loop", chunk_render, METH_VARARGS,
      "Renders stuffs"},
     
+    {"render_tile", tile_render, METH_VARARGS,
+     "Renders a list of chunk sections onto a tile"},
+    
+    {"decode_section", decode_section, METH_VARARGS,
+     "Decodes the arrays of an Anvil chunk section"},
+    
     {"extension_version", get_extension_version, METH_VARARGS, 
         "Returns the extension version"},
     
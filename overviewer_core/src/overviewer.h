@@ -26,7 +26,7 @@
 
 // increment this value if you've made a change to the c extesion
 // and want to force users to rebuild
-#define OVERVIEWER_EXTENSION_VERSION 42
+#define OVERVIEWER_EXTENSION_VERSION 46
 
 /* Python PIL, and numpy headers */
 #include <Python.h>
@@ -80,6 +80,10 @@ typedef struct _RenderMode RenderMode;
 typedef struct {
     /* whether this chunk is loaded: use load_chunk to load */
     int loaded;
+    /* how many times this chunk's arrays need turning by 90 degrees: chunks
+       from a RotatedRegionSet are kept as they're stored, and read through
+       unrotate_block_coords (see RegionSet.get_unrotated_chunk) */
+    int rotation;
     /* chunk biome array */
     PyObject *biomes;
     /* all the sections in a given chunk */
@@ -88,6 +92,12 @@ typedef struct {
         PyObject *blocks, *data, *skylight, *blocklight;
     } sections[SECTIONS_PER_CHUNK];
 } ChunkData;
+/* a grid of chunk columns covering a whole tile, loaded as they're needed */
+typedef struct {
+    /* chunk coords of the first column, and the size of the grid */
+    int x, z, xsize, zsize;
+    ChunkData *chunks;
+} ChunkGrid;
 typedef struct {
     /* the regionset object, and chunk coords */
     PyObject *world;
@@ -114,13 +124,18 @@ typedef struct {
     PyObject *blockdatas;
     PyObject *blocks;
     
-    /* 3x3 array of this and neighboring chunk columns */
-    ChunkData chunks[3][3];    
+    /* 3x3 array of this and neighboring chunk columns, borrowed from the
+       grid and all loaded before the section is rendered */
+    ChunkData *chunks[3][3];
+    
+    /* every chunk column the tile being rendered needs */
+    ChunkGrid *grid;
 } RenderState;
 PyObject *init_chunk_render(void);
 /* returns true on error, x,z relative */
 int load_chunk(RenderState* state, int x, int z, unsigned char required);
 PyObject *chunk_render(PyObject *self, PyObject *args);
+PyObject *tile_render(PyObject *self, PyObject *args);
 typedef enum
 {
     KNOWN,
@@ -148,6 +163,37 @@ block_has_property(unsigned short b, BlockProperty prop) {
 }
 #define is_transparent(b) block_has_property((b), TRANSPARENT)
 
+/* turns block coords within a chunk back by the given number of 90 degree
+   turns, so coords in a rotated render index the chunk's unrotated arrays */
+static inline void unrotate_block_coords(int rotation, int *x, int *z) {
+    int t = *x;
+    switch (rotation) {
+    case 1:
+        *x = *z;
+        *z = 15 - t;
+        break;
+    case 2:
+        *x = 15 - *x;
+        *z = 15 - *z;
+        break;
+    case 3:
+        *x = 15 - *z;
+        *z = t;
+        break;
+    }
+}
+
+/* like getArrayShort3D and getArrayByte3D, for the arrays of the section
+   being rendered (state->blocks and state->blockdatas) */
+static inline unsigned short getSectionShort3D(RenderState *state, PyObject *array, int x, int y, int z) {
+    unrotate_block_coords(state->chunks[1][1]->rotation, &x, &z);
+    return getArrayShort3D(array, x, y, z);
+}
+static inline unsigned char getSectionByte3D(RenderState *state, PyObject *array, int x, int y, int z) {
+    unrotate_block_coords(state->chunks[1][1]->rotation, &x, &z);
+    return getArrayByte3D(array, x, y, z);
+}
+
 /* helper for indexing section data possibly across section boundaries */
 typedef enum
 {
@@ -191,7 +237,7 @@ static inline unsigned int get_data(RenderState *state, DataType type, int x, in
     if (chunky < 0 || chunky >= SECTIONS_PER_CHUNK)
         return def;
     
-    if (!(state->chunks[chunkx][chunkz].loaded))
+    if (!(state->chunks[chunkx][chunkz]->loaded))
     {
         if (load_chunk(state, chunkx - 1, chunkz - 1, 0))
             return def;
@@ -200,24 +246,25 @@ static inline unsigned int get_data(RenderState *state, DataType type, int x, in
     switch (type)
     {
     case BLOCKS:
-        data_array = state->chunks[chunkx][chunkz].sections[chunky].blocks;
+        data_array = state->chunks[chunkx][chunkz]->sections[chunky].blocks;
         break;
     case DATA:
-        data_array = state->chunks[chunkx][chunkz].sections[chunky].data;
+        data_array = state->chunks[chunkx][chunkz]->sections[chunky].data;
         break;
     case BLOCKLIGHT:
-        data_array = state->chunks[chunkx][chunkz].sections[chunky].blocklight;
+        data_array = state->chunks[chunkx][chunkz]->sections[chunky].blocklight;
         break;
     case SKYLIGHT:
-        data_array = state->chunks[chunkx][chunkz].sections[chunky].skylight;
+        data_array = state->chunks[chunkx][chunkz]->sections[chunky].skylight;
         break;
     case BIOMES:
-        data_array = state->chunks[chunkx][chunkz].biomes;
+        data_array = state->chunks[chunkx][chunkz]->biomes;
     };
     
     if (data_array == NULL)
         return def;
     
+    unrotate_block_coords(state->chunks[chunkx][chunkz]->rotation, &x, &z);
     if (type == BLOCKS)
         return getArrayShort3D(data_array, x, y, z);
     if (type == BIOMES)
@@ -228,6 +275,9 @@ static inline unsigned int get_data(RenderState *state, DataType type, int x, in
 /* pull in the rendermode info */
 #include "rendermodes.h"
 
+/* in decode.c */
+PyObject *decode_section(PyObject *self, PyObject *args);
+
 /* in endian.c */
 void init_endian(void);
 unsigned short big_endian_ushort(unsigned short in);
@@ -50,11 +50,11 @@ cave_occluded(void *data, RenderState *state, int x, int y, int z) {
     }
     
     /* special handling for section boundaries */
-    if (x == 0 && (!(state->chunks[0][1].loaded) || state->chunks[0][1].sections[state->chunky].blocks == NULL))
+    if (x == 0 && (!(state->chunks[0][1]->loaded) || state->chunks[0][1]->sections[state->chunky].blocks == NULL))
         return 1;
-    if (y == 15 && (state->chunky + 1 >= SECTIONS_PER_CHUNK || state->chunks[1][1].sections[state->chunky + 1].blocks == NULL))
+    if (y == 15 && (state->chunky + 1 >= SECTIONS_PER_CHUNK || state->chunks[1][1]->sections[state->chunky + 1].blocks == NULL))
         return 1;
-    if (z == 15 && (!(state->chunks[1][2].loaded) || state->chunks[1][2].sections[state->chunky].blocks == NULL))
+    if (z == 15 && (!(state->chunks[1][2]->loaded) || state->chunks[1][2]->sections[state->chunky].blocks == NULL))
         return 1;
     
     return 0;
@@ -79,7 +79,7 @@ cave_hidden(void *data, RenderState *state, int x, int y, int z) {
      * at this point of the code the block has no skylight
      * but a deep sea can be completely dark
      */
-    if ((getArrayShort3D(state->blocks, x, y, z) == 9) ||
+    if ((getSectionShort3D(state, state->blocks, x, y, z) == 9) ||
         (get_data(state, BLOCKS, x, y+1, z) == 9)) {
         
         for (dy = y+1; dy < (SECTIONS_PER_CHUNK - state->chunky) * 16; dy++) {
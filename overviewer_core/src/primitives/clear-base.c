@@ -19,13 +19,13 @@
 
 static int
 clear_base_occluded(void *data, RenderState *state, int x, int y, int z) {
-    if ( (x != 0) && (y != 15) && (z != 127) &&
+    if ( (x != 0) && (y != 15) && (z != 15) &&
          !render_mode_hidden(state->rendermode, x-1, y, z) &&
          !render_mode_hidden(state->rendermode, x, y, z+1) &&
          !render_mode_hidden(state->rendermode, x, y+1, z) &&
-         !is_transparent(getArrayByte3D(state->blocks, x-1, y, z)) &&
-         !is_transparent(getArrayByte3D(state->blocks, x, y, z+1)) &&
-         !is_transparent(getArrayByte3D(state->blocks, x, y+1, z))) {
+         !is_transparent(getSectionByte3D(state, state->blocks, x-1, y, z)) &&
+         !is_transparent(getSectionByte3D(state, state->blocks, x, y, z+1)) &&
+         !is_transparent(getSectionByte3D(state, state->blocks, x, y+1, z))) {
         return 1;
     }
     
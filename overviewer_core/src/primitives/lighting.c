@@ -200,7 +200,7 @@ inline int
 lighting_is_face_occluded(RenderState *state, int skip_sides, int x, int y, int z) {
     /* first, check for occlusion if the block is in the local chunk */
     if (x >= 0 && x < 16 && y >= 0 && y < 16 && z >= 0 && z < 16) {
-        unsigned short block = getArrayShort3D(state->blocks, x, y, z);
+        unsigned short block = getSectionShort3D(state, state->blocks, x, y, z);
         
         if (!is_transparent(block) && !render_mode_hidden(state->rendermode, x, y, z)) {
             /* this face isn't visible, so don't draw anything */
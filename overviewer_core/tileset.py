@@ -19,18 +19,22 @@ import os
 import os.path
 import sys
 import shutil
-import random
 import functools
 import time
 import errno
+import hashlib
 import stat
+import json
 from collections import namedtuple
 from itertools import product, izip
 
+import numpy
 from PIL import Image
 
 from .util import roundrobin
 from . import nbt
+from . import world
+from . import cache
 from .files import FileReplacer
 from .optimizeimages import optimize_image
 import rendermodes
@@ -47,10 +51,34 @@ the user.
 The TileSet class implements the Worker interface. This interface has the
 following methods:
 
+prepare_preprocessing()
+    This method is called in the main process before the worker is sent to
+    other processes or any of its preprocessing work items are done. It should
+    make any decision the preprocessing work items depend on.
+
+get_preprocessing_key()
+    This method returns a hashable key. Workers with the same key have their
+    preprocessing work items done together, in the same job, so they can share
+    the work of reading their input.
+
+iterate_preprocessing_items()
+    This method returns an iterator over preprocessing work items, which must
+    be pickelable and hashable. Items are done before do_preprocessing() is
+    called, in no particular order, and possibly in a different process.
+
+do_preprocessing_work(workobj)
+    Does the work for a given preprocessing work item and returns its
+    (pickelable) result.
+
+add_preprocessing_result(workobj, result)
+    Takes the result of do_preprocessing_work() for the given item. This is
+    called in the main process.
+
 do_preprocessing()
     This method is called before iterate_work_items(). It should do any work
     that needs to be done prior to iterate_work_items(). It is not called for
-    instances that will not have iterate_work_items() called.
+    instances that will not have iterate_work_items() called. If the
+    preprocessing work items were not done, it does them itself.
 
 get_num_phases()
     This method returns an integer indicating how many phases of work this
@@ -64,13 +92,15 @@ get_phase_length(phase)
     be exact, or an estimate. If there is no useful information on the size of
     a phase, return None.
 
-iterate_work_items(phase)
+iterate_work_items(phase, streaming=False)
     Takes a phase number (a non-negative integer). This method should return an
     iterator over work items and a list of dependencies i.e. (work_item, [d1,
     d2, ...]). The work items and dependencies can be any pickelable object;
     they are treated as opaque by the Dispatcher. The work item objects are
     passed back in to the do_work() method (perhaps in a different, identically
-    configured instance).
+    configured instance). A work item that stands for more than one unit of
+    progress (see get_phase_length()) can say how many in a "weight"
+    attribute.
 
     The dependency items are other work items that are compared for equality
     with work items that are already in the queue. The dispatcher guarantees
@@ -80,11 +110,28 @@ iterate_work_items(phase)
     dependencies; the dispatcher requires this ordering or it cannot guarantee
     the dependencies are met.
 
+finish_work_item(phase, workobj)
+    This optional method is called in the main process when a work item has
+    finished, and returns a list of new (work_item, [d1, d2, ...]) tuples to do.
+    Workers that have it get streaming=True passed to iterate_work_items(),
+    which may then leave out items that depend on others and return them from
+    here once those are done, instead of having them wait in the dispatcher.
+
+get_work_item_priority(workobj)
+    This optional method returns a number for a work item whose dependencies
+    are done. Of the items ready to start, the dispatcher starts those with the
+    highest number first, across all workers. The default priority is 0.
+
 do_work(workobj)
     Does the work for a given work object. This method is not expected to
     return anything, so the results of its work should be reflected on the
     filesystem or by sending signals.
 
+get_caches()
+    This optional method returns a list of the cache objects this worker
+    reads through. The dispatcher collects their statistics (see
+    cache.get_stats()) from each worker process at the end of a run.
+
 
 """
 
@@ -97,6 +144,29 @@ def iterate_base4(d):
 # world
 Bounds = namedtuple("Bounds", ("mincol", "maxcol", "minrow", "maxrow"))
 
+class TileBatch(tuple):
+    """A work item for a whole subtree of tiles, so that neighboring
+    render-tiles, which share most of their chunks, are all rendered by the
+    same process. It is equal to the path of the subtree's root, so it
+    satisfies the dependencies of the tile above it. The tiles attribute lists
+    the paths of the tiles in the subtree to render, in order.
+
+    """
+    def __new__(cls, path, tiles):
+        self = super(TileBatch, cls).__new__(cls, path)
+        self.tiles = tiles
+        return self
+
+    def __reduce__(self):
+        return (TileBatch, (tuple(self), self.tiles))
+
+    @property
+    def weight(self):
+        return len(self.tiles)
+
+    def __repr__(self):
+        return "TileBatch(%r, %d tiles)" % (tuple(self), len(self.tiles))
+
 # A note about the implementation of the different rendercheck modes:
 #
 # For reference, here's what the rendercheck modes are:
@@ -158,6 +228,16 @@ Bounds = namedtuple("Bounds", ("mincol", "maxcol", "minrow", "maxrow"))
 # any additional checks.
 
 __all__ = ["TileSet"]
+# Results of looking at the chunks of a regionset, shared by all TileSets in
+# this process with regionsets of the same transform key (see
+# RegionSet.get_transform_key()), e.g. several rendermodes of one world with
+# the same north direction and crop.
+# Maps transform keys to the Bounds of their chunks
+_chunk_range_cache = {}
+# Maps (transform key, treedepth, regionx, regionz) to the paths and mtimes of
+# the tiles touched by that region's chunks, see TileSet._scan_region()
+_region_tiles_cache = cache.LRUCache(size=64)
+
 class TileSet(object):
     """The TileSet object manages the work required to produce a set of tiles
     on disk. It calculates the work that needs to be done and tells the
@@ -264,6 +344,25 @@ class TileSet(object):
             changelist output: each tile written will get outputted to the
             specified fd.
 
+        batchlevels
+            Optional: the number of zoom levels of tiles that are given out as
+            one work item. With 2, each job renders a subtree of up to 4x4
+            render-tiles and the composite-tiles above them, so that the
+            chunks they share are decoded once, in the same process. 0 gives
+            out every tile on its own. The default is 2.
+
+        texturepath, northdirection
+            Optional: the options the Textures object and the RegionSet were
+            made with. They are only used to tell whether an interrupted
+            render can be continued.
+
+        In rendercheck modes 0 and 2, the tiles are listed in a journal file
+        in the output directory as they finish. If the render is interrupted,
+        the next one in the same mode and with the same options that change
+        what the tiles look like skips the tiles in the journal, unless their
+        chunks have changed since. The journal is removed by close_journal()
+        once the render is complete.
+
         Other options that must be specified but aren't really documented
         (oops. consider it a TODO):
         * worldname_orig
@@ -284,6 +383,14 @@ class TileSet(object):
 
         self.last_rendertime = config.get('last_rendertime', 0)
 
+        # The journal of an interrupted render. Worker processes don't need
+        # it; they get what they need pickled.
+        self.journalpath = os.path.join(self.outputdir, "render.journal")
+        self._journal = None
+        journal_header = None
+        if config.get("render_in_progress", False) and not hasattr(self, "_resume_since"):
+            journal_header = self._read_journal_header()
+
         if "renderchecks" not in self.options:
             # renderchecks was not given, this indicates it was not specified
             # in either the config file or the command line. The following code
@@ -316,6 +423,12 @@ class TileSet(object):
                         "normally happen. I guess we have no choice but to do a "
                         "--forcerender", self.options['name'])
                 self.options['renderchecks'] = 2
+            elif journal_header is not None and journal_header["renderchecks"] in (0,2):
+                # The last render was interrupted, but it kept a journal of
+                # the tiles it finished. Pick up where it left off.
+                logging.info("The last render for '%s' didn't finish. I'll "
+                        "continue it from its journal.", self.options['name'])
+                self.options['renderchecks'] = journal_header["renderchecks"]
             elif config.get("render_in_progress", False):
                 # The last render must have been interrupted. The default should be
                 # a check-tiles render then
@@ -355,15 +468,47 @@ class TileSet(object):
         else:
             raise ValueError("imgformat must be one of: 'png' or 'jpg'")
 
-        # This sets self.treedepth, self.xradius, and self.yradius
-        self._set_map_size()
+        # This sets self.treedepth, self.xradius, and self.yradius, unless they
+        # were already restored by __setstate__
+        if not hasattr(self, "treedepth"):
+            self._set_map_size()
+
+        # The tree of tiles to render. This is filled in by the chunk scan
+        # during preprocessing
+        self.dirtytree = None
+        # See finish_work_item()
+        self._unfinished_children = None
+        # See prepare_preprocessing()
+        self._prepared = False
+
+        # When resuming from a journal, the time the interrupted render
+        # started. The tiles it finished are loaded during preprocessing,
+        # and skipped unless they are among the render-tiles whose chunks
+        # changed after that time.
+        if not hasattr(self, "_resume_since"):
+            self._resume_since = None
+            # Without an explicit renderchecks mode, the mode was set to the
+            # journal's above
+            if (journal_header is not None and self.options['renderchecks'] in (0,2) and
+                    journal_header["renderchecks"] == self.options['renderchecks'] and
+                    journal_header["treedepth"] == self.treedepth and
+                    journal_header["imgextension"] == self.imgextension and
+                    journal_header["options"] == self._get_options_key()):
+                self._resume_since = journal_header["started"]
+        self._resumed_tiles = None
+        self._stale_tiles = None
 
     # Only pickle the initial state. Don't pickle anything resulting from the
-    # do_preprocessing step
+    # do_preprocessing step. The map size and the resume time are included so
+    # that worker processes don't need to look at every chunk or the journal
+    # again to find them.
     def __getstate__(self):
-        return self.world, self.regionset, self.am, self.textures, self.options, self.outputdir
+        return (self.world, self.regionset, self.am, self.textures, self.options, self.outputdir), \
+                (self.treedepth, self.xradius, self.yradius), self._resume_since
     def __setstate__(self, state):
-        self.__init__(*state)
+        initargs, mapsize, self._resume_since = state
+        self.treedepth, self.xradius, self.yradius = mapsize
+        self.__init__(*initargs)
 
     def do_preprocessing(self):
         """For the preprocessing step of the Worker interface, this does the
@@ -380,14 +525,72 @@ class TileSet(object):
             logging.warning("Just letting you know, your map requries %s zoom levels. This is REALLY big!",
                     self.treedepth)
 
+        self.prepare_preprocessing()
+
+        # Do the chunk scan here, unless it was already done through
+        # add_preprocessing_result()
+        if self.dirtytree is None:
+            self.dirtytree = self._chunk_scan()
+        else:
+            self._finish_scan()
+
+        if self._resume_since is not None:
+            self._resumed_tiles = self._read_journal_tiles()
+            logging.info("%d tiles of %s were already rendered by the last render",
+                    len(self._resumed_tiles), self.options['name'])
+
+    def prepare_preprocessing(self):
+        """Re-arranges the tiles on disk if the size of the map changed. This
+        can switch to rendercheck mode 1, which the chunk scan depends on, so
+        it is done before any regions are scanned.
+
+        """
+        if self._prepared:
+            return
+        self._prepared = True
         # Do any tile re-arranging if necessary. Skip if there was no config
         # from the asset-manager, which typically indicates this is a new
         # render
         if self.config:
             self._rearrange_tiles()
 
-        # Do the chunk scan here
-        self.dirtytree = self._chunk_scan()
+    def get_preprocessing_key(self):
+        """Returns a key identifying the world data this TileSet scans during
+        preprocessing. TileSets with the same key (renders of the same
+        dimension of a world) have their region scans done together.
+
+        """
+        obj = self.regionset
+        while isinstance(obj, world.RegionSetWrapper):
+            obj = obj._r
+        try:
+            return obj.regiondir
+        except AttributeError:
+            return repr(obj)
+
+    def iterate_preprocessing_items(self):
+        """Returns an iterator over the regions to scan, as (regionx, regionz)
+        tuples
+
+        """
+        return iter(self.regionset.get_regions())
+
+    def do_preprocessing_work(self, region):
+        """Scans the chunks of the given region. The result is to be passed
+        to add_preprocessing_result() in the main process.
+
+        """
+        return self._scan_region(*region)
+
+    def add_preprocessing_result(self, region, result):
+        """Adds the result of scanning a region to the tree of dirty tiles"""
+        if self.dirtytree is None:
+            self._start_scan()
+        self._add_scan_result(result)
+
+    def get_caches(self):
+        """Returns the chunk caches used by this TileSet's regionset"""
+        return self.regionset.get_caches()
 
     def get_num_phases(self):
         """Returns the number of levels in the quadtree, which is equal to the
@@ -401,6 +604,8 @@ class TileSet(object):
         is no good estimate.
         """
         # Yeah functional programming!
+        if self._resumed_tiles is not None:
+            return sum(1 for _ in self._skip_resumed(self.dirtytree.posttraversal()))
         return {
                 0: lambda: self.dirtytree.count_all(),
                 #there is no good way to guess this so just give total count
@@ -408,11 +613,16 @@ class TileSet(object):
                 2: lambda: self.dirtytree.count_all(),
                 }[self.options['renderchecks']]()
 
-    def iterate_work_items(self, phase):
+    def iterate_work_items(self, phase, streaming=False):
         """Iterates over the dirty tiles in the tree and return them in the
         appropriate order with the appropriate dependencies.
 
         This method returns an iterator over (obj, [dependencies, ...])
+
+        With streaming, composite-tiles are left out. finish_work_item() gives
+        each one out when the last of its children is done. This only applies
+        to renderchecks modes 0 and 2, where the tiles to render are known up
+        front.
         """
 
         # The following block of code implementes the changelist functionality.
@@ -439,6 +649,71 @@ class TileSet(object):
                 os.write(fd, imgpath + "\n")
 
 
+        self._open_journal()
+
+        batchlevels = self.options.get("batchlevels", 2)
+        items = self._iterate_work_items()
+        if batchlevels > 0:
+            items = self._batch_work_items(items, max(self.treedepth - batchlevels, 0))
+        # Tiles skipped because they were already rendered would never
+        # finish, so the tiles above them can't be streamed
+        streaming = (streaming and self.options['renderchecks'] in (0,2) and
+                self._resumed_tiles is None)
+        # maps composite-tiles to how many of their children haven't
+        # finished, once one has
+        self._unfinished_children = {} if streaming else None
+        for workitem, dependencies in items:
+            if fd:
+                for tilepath in getattr(workitem, "tiles", [workitem]):
+                    write_out(tilepath)
+            if streaming and not isinstance(workitem, TileBatch) and len(workitem) < self.treedepth:
+                # finish_work_item() gives this out later
+                continue
+            yield workitem, dependencies
+
+    def finish_work_item(self, phase, workitem):
+        """Called in the main process when the given work item is done. When
+        streaming (see iterate_work_items()), returns the composite-tile above
+        it, if this was the last of that tile's children to finish.
+
+        The finished tiles are added to the journal.
+
+        """
+        if self._journal is not None:
+            for tilepath in getattr(workitem, "tiles", [workitem]):
+                self._journal.write("".join(str(x) for x in tilepath) + "\n")
+
+        counts = self._unfinished_children
+        if counts is None or len(workitem) == 0:
+            return []
+        parent = tuple(workitem)[:-1]
+        if parent in counts:
+            remaining = counts[parent] - 1
+        else:
+            remaining = sum(1 for i in xrange(4) if self.dirtytree.query_path(parent + (i,))) - 1
+        if remaining:
+            counts[parent] = remaining
+            return []
+        counts.pop(parent, None)
+        return [(parent, [])]
+
+    def get_work_item_priority(self, workitem):
+        """Returns the number of tiles from the given tile up to the base
+        tile, counting from its deepest tile for a TileBatch. The tiles in the
+        tree each wait only on their children, so doing the tiles with the
+        longest chain of tiles waiting on them first is what keeps the most
+        tiles ready to render until the end.
+
+        """
+        if isinstance(workitem, TileBatch):
+            return max(len(tilepath) for tilepath in workitem.tiles)
+        return len(workitem)
+
+    def _iterate_work_items(self):
+        """Iterates over the tiles to render, in post-traversal order, as
+        (tilepath, dependencies) tuples. See iterate_work_items()
+
+        """
         # See note at the top of this file about the rendercheck modes for an
         # explanation of what this method does in different situations.
         #
@@ -446,15 +721,16 @@ class TileSet(object):
         # render. Iterate over the tiles in using the posttraversal() method.
         # Yield each item. Easy.
         if self.options['renderchecks'] in (0,2):
-            for tilepath in self.dirtytree.posttraversal():
+            tilepaths = self.dirtytree.posttraversal()
+            if self._resumed_tiles is not None:
+                tilepaths = self._skip_resumed(tilepaths)
+            for tilepath in tilepaths:
                 dependencies = []
                 # These tiles may or may not exist, but the dispatcher won't
                 # care according to the worker interface protocol It will only
                 # wait for the items that do exist and are in the queue.
                 for i in range(4):
                     dependencies.append( tilepath + (i,) )
-                if fd:
-                    write_out(tilepath)
                 yield tilepath, dependencies
 
         else:
@@ -466,18 +742,137 @@ class TileSet(object):
                     dependencies = []
                     for i in range(4):
                         dependencies.append( tilepath + (i,) )
-                    if fd:
-                        write_out(tilepath)
                     yield tilepath, dependencies
 
+    def _skip_resumed(self, tilepaths):
+        """Filters the tiles already rendered by an interrupted render out of
+        the given tile paths, which must be in post-traversal order. A
+        composite-tile is only skipped if none of its children are rendered
+        again.
+
+        """
+        resumed = self._resumed_tiles
+        stale = self._stale_tiles
+        # composite-tiles with a child that is rendered again
+        changed = set()
+        for tilepath in tilepaths:
+            if tilepath in resumed and tilepath not in changed and tilepath not in stale:
+                continue
+            changed.discard(tilepath)
+            if tilepath:
+                changed.add(tilepath[:-1])
+            yield tilepath
+
+    def _read_journal_header(self):
+        """Returns the header of the journal of an interrupted render, a
+        dictionary, or None if there is no usable journal
+
+        """
+        try:
+            with open(self.journalpath) as f:
+                header = json.loads(f.readline())
+        except (EnvironmentError, ValueError):
+            return None
+        if not isinstance(header, dict) or not all(key in header for key in
+                ("started", "renderchecks", "treedepth", "imgextension", "options")):
+            return None
+        return header
+
+    def _read_journal_tiles(self):
+        """Returns the set of the tile paths listed in the journal"""
+        tiles = set()
+        with open(self.journalpath) as f:
+            f.readline()
+            for line in f:
+                # The last line may be cut short
+                if not line.endswith("\n"):
+                    break
+                line = line[:-1]
+                if len(line) <= self.treedepth and not line.strip("0123"):
+                    tiles.add(tuple(int(x) for x in line))
+        return tiles
+
+    def _get_options_key(self):
+        """Returns a string identifying the options that change what the
+        tiles look like. The journal of a render with other options can't be
+        continued.
+
+        """
+        key = [canonical_option(self.options.get(name)) for name in
+                ("rendermode", "texturepath", "bgcolor", "northdirection", "imgformat", "imgquality")]
+        return hashlib.md5(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def _open_journal(self):
+        """Opens the journal for the finished tiles to be added to. It's
+        started over unless this render continues the last one. Only
+        rendercheck modes 0 and 2 keep one.
+
+        """
+        if self._journal is not None or self.options['renderchecks'] not in (0,2):
+            return
+        if self._resume_since is not None:
+            self._journal = open(self.journalpath, "a", 1)
+        else:
+            self._journal = open(self.journalpath, "w", 1)
+            header = dict(started=time.time(), renderchecks=self.options['renderchecks'],
+                    treedepth=self.treedepth, imgextension=self.imgextension,
+                    options=self._get_options_key())
+            self._journal.write(json.dumps(header) + "\n")
+
+    def close_journal(self, completed):
+        """Closes the journal of finished tiles. If the render is completed,
+        the journal is removed, as there's nothing to continue.
+
+        """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if completed and os.path.exists(self.journalpath):
+            os.remove(self.journalpath)
+
+    def _batch_work_items(self, items, level):
+        """Groups the (tilepath, dependencies) items, which must be in
+        post-traversal order, into a TileBatch for each subtree rooted at the
+        given level. Tiles above that level are passed through unchanged.
+
+        """
+        # In post-traversal order, the tiles of a subtree come right before
+        # its root
+        batch = []
+        for tilepath, dependencies in items:
+            if len(tilepath) > level:
+                if batch and batch[0][:level] != tilepath[:level]:
+                    # the root of the last subtree didn't need rendering
+                    yield TileBatch(batch[0][:level], batch), []
+                    batch = []
+                batch.append(tilepath)
+            elif len(tilepath) == level:
+                if batch and batch[0][:level] != tilepath:
+                    yield TileBatch(batch[0][:level], batch), []
+                    batch = []
+                batch.append(tilepath)
+                yield TileBatch(tilepath, batch), []
+                batch = []
+            else:
+                if batch:
+                    yield TileBatch(batch[0][:level], batch), []
+                    batch = []
+                yield tilepath, dependencies
+        if batch:
+            yield TileBatch(batch[0][:level], batch), []
+
     def do_work(self, tilepath):
         """Renders the given tile.
 
         tilepath is yielded by iterate_work_items and is an iterable of
-        integers representing the path of the tile to render.
+        integers representing the path of the tile to render, or a TileBatch
+        of tiles to render in order.
 
         """
-        if len(tilepath) == self.treedepth:
+        if isinstance(tilepath, TileBatch):
+            for path in tilepath.tiles:
+                self.do_work(path)
+        elif len(tilepath) == self.treedepth:
             # A render-tile
             self._render_rendertile(RenderTile.from_path(tilepath))
         else:
@@ -552,17 +947,29 @@ class TileSet(object):
         self.minrow, self.maxrow, self.mincol, self.maxcol
 
         """
+        # This is the same for all TileSets over the same chunks
+        key = self.regionset.get_transform_key()
+        try:
+            return _chunk_range_cache[key]
+        except KeyError:
+            pass
+
         minrow = mincol = maxrow = maxcol = 0
 
-        for c_x, c_z, _ in self.regionset.iterate_chunks():
-            # Convert these coordinates to row/col
+        for c_x, c_z, _ in self.regionset.iterate_chunk_arrays():
+            if not len(c_x):
+                continue
+            # Convert these coordinates to row/col. convert_coords() works
+            # on whole arrays as well
             col, row = convert_coords(c_x, c_z)
 
-            minrow = min(minrow, row)
-            maxrow = max(maxrow, row)
-            mincol = min(mincol, col)
-            maxcol = max(maxcol, col)
-        return Bounds(mincol, maxcol, minrow, maxrow)
+            minrow = min(minrow, int(row.min()))
+            maxrow = max(maxrow, int(row.max()))
+            mincol = min(mincol, int(col.min()))
+            maxcol = max(maxcol, int(col.max()))
+        bounds = Bounds(mincol, maxcol, minrow, maxrow)
+        _chunk_range_cache[key] = bounds
+        return bounds
 
     def _set_map_size(self):
         """Finds and sets the depth of the map's quadtree, as well as the
@@ -627,6 +1034,8 @@ class TileSet(object):
                         "this one render. This will make sure any old tiles that "
                         "should no longer exist are deleted.")
                 self.options['renderchecks'] = 1
+                # The journal only covers modes 0 and 2
+                self._resume_since = None
 
     def _increase_depth(self):
         """Moves existing tiles into place for a larger tree"""
@@ -709,20 +1118,41 @@ class TileSet(object):
         As a side-effect, the scan sets self.max_chunk_mtime to the max of all
         the chunks' mtimes
 
-        """
-        # See note at the top of this file about the rendercheck modes for an
-        # explanation of what this method does in different situations.
+        The scan is done one region at a time by _scan_region(), which may
+        also be run in other processes and its results added with
+        _add_scan_result(). This method does the whole scan in this process.
 
-        # Local vars for slightly faster lookups
-        depth = self.treedepth
-        xradius = self.xradius
-        yradius = self.yradius
+        """
+        self._start_scan()
+        for regionx, regionz in self.regionset.get_regions():
+            self._add_scan_result(self._scan_region(regionx, regionz))
+        self._finish_scan()
+        return self.dirtytree
 
-        dirty = RendertileSet(depth)
+    def _start_scan(self):
+        """Sets up self.dirtytree and the scan statistics, for the results of
+        _scan_region() to be added to
 
-        chunkcount = 0
-        stime = time.time()
+        """
+        self.dirtytree = RendertileSet(self.treedepth)
+        self._stale_tiles = set()
+        self.max_chunk_mtime = 0
+        self._scan_chunkcount = 0
+        self._scan_stime = time.time()
+
+    def _scan_region(self, regionx, regionz):
+        """Scans the chunks of one region. Returns a tuple (paths, chunkcount,
+        max_chunk_mtime, stalepaths), where paths is an array with a row for
+        the path of each dirty render-tile touched by the region's chunks, and
+        stalepaths likewise for the tiles whose chunks changed since the
+        interrupted render this one continues, if any.
+
+        This doesn't use or change any state from the preprocessing step, so
+        it can be run in the worker processes.
 
+        """
+        # See note at the top of this file about the rendercheck modes for an
+        # explanation of what this method does in different situations.
         rendercheck = self.options['renderchecks']
         markall = rendercheck in (1,2)
 
@@ -730,74 +1160,77 @@ class TileSet(object):
 
         last_rendertime = self.last_rendertime
 
-        max_chunk_mtime = 0
-
-
-        # For each chunk, do this:
-        #   For each tile that the chunk touches, do this:
-        #       Compare the last modified time of the chunk and tile. If the
-        #       tile is older, mark it in a RendertileSet object as dirty.
-
-        for chunkx, chunkz, chunkmtime in self.regionset.iterate_chunks():
-
-            chunkcount += 1
-
-            if chunkmtime > max_chunk_mtime:
-                max_chunk_mtime = chunkmtime
-
-            # Convert to diagonal coordinates
-            chunkcol, chunkrow = convert_coords(chunkx, chunkz)
-
-            for c, r in get_tiles_by_chunk(chunkcol, chunkrow):
-
-                # Make sure the tile is in the boundary we're rendering.
-                # This can happen when rendering at lower treedepth than
-                # can contain the entire map, but shouldn't happen if the
-                # treedepth is correctly calculated.
-                if (
-                        c < -xradius or
-                        c >= xradius or
-                        r < -yradius or
-                        r >= yradius
-                        ):
-                    continue
+        # Find all the tiles the chunks touch, and for each of those tiles the
+        # newest chunk mtime. Tiles on the region's borders are also touched
+        # by chunks of other regions, and may be found dirty by their scan
+        # too. This only depends on the chunks and the tree size, so it is
+        # shared with other TileSets over the same chunks.
+        key = (self.regionset.get_transform_key(), self.treedepth, regionx, regionz)
+        try:
+            tilepaths, tilemtimes, chunkcount, max_chunk_mtime = _region_tiles_cache[key]
+        except KeyError:
+            chunkxs, chunkzs, chunkmtimes = self.regionset.get_region_chunk_arrays(regionx, regionz)
+            chunkcount = len(chunkxs)
+            max_chunk_mtime = int(chunkmtimes.max()) if chunkcount else 0
+            tilecols, tilerows, tilemtimes = self._get_tiles_by_chunks(chunkxs, chunkzs, chunkmtimes)
+            tilepaths = numpy.array(compute_paths(tilecols, tilerows, self.treedepth),
+                    dtype=numpy.uint8).reshape((-1, self.treedepth))
+            _region_tiles_cache[key] = (tilepaths, tilemtimes, chunkcount, max_chunk_mtime)
+
+        if markall:
+            # markall mode: Skip all other checks, mark tiles as dirty
+            # unconditionally
+            isdirty = numpy.ones(len(tilepaths), dtype=bool)
+        else:
+            # Check mtimes
+            isdirty = tilemtimes > last_rendertime
+            # Stochastic check. The given probability is for a particular
+            # tile that needs rendering.
+            if rerender_prob:
+                isdirty |= numpy.random.random_sample(len(tilepaths)) < rerender_prob
+
+        if self._resume_since is not None:
+            stalepaths = tilepaths[isdirty & (tilemtimes > self._resume_since)]
+        else:
+            stalepaths = tilepaths[:0]
 
-                # Computes the path in the quadtree from the col,row coordinates
-                tile = RenderTile.compute_path(c, r, depth)
+        return tilepaths[isdirty], chunkcount, max_chunk_mtime, stalepaths
 
-                if markall:
-                    # markall mode: Skip all other checks, mark tiles
-                    # as dirty unconditionally
-                    dirty.add(tile.path)
-                    continue
+    def _add_scan_result(self, result):
+        """Adds the result of a _scan_region() call to self.dirtytree"""
+        paths, chunkcount, max_chunk_mtime, stalepaths = result
+        self._scan_chunkcount += chunkcount
+        self.max_chunk_mtime = max(self.max_chunk_mtime, max_chunk_mtime)
+        for path in paths.tolist():
+            self.dirtytree.add(path)
+        self._stale_tiles.update(tuple(path) for path in stalepaths.tolist())
 
-                # Check if this tile has already been marked dirty. If so,
-                # no need to do any of the below.
-                if dirty.query_path(tile.path):
-                    continue
+    def _finish_scan(self):
+        t = int(time.time()-self._scan_stime)
+        logging.debug("Finished chunk scan for %s. %s chunks scanned in %s second%s",
+                self.options['name'], self._scan_chunkcount, t,
+                "s" if t != 1 else "")
 
-                # Stochastic check. Since we're scanning by chunks and not
-                # by tiles, and the tiles get checked multiple times for
-                # each chunk, this is only an approximation. The given
-                # probability is for a particular tile that needs
-                # rendering, but since a tile gets touched up to 32 times
-                # (once for each chunk in it), divide the probability by
-                # 32.
-                if rerender_prob and rerender_prob/32 > random.random():
-                    dirty.add(tile.path)
-                    continue
+    def _get_tiles_by_chunks(self, chunkxs, chunkzs, chunkmtimes):
+        """Takes arrays of chunk coordinates and mtimes, and returns arrays
+        (tilecols, tilerows, tilemtimes) of the render-tiles within this
+        tileset's bounds that those chunks touch, each tile with the mtime of
+        its newest chunk.
 
-                # Check mtimes and conditionally add tile to the set
-                if chunkmtime > last_rendertime:
-                    dirty.add(tile.path)
+        """
+        # Convert to diagonal coordinates
+        chunkcols, chunkrows = convert_coords(chunkxs, chunkzs)
+        tilecols, tilerows, chunkindex = get_tiles_by_chunks(chunkcols, chunkrows)
 
-        t = int(time.time()-stime)
-        logging.debug("Finished chunk scan for %s. %s chunks scanned in %s second%s",
-                self.options['name'], chunkcount, t,
-                "s" if t != 1 else "")
+        # Make sure the tile is in the boundary we're rendering.
+        # This can happen when rendering at lower treedepth than
+        # can contain the entire map, but shouldn't happen if the
+        # treedepth is correctly calculated.
+        inbounds = ((tilecols >= -self.xradius) & (tilecols < self.xradius) &
+                (tilerows >= -self.yradius) & (tilerows < self.yradius))
 
-        self.max_chunk_mtime = max_chunk_mtime
-        return dirty
+        return unique_tiles(tilecols[inbounds], tilerows[inbounds],
+                chunkmtimes[chunkindex[inbounds]])
 
     def __str__(self):
         return "<TileSet for %s>" % os.path.basename(self.outputdir)
@@ -949,6 +1382,7 @@ class TileSet(object):
         # col colstart will get drawn on the image starting at x coordinates -(384/2)
         # row rowstart will get drawn on the image starting at y coordinates -(192/2)
         max_chunk_mtime = 0
+        sections = []
         for col, row, chunkx, chunky, chunkz, chunk_mtime in chunks:
             xpos = -192 + (col-colstart)*192
             ypos = -96 + (row-rowstart)*96 + (16-1 - chunky)*192
@@ -956,35 +1390,17 @@ class TileSet(object):
             if chunk_mtime > max_chunk_mtime:
                 max_chunk_mtime = chunk_mtime
 
-            # draw the chunk!
-            try:
-                c_overviewer.render_loop(self.world, self.regionset, chunkx, chunky,
-                        chunkz, tileimg, xpos, ypos,
-                        self.options['rendermode'], self.textures)
-            except nbt.CorruptionError:
-                # A warning and traceback was already printed by world.py's
-                # get_chunk()
-                logging.debug("Skipping the render of corrupt chunk at %s,%s and moving on.", chunkx, chunkz)
-            except Exception, e:
-                logging.error("Could not render chunk %s,%s for some reason. This is likely a render primitive option error.", chunkx, chunkz)
-                logging.error("Full error was:", exc_info=1)
-                sys.exit(1)
-
-            ## Semi-handy routine for debugging the drawing routine
-            ## Draw the outline of the top of the chunk
-            #import ImageDraw
-            #draw = ImageDraw.Draw(tileimg)
-            ## Draw top outline
-            #draw.line([(192,0), (384,96)], fill='red')
-            #draw.line([(192,0), (0,96)], fill='red')
-            #draw.line([(0,96), (192,192)], fill='red')
-            #draw.line([(384,96), (192,192)], fill='red')
-            ## Draw side outline
-            #draw.line([(0,96),(0,96+192)], fill='red')
-            #draw.line([(384,96),(384,96+192)], fill='red')
-            ## Which chunk this is:
-            #draw.text((96,48), "C: %s,%s" % (chunkx, chunkz), fill='red')
-            #draw.text((96,96), "c,r: %s,%s" % (col, row), fill='red')
+            sections.append((chunkx, chunky, chunkz, xpos, ypos))
+
+        # draw the chunks! Sections of corrupt chunks are skipped; a warning
+        # and traceback was already printed by world.py's get_chunk()
+        try:
+            c_overviewer.render_tile(self.world, self.regionset, sections,
+                    tileimg, self.options['rendermode'], self.textures)
+        except Exception, e:
+            logging.error("Could not render %s for some reason. This is likely a render primitive option error.", tile)
+            logging.error("Full error was:", exc_info=1)
+            sys.exit(1)
 
         # Save them
         with FileReplacer(imgpath) as tmppath:
@@ -1153,6 +1569,23 @@ class TileSet(object):
 ## Functions for converting (x, z) to (col, row) and back
 ##
 
+def canonical_option(value):
+    """Converts an option value to plain lists, dicts, strings and numbers
+    that serialize the same way on every run. Render primitives become their
+    name and option values. Any other object becomes its class name, since its
+    repr may include its address.
+
+    """
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [canonical_option(x) for x in value]
+    if isinstance(value, dict):
+        return sorted([canonical_option(k), canonical_option(v)] for k, v in value.iteritems())
+    if isinstance(value, rendermodes.RenderPrimitive):
+        return [value.name, canonical_option(value.option_values)]
+    return type(value).__name__
+
 def convert_coords(chunkx, chunkz):
     """Takes a coordinate (chunkx, chunkz) where chunkx and chunkz are
     in the chunk coordinate system, and figures out the row and column
@@ -1202,6 +1635,69 @@ def get_tiles_by_chunk(chunkcol, chunkrow):
 
     return product(colrange, rowrange)
 
+# The (col, row) offsets from a chunk's tile (see get_tiles_by_chunk()) to
+# all the tiles it may touch: the tile to its left, and the tile above it plus
+# the 9 below
+_tile_col_offsets = numpy.array([-2, 0]).reshape((1,2,1))
+_tile_row_offsets = numpy.arange(-4, 32+1, 4).reshape((1,1,10))
+
+def get_tiles_by_chunks(chunkcols, chunkrows):
+    """Array version of get_tiles_by_chunk(). Takes arrays of chunk columns
+    and rows, and returns arrays (tilecols, tilerows, chunkindex) with an
+    entry for every tile each chunk touches. chunkindex is the index of the
+    touching chunk in the given arrays.
+
+    """
+    chunkcols = numpy.asarray(chunkcols, dtype=numpy.int64).reshape((-1,1,1))
+    chunkrows = numpy.asarray(chunkrows, dtype=numpy.int64).reshape((-1,1,1))
+
+    tilecols = chunkcols - chunkcols % 2 + _tile_col_offsets
+    tilerows = chunkrows - chunkrows % 4 + _tile_row_offsets
+
+    # Only chunks in an even column touch the tile to their left, and only
+    # chunks in a row divisible by 4 touch the tile above them
+    touches = ((chunkcols % 2 == 0) | (_tile_col_offsets == 0)) & \
+            ((chunkrows % 4 == 0) | (_tile_row_offsets != -4))
+
+    chunkindex = numpy.arange(len(chunkcols)).reshape((-1,1,1))
+    tilecols, tilerows, chunkindex, touches = numpy.broadcast_arrays(
+            tilecols, tilerows, chunkindex, touches)
+    return tilecols[touches], tilerows[touches], chunkindex[touches]
+
+def unique_tiles(tilecols, tilerows, tilemtimes):
+    """Takes arrays of tile columns, rows and mtimes that may contain the same
+    tile more than once, and returns (tilecols, tilerows, tilemtimes) with
+    each tile only once, with the greatest of its mtimes.
+
+    """
+    if not len(tilecols):
+        return tilecols, tilerows, tilemtimes
+    order = numpy.lexsort((tilerows, tilecols))
+    tilecols = tilecols[order]
+    tilerows = tilerows[order]
+    tilemtimes = tilemtimes[order]
+
+    # index of the first entry of each tile
+    starts = numpy.flatnonzero(numpy.concatenate(([True],
+            (tilecols[1:] != tilecols[:-1]) | (tilerows[1:] != tilerows[:-1]))))
+    return (tilecols[starts], tilerows[starts],
+            numpy.maximum.reduceat(tilemtimes, starts))
+
+def compute_paths(tilecols, tilerows, depth):
+    """Array version of RenderTile.compute_path(). Returns a list of the
+    quadtree paths (as tuples) of the tiles with the given columns and rows.
+
+    """
+    # Shift the coordinates so they start at 0. Then each bit of the column
+    # and row, from the top down, says which half the tile is in at that
+    # level.
+    cols = numpy.asarray(tilecols, dtype=numpy.int64) + 2**depth
+    rows = numpy.asarray(tilerows, dtype=numpy.int64) + 2*2**depth
+    levels = numpy.arange(depth, dtype=numpy.int64)
+    xbits = (cols.reshape((-1,1)) >> (depth - levels)) & 1
+    ybits = (rows.reshape((-1,1)) >> (depth + 1 - levels)) & 1
+    return [tuple(path) for path in (xbits + 2*ybits).tolist()]
+
 def get_chunks_by_tile(tile, regionset):
     """Get chunk sections that are relevant to the given render-tile. Only
     returns chunk sections that are in chunks that actually exist according to
@@ -27,6 +27,13 @@ import numpy
 from . import nbt
 from . import cache
 
+try:
+    from .c_overviewer import decode_section as _c_decode_section
+except ImportError:
+    # the extension isn't built, or is too old to have it; get_chunk() falls
+    # back to numpy
+    _c_decode_section = None
+
 """
 This module has routines for extracting information about available worlds
 
@@ -292,6 +299,22 @@ class RegionSet(object):
         # path will be normalized in __init__
         return self.type
 
+    def get_transform_key(self):
+        """Returns a hashable key identifying the chunks of this regionset.
+        Regionsets with equal keys hold the same chunks at the same
+        coordinates, so results computed from one can be reused for the
+        other. Wrappers that move or filter chunks add to this key.
+
+        """
+        return (self.regiondir,)
+
+    def get_caches(self):
+        """Returns a list of the cache objects used by this regionset and the
+        regionsets it wraps.
+
+        """
+        return []
+
     def _get_regionobj(self, regionfilename):
         # Check the cache first. If it's not there, create the
         # nbt.MCRFileReader object, cache it, and return it
@@ -303,8 +326,13 @@ class RegionSet(object):
             self.regioncache[regionfilename] = region
             return region
     
+    # The parts of a chunk's NBT data that are needed for rendering. All other
+    # tags (Entities, TileEntities, TileTicks, HeightMap...) are skipped over
+    # by the NBT parser unless they are asked for.
+    _render_tagpaths = ("Level/Sections", "Level/Biomes")
+
     #@log_other_exceptions
-    def get_chunk(self, x, z):
+    def get_chunk(self, x, z, entities=False):
         """Returns a dictionary object representing the "Level" NBT Compound
         structure for a chunk given its x, z coordinates. The coordinates given
         are chunk coordinates. Raises ChunkDoesntExist exception if the given
@@ -326,10 +354,19 @@ class RegionSet(object):
             array
           * The "Data" byte string is transformed into a 16x16x128 numpy array
 
+        Unless entities is True, only the Sections and Biomes tags are parsed
+        and included in the returned dictionary. Pass entities=True to get the
+        full "Level" structure, including the Entities and TileEntities lists.
+
         Warning: the returned data may be cached and thus should not be
         modified, lest it affect the return values of future calls for the same
         chunk.
         """
+        if entities:
+            tagpaths = None
+        else:
+            tagpaths = self._render_tagpaths
+
         regionfile = self._get_region_path(x, z)
         if regionfile is None:
             raise ChunkDoesntExist("Chunk %s,%s doesn't exist (and neither does its region)" % (x,z))
@@ -340,7 +377,7 @@ class RegionSet(object):
         while True:
             try:
                 region = self._get_regionobj(regionfile)
-                data = region.load_chunk(x, z)
+                data = region.load_chunk(x, z, tagpaths)
             except nbt.CorruptionError, e:
                 tries -= 1
                 if tries > 0:
@@ -387,59 +424,25 @@ class RegionSet(object):
         chunk_data['Biomes'] = biomes
 
         for section in chunk_data['Sections']:
-
-            # Turn the Blocks array into a 16x16x16 numpy matrix of shorts,
-            # adding in the additional block array if included.
-            blocks = numpy.frombuffer(section['Blocks'], dtype=numpy.uint8)
-            # Cast up to uint16, blocks can have up to 12 bits of data
-            blocks = blocks.astype(numpy.uint16)
-            blocks = blocks.reshape((16,16,16))
-            if "Add" in section:
-                # This section has additional bits to tack on to the blocks
-                # array. Add is a packed array with 4 bits per slot, so
-                # it needs expanding
-                additional = numpy.frombuffer(section['Add'], dtype=numpy.uint8)
-                additional = additional.astype(numpy.uint16).reshape((16,16,8))
-                additional_expanded = numpy.empty((16,16,16), dtype=numpy.uint16)
-                additional_expanded[:,:,::2] = (additional & 0x0F) << 8
-                additional_expanded[:,:,1::2] = (additional & 0xF0) << 4
-                blocks += additional_expanded
-                del additional
-                del additional_expanded
-                del section['Add'] # Save some memory
-            section['Blocks'] = blocks
-
-            # Turn the skylight array into a 16x16x16 matrix. The array comes
-            # packed 2 elements per byte, so we need to expand it.
-            skylight = numpy.frombuffer(section['SkyLight'], dtype=numpy.uint8)
-            skylight = skylight.reshape((16,16,8))
-            skylight_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-            skylight_expanded[:,:,::2] = skylight & 0x0F
-            skylight_expanded[:,:,1::2] = (skylight & 0xF0) >> 4
-            del skylight
-            section['SkyLight'] = skylight_expanded
-
-            # Turn the BlockLight array into a 16x16x16 matrix, same as SkyLight
-            blocklight = numpy.frombuffer(section['BlockLight'], dtype=numpy.uint8)
-            blocklight = blocklight.reshape((16,16,8))
-            blocklight_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-            blocklight_expanded[:,:,::2] = blocklight & 0x0F
-            blocklight_expanded[:,:,1::2] = (blocklight & 0xF0) >> 4
-            del blocklight
-            section['BlockLight'] = blocklight_expanded
-
-            # Turn the Data array into a 16x16x16 matrix, same as SkyLight
-            data = numpy.frombuffer(section['Data'], dtype=numpy.uint8)
-            data = data.reshape((16,16,8))
-            data_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-            data_expanded[:,:,::2] = data & 0x0F
-            data_expanded[:,:,1::2] = (data & 0xF0) >> 4
-            del data
-            section['Data'] = data_expanded
+            decode_section(section)
         
         return chunk_data      
     
 
+    def get_unrotated_chunk(self, x, z):
+        """Returns a (chunk, rotation) tuple. The chunk is the one get_chunk()
+        returns for the given coordinates, except that its arrays haven't been
+        turned to match a RotatedRegionSet's north direction yet. rotation is
+        how many 90 degree turns they still need, the same way a north
+        direction counts them (see UPPER_LEFT and friends below).
+
+        The C extension renders from these, and reads the arrays with the
+        coordinates turned instead. That way every north direction uses the
+        same cached chunks.
+
+        """
+        return self.get_chunk(x, z), 0
+
     def iterate_chunks(self):
         """Returns an iterator over all chunk metadata in this world. Iterates
         over tuples of integers (x,z,mtime) for each chunk.  Other chunk data
@@ -456,6 +459,40 @@ class RegionSet(object):
             for chunkx, chunky in mcr.get_chunks():
                 yield chunkx+32*regionx, chunky+32*regiony, mcr.get_chunk_timestamp(chunkx, chunky)
 
+    def get_regions(self):
+        """Returns a list of (regionx, regionz) coordinates of all the region
+        files in this regionset. Each of these may be passed to
+        get_region_chunk_arrays().
+
+        """
+        return self.regionfiles.keys()
+
+    def get_region_chunk_arrays(self, regionx, regionz):
+        """Returns the chunk metadata of all the chunks in the given region at
+        once, as a tuple of numpy arrays (x, z, mtime) in chunk coordinates.
+        Corrupt or missing regions have no chunks.
+
+        """
+        regionfile = self.regionfiles.get((regionx, regionz), None)
+        if regionfile is None:
+            return _empty_chunk_arrays()
+        try:
+            mcr = self._get_regionobj(regionfile)
+        except nbt.CorruptRegionError:
+            logging.warning("Found a corrupt region file at %s,%s. Skipping it.", regionx, regionz)
+            return _empty_chunk_arrays()
+        x, z, mtime = mcr.get_chunk_arrays()
+        return x + 32*regionx, z + 32*regionz, mtime
+
+    def iterate_chunk_arrays(self):
+        """Returns an iterator over all chunk metadata in this world, one
+        region at a time, as returned by get_region_chunk_arrays(). This is
+        the bulk version of iterate_chunks().
+
+        """
+        for regionx, regionz in self.get_regions():
+            yield self.get_region_chunk_arrays(regionx, regionz)
+
     def get_chunk_mtime(self, x, z):
         """Returns a chunk's mtime, or False if the chunk does not exist.  This
         is therefore a dual purpose method. It corrects for the given north
@@ -501,6 +538,57 @@ class RegionSet(object):
                 logging.warning("Holy shit what is up with region file %s !?" % f)
             yield (x, y, path)
 
+def decode_section(section):
+    """Turns the byte strings of an Anvil chunk section dictionary into
+    16x16x16 numpy arrays, indexed Y,Z,X, in place. Blocks becomes an array
+    of shorts, with the extra bits from Add (which is removed) included, and
+    the packed 4 bit values of Data, SkyLight and BlockLight are expanded to
+    one byte each.
+
+    The C extension does this in one pass over the section. Without it, numpy
+    is used.
+
+    """
+    blocks = numpy.empty((16,16,16), dtype=numpy.uint16)
+    data = numpy.empty((16,16,16), dtype=numpy.uint8)
+    skylight = numpy.empty((16,16,16), dtype=numpy.uint8)
+    blocklight = numpy.empty((16,16,16), dtype=numpy.uint8)
+    if _c_decode_section is not None:
+        _c_decode_section(section['Blocks'], section.get('Add'), section['Data'],
+                section['SkyLight'], section['BlockLight'],
+                blocks, data, skylight, blocklight)
+    else:
+        _decode_section_numpy(section, blocks, data, skylight, blocklight)
+
+    section.pop('Add', None) # Save some memory
+    section['Blocks'] = blocks
+    section['Data'] = data
+    section['SkyLight'] = skylight
+    section['BlockLight'] = blocklight
+
+def _decode_section_numpy(section, blocks, data, skylight, blocklight):
+    """The numpy version of decode_section(), filling in the given arrays"""
+    # blocks can have up to 12 bits of data, so they're cast up to uint16
+    blocks[...] = numpy.frombuffer(section['Blocks'], dtype=numpy.uint8).reshape((16,16,16))
+    if "Add" in section:
+        # This section has additional bits to tack on to the blocks
+        # array. Add is a packed array with 4 bits per slot
+        additional = numpy.frombuffer(section['Add'], dtype=numpy.uint8)
+        additional = additional.astype(numpy.uint16).reshape((16,16,8))
+        blocks[:,:,::2] += (additional & 0x0F) << 8
+        blocks[:,:,1::2] += (additional & 0xF0) << 4
+
+    # The other arrays come packed 2 elements per byte, so they need expanding
+    for name, expanded in (('Data', data), ('SkyLight', skylight), ('BlockLight', blocklight)):
+        packed = numpy.frombuffer(section[name], dtype=numpy.uint8).reshape((16,16,8))
+        expanded[:,:,::2] = packed & 0x0F
+        expanded[:,:,1::2] = packed >> 4
+
+def _empty_chunk_arrays():
+    """Returns an (x, z, mtime) tuple of arrays holding no chunks"""
+    return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64),
+            numpy.zeros(0, dtype=numpy.uint32))
+
 class RegionSetWrapper(object):
     """This is the base class for all "wrappers" of RegionSet objects. A
     wrapper is an object that acts similarly to a subclass: some methods are
@@ -519,12 +607,26 @@ class RegionSetWrapper(object):
 
     def get_type(self):
         return self._r.get_type()
+    def get_transform_key(self):
+        return self._r.get_transform_key()
+    def get_caches(self):
+        return self._r.get_caches()
     def get_biome_data(self, x, z):
         return self._r.get_biome_data(x,z)
-    def get_chunk(self, x, z):
-        return self._r.get_chunk(x,z)
+    def get_chunk(self, x, z, entities=False):
+        return self._r.get_chunk(x,z, entities=entities)
+    def get_unrotated_chunk(self, x, z):
+        # wrappers that change the chunks do so in get_chunk()
+        return self.get_chunk(x,z), 0
     def iterate_chunks(self):
         return self._r.iterate_chunks()
+    def get_regions(self):
+        return self._r.get_regions()
+    def get_region_chunk_arrays(self, regionx, regionz):
+        return self._r.get_region_chunk_arrays(regionx, regionz)
+    def iterate_chunk_arrays(self):
+        for regionx, regionz in self.get_regions():
+            yield self.get_region_chunk_arrays(regionx, regionz)
     def get_chunk_mtime(self, x, z):
         return self._r.get_chunk_mtime(x,z)
     
@@ -578,9 +680,10 @@ class RotatedRegionSet(RegionSetWrapper):
     def __setstate__(self, args):
         self.__init__(args[0], args[1])
     
-    def get_chunk(self, x, z):
+    def get_chunk(self, x, z, entities=False):
         x,z = self.unrotate(x,z)
-        chunk_data = dict(super(RotatedRegionSet, self).get_chunk(x,z))
+        # Only the arrays are rotated. Entities keep their world coordinates.
+        chunk_data = dict(super(RotatedRegionSet, self).get_chunk(x,z, entities=entities))
         newsections = []
         for section in chunk_data['Sections']:
             section = dict(section)
@@ -602,6 +705,14 @@ class RotatedRegionSet(RegionSetWrapper):
         chunk_data['Biomes'] = numpy.swapaxes(biomes, 0, 1)
         return chunk_data
 
+    def get_unrotated_chunk(self, x, z):
+        x,z = self.unrotate(x,z)
+        chunk_data, rotation = self._r.get_unrotated_chunk(x,z)
+        return chunk_data, (rotation + self.north_dir) % 4
+
+    def get_transform_key(self):
+        return super(RotatedRegionSet, self).get_transform_key() + (("rotate", self.north_dir),)
+
     def get_chunk_mtime(self, x, z):
         x,z = self.unrotate(x,z)
         return super(RotatedRegionSet, self).get_chunk_mtime(x, z)
@@ -611,6 +722,13 @@ class RotatedRegionSet(RegionSetWrapper):
             x,z = self.rotate(x,z)
             yield x,z,mtime
 
+    def get_region_chunk_arrays(self, regionx, regionz):
+        # the rotation functions are plain negations and swaps, so they work
+        # on whole arrays too
+        x,z,mtime = super(RotatedRegionSet, self).get_region_chunk_arrays(regionx, regionz)
+        x,z = self.rotate(x,z)
+        return x,z,mtime
+
 class CroppedRegionSet(RegionSetWrapper):
     def __init__(self, rsetobj, xmin, zmin, xmax, zmax):
         super(CroppedRegionSet, self).__init__(rsetobj)
@@ -619,12 +737,16 @@ class CroppedRegionSet(RegionSetWrapper):
         self.zmin = zmin//16
         self.zmax = zmax//16
 
-    def get_chunk(self,x,z):
+    def get_transform_key(self):
+        return super(CroppedRegionSet, self).get_transform_key() + \
+                (("crop", self.xmin, self.zmin, self.xmax, self.zmax),)
+
+    def get_chunk(self,x,z, entities=False):
         if (
                 self.xmin <= x <= self.xmax and
                 self.zmin <= z <= self.zmax
                 ):
-            return super(CroppedRegionSet, self).get_chunk(x,z)
+            return super(CroppedRegionSet, self).get_chunk(x,z, entities=entities)
         else:
             raise ChunkDoesntExist("This chunk is out of the requested bounds")
 
@@ -634,6 +756,19 @@ class CroppedRegionSet(RegionSetWrapper):
                     self.xmin <= x <= self.xmax and
                     self.zmin <= z <= self.zmax
                 )
+
+    def get_regions(self):
+        # skip regions entirely outside of the bounds
+        return [(regionx, regionz) for (regionx, regionz) in super(CroppedRegionSet, self).get_regions()
+                if
+                    self.xmin <= regionx*32+31 and regionx*32 <= self.xmax and
+                    self.zmin <= regionz*32+31 and regionz*32 <= self.zmax
+                ]
+
+    def get_region_chunk_arrays(self, regionx, regionz):
+        x,z,mtime = super(CroppedRegionSet, self).get_region_chunk_arrays(regionx, regionz)
+        inbounds = (self.xmin <= x) & (x <= self.xmax) & (self.zmin <= z) & (z <= self.zmax)
+        return x[inbounds], z[inbounds], mtime[inbounds]
     def get_chunk_mtime(self,x,z):
         if (
                 self.xmin <= x <= self.xmax and
@@ -677,8 +812,20 @@ class CachedRegionSet(RegionSetWrapper):
 
         self.key = s
 
-    def get_chunk(self, x, z):
-        key = hashlib.md5(repr((self.key, x, z))).hexdigest()
+    def get_caches(self):
+        return self.caches + self._r.get_caches()
+
+    def get_chunk(self, x, z, entities=False):
+        # The chunk's mtime is part of the key, so caches that outlive this
+        # run (on disk or in memcached) never return an old version of a chunk.
+        # Chunks with their entities are kept apart from those without.
+        mtime = self._r.get_chunk_mtime(x, z)
+        if mtime is None:
+            raise ChunkDoesntExist("Chunk %s,%s doesn't exist" % (x,z))
+        if entities:
+            key = hashlib.md5(repr((self.key, x, z, mtime, "entities"))).hexdigest()
+        else:
+            key = hashlib.md5(repr((self.key, x, z, mtime))).hexdigest()
         for i, cache in enumerate(self.caches):
             try:
                 retval = cache[key]
@@ -689,7 +836,7 @@ class CachedRegionSet(RegionSetWrapper):
             except KeyError:
                 pass
         else:
-            retval = super(CachedRegionSet, self).get_chunk(x,z)
+            retval = super(CachedRegionSet, self).get_chunk(x,z, entities=entities)
 
         # Now add retval to all the caches that didn't have it, all the caches
         # up to and including index i
@@ -11,7 +11,9 @@ from test_tileobj import TileTest
 from test_rendertileset import RendertileSetTest
 from test_settings import SettingsTest
 from test_tileset import TilesetTest
-from test_cache import TestLRU
+from test_cache import TestLRU, TestLRUBytes, TestDiskCache, TestSharedMemoryCache
+from test_nbt import NBTReaderTest, MCRReaderTest
+from test_dispatcher import DispatcherTest
 
 # DISABLE THIS BLOCK TO GET LOG OUTPUT FROM TILESET FOR DEBUGGING
 if 0:
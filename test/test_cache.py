@@ -1,4 +1,12 @@
 import unittest
+import tempfile
+import shutil
+import os
+import cPickle
+import subprocess
+import sys
+
+import numpy
 
 from overviewer_core import cache
 
@@ -54,3 +62,186 @@ class TestLRU(unittest.TestCase):
         self.assertEquals(self.lru[4], 'asdf')
         self.assertEquals(self.lru[5], 'asdf')
         self.assertEquals(self.lru[6], 'asdf')
+
+class TestLRUBytes(unittest.TestCase):
+
+    def setUp(self):
+        self.lru = cache.LRUCache(size=None, maxbytes=1000)
+
+    def make_value(self, n):
+        return {'Sections': [{'Y': 0, 'Blocks': numpy.zeros(n, dtype=numpy.uint8)}]}
+
+    def test_nbytes(self):
+        self.assertEquals(cache.get_nbytes(self.make_value(300)), 300)
+        self.assertEquals(cache.get_nbytes((numpy.zeros(10, dtype=numpy.uint16), "abc", 5)), 23)
+
+    def test_evict_by_bytes(self):
+        for i in xrange(4):
+            self.lru[i] = self.make_value(300)
+        self.assertRaises(KeyError, self.lru.__getitem__, 0)
+        self.lru[1]
+        self.lru[4] = self.make_value(600)
+        # 2 and 3 were used least recently
+        self.assertRaises(KeyError, self.lru.__getitem__, 2)
+        self.assertRaises(KeyError, self.lru.__getitem__, 3)
+        self.assertEquals(self.lru[1]['Sections'][0]['Blocks'].nbytes, 300)
+        self.assertEquals(self.lru.resident_bytes, 900)
+        self.assertEquals(self.lru.evictions, 3)
+        self.assertEquals(cache.get_stats(self.lru),
+                {'hits': 2, 'misses': 3, 'evictions': 3, 'resident_bytes': 900})
+
+    def test_too_big(self):
+        self.lru[1] = self.make_value(300)
+        self.lru[2] = self.make_value(2000)
+        self.assertRaises(KeyError, self.lru.__getitem__, 2)
+        self.assertEquals(self.lru.resident_bytes, 300)
+
+    def test_replace_and_delete(self):
+        self.lru[1] = self.make_value(300)
+        self.lru[1] = self.make_value(500)
+        self.assertEquals(self.lru.resident_bytes, 500)
+        del self.lru[1]
+        self.assertEquals(self.lru.resident_bytes, 0)
+
+    def test_pickle(self):
+        lru = cPickle.loads(cPickle.dumps(self.lru))
+        self.assertEquals((lru.size, lru.maxbytes), (None, 1000))
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp(prefix="OVTEST")
+        self.cache = cache.DiskCache(self.cachedir, size=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def make_chunk(self):
+        return {
+                'Biomes': numpy.arange(256, dtype=numpy.uint8).reshape((16,16)),
+                'Sections': [
+                    {'Y': 0,
+                     'Blocks': numpy.arange(4096, dtype=numpy.uint16).reshape((16,16,16)),
+                     'Data': numpy.ones((16,16,16), dtype=numpy.uint8)},
+                    {'Y': 1,
+                     'Blocks': numpy.zeros((16,16,16), dtype=numpy.uint16)[:,::-1,:],
+                     'Empty': numpy.zeros((0,), dtype=numpy.uint8)},
+                    ],
+                'Name': u"chunk",
+                }
+
+    def test_roundtrip(self):
+        chunk = self.make_chunk()
+        self.cache["abcdef"] = chunk
+        got = self.cache["abcdef"]
+        self.assertEquals(sorted(got.keys()), sorted(chunk.keys()))
+        self.assertEquals(got['Name'], u"chunk")
+        self.assertTrue(numpy.array_equal(got['Biomes'], chunk['Biomes']))
+        for gotsection, section in zip(got['Sections'], chunk['Sections']):
+            self.assertEquals(sorted(gotsection.keys()), sorted(section.keys()))
+            for name, value in section.iteritems():
+                if isinstance(value, numpy.ndarray):
+                    self.assertEquals(gotsection[name].dtype, value.dtype)
+                    self.assertTrue(numpy.array_equal(gotsection[name], value))
+                else:
+                    self.assertEquals(gotsection[name], value)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_missing(self):
+        self.assertRaises(KeyError, self.cache.__getitem__, "abcdef")
+        self.assertEquals(self.cache.misses, 1)
+
+    def test_corrupt(self):
+        self.cache["abcdef"] = self.make_chunk()
+        path = self.cache._get_path("abcdef")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) // 2)
+        self.assertRaises(KeyError, self.cache.__getitem__, "abcdef")
+        self.assertFalse(os.path.exists(path))
+
+    def test_prune(self):
+        # each of these is about 400KB, and the cache's limit is 1MB
+        data = {'a': numpy.zeros(400*1024, dtype=numpy.uint8)}
+        for i, key in enumerate(["aa1", "aa2", "bb3", "bb4"]):
+            self.cache[key] = data
+            os.utime(self.cache._get_path(key), (i, i))
+        self.cache.prune()
+        self.assertRaises(KeyError, self.cache.__getitem__, "aa1")
+        self.assertRaises(KeyError, self.cache.__getitem__, "aa2")
+        self.assertEquals(len(self.cache["bb3"]['a']), 400*1024)
+        self.assertEquals(len(self.cache["bb4"]['a']), 400*1024)
+
+class TestSharedMemoryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.SharedMemoryCache(size=8)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_roundtrip(self):
+        chunk = {'Biomes': numpy.arange(256, dtype=numpy.uint8).reshape((16,16)),
+                 'Sections': [{'Y': 3, 'Blocks': numpy.arange(4096, dtype=numpy.uint16).reshape((16,16,16))}]}
+        self.cache["abc"] = chunk
+        got = self.cache["abc"]
+        self.assertTrue(numpy.array_equal(got['Biomes'], chunk['Biomes']))
+        self.assertEquals(got['Sections'][0]['Y'], 3)
+        self.assertTrue(numpy.array_equal(got['Sections'][0]['Blocks'], chunk['Sections'][0]['Blocks']))
+        self.assertRaises(KeyError, self.cache.__getitem__, "abd")
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_shared(self):
+        # A copy, like the ones in worker processes, sees the same items
+        other = cPickle.loads(cPickle.dumps(self.cache))
+        try:
+            other["abc"] = [numpy.ones(10)]
+            self.assertEquals(list(self.cache["abc"][0]), [1.0] * 10)
+        finally:
+            other.close()
+        self.assertTrue(os.path.exists(self.cache.path))
+
+    def test_removed_at_exit(self):
+        # A render that stops early doesn't leave the file behind
+        path = subprocess.check_output([sys.executable, "-c",
+            "from overviewer_core import cache; "
+            "print cache.SharedMemoryCache(size=8).path"]).strip()
+        self.assertTrue(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_missing_file(self):
+        # A copy unpickled on another machine can't map the file
+        other = object.__new__(cache.SharedMemoryCache)
+        other.__setstate__(("/nonexistent/overviewer-cache", self.cache.numsets))
+        other["abc"] = [numpy.ones(10)]
+        self.assertRaises(KeyError, other.__getitem__, "abc")
+        self.assertEquals(other.misses, 1)
+        other.close()
+
+    def test_packing(self):
+        # Items take only the room they need, so a set holds many small
+        # ones, and the items that are left keep their data as others are
+        # replaced and moved around
+        r = numpy.random.RandomState(1)
+        items = {}
+        for i in xrange(2000):
+            key = str(r.randint(300))
+            items[key] = numpy.arange(r.randint(1, 40000), dtype=numpy.uint8) + i
+            self.cache[key] = items[key]
+        found = 0
+        for key, array in items.iteritems():
+            try:
+                got = self.cache[key]
+            except KeyError:
+                continue
+            found += 1
+            self.assertTrue(numpy.array_equal(got, array))
+        self.assertTrue(found > 100, found)
+
+    def test_eviction(self):
+        # Far more items than fit in the cache. The most recent ones should
+        # still be there, and a too-big item is never stored.
+        for i in xrange(500):
+            self.cache[str(i)] = {'i': i, 'data': numpy.zeros(1000)}
+        self.assertEquals(self.cache["499"]['i'], 499)
+        self.cache["big"] = numpy.zeros(1024*1024)
+        self.assertRaises(KeyError, self.cache.__getitem__, "big")
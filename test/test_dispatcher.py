@@ -0,0 +1,231 @@
+import unittest
+import tempfile
+import shutil
+import os
+import multiprocessing
+import time
+
+from overviewer_core import dispatcher, observer
+
+class FakeWorker(object):
+    """A worker with a tree of work items like a TileSet's: each item depends
+    on the items one longer than it that start with it"""
+    def __init__(self, items):
+        self.items = items
+        self.done = []
+
+    def get_num_phases(self):
+        return 1
+
+    def get_phase_length(self, phase):
+        return len(self.items)
+
+    def iterate_work_items(self, phase):
+        for item in self.items:
+            yield item, [item + (i,) for i in range(4)]
+
+    def do_work(self, item):
+        self.done.append(item)
+
+class PriorityWorker(FakeWorker):
+    def get_work_item_priority(self, item):
+        return item[0]
+
+class CrashingWorker(FakeWorker):
+    """Kills the worker process the first time it's given the item (2,), or
+    every time if markerdir is None"""
+    def __init__(self, items, markerdir):
+        super(CrashingWorker, self).__init__(items)
+        self.marker = markerdir and os.path.join(markerdir, "crashed")
+
+    def do_work(self, item):
+        if item == (2,) and not (self.marker and os.path.exists(self.marker)):
+            if self.marker:
+                open(self.marker, "w").close()
+            self.fail()
+        super(CrashingWorker, self).do_work(item)
+
+    def fail(self):
+        os._exit(1)
+
+class HangingWorker(CrashingWorker):
+    def fail(self):
+        time.sleep(60)
+
+class DelayedDispatcher(dispatcher.Dispatcher):
+    """Runs jobs in the reverse order they were dispatched in, and only when
+    asked for finished jobs, like a dispatcher with slow workers"""
+    def __init__(self):
+        super(DelayedDispatcher, self).__init__()
+        self.queued = []
+
+    def dispatch(self, tileset, workitem):
+        if tileset is not None:
+            self.queued.append((tileset, workitem))
+            return []
+        finished = self.queued[::-1]
+        self.queued = []
+        for tileset, workitem in finished:
+            tileset.do_work(workitem)
+        return finished
+
+class GivingUpDispatcher(DelayedDispatcher):
+    """Gives up on the item (2,) instead of running it"""
+    def dispatch(self, tileset, workitem):
+        if workitem == (2,):
+            self.abandoned_jobs.append((tileset, workitem))
+            return []
+        return super(GivingUpDispatcher, self).dispatch(tileset, workitem)
+
+class SingleJobDispatcher(DelayedDispatcher):
+    """Only takes a job when the last one has finished"""
+    def can_dispatch(self):
+        return not self.queued
+
+class DispatcherTest(unittest.TestCase):
+    items = [(0, 0), (0, 1), (0,), (1, 3), (1,), (2,), ()]
+
+    def check_order(self, worker):
+        self.assertEqual(sorted(worker.done), sorted(self.items))
+        for item in worker.done:
+            # every item was done before the one that depends on it
+            if item:
+                self.assertTrue(worker.done.index(item) < worker.done.index(item[:-1]))
+
+    def test_serial(self):
+        worker = FakeWorker(self.items)
+        obs = observer.Observer()
+        dispatcher.Dispatcher().render_all([worker], obs)
+        self.assertEqual(worker.done, self.items)
+        self.assertEqual(obs.get_current_value(), len(self.items))
+
+    def test_dependencies(self):
+        worker = FakeWorker(self.items)
+        obs = observer.Observer()
+        dispatch = DelayedDispatcher()
+        dispatch.render_all([worker], obs)
+        self.check_order(worker)
+        self.assertEqual(obs.get_current_value(), len(self.items))
+        self.assertEqual(dispatch._unfinished_jobs, set())
+        self.assertEqual(dispatch._waiting_jobs, {})
+        self.assertEqual(dispatch._dependent_jobs, {})
+
+    def test_abandoned_jobs(self):
+        worker = FakeWorker(self.items)
+        worker.finished = []
+        worker.finish_work_item = lambda phase, item: worker.finished.append(item) or []
+        worker.iterate_work_items = lambda phase, streaming: FakeWorker.iterate_work_items(worker, phase)
+        dispatch = GivingUpDispatcher()
+        dispatch.render_all([worker], observer.Observer())
+        # the job that depends on it is dropped too, and the worker isn't
+        # told about either as finished
+        expected = [item for item in self.items if item not in [(2,), ()]]
+        self.assertEqual(sorted(worker.done), sorted(expected))
+        self.assertEqual(sorted(worker.finished), sorted(expected))
+        self.assertEqual(dispatch._unfinished_jobs, set())
+        self.assertEqual(dispatch._waiting_jobs, {})
+
+    def test_priority(self):
+        worker = PriorityWorker([(1,), (5,), (3,), (4,)])
+        SingleJobDispatcher().render_all([worker], observer.Observer())
+        # the first job goes out before the others are added
+        self.assertEqual(worker.done, [(1,), (5,), (4,), (3,)])
+
+    def test_biggest_tileset_first(self):
+        small = FakeWorker([(0,), (1,)])
+        big = FakeWorker([(0,), (1,), (2,), (3,), (4,)])
+        dispatch = dispatcher.Dispatcher()
+        order = []
+        def dispatch_job(tileset, workitem):
+            if tileset is None:
+                return []
+            order.append(tileset)
+            return [(tileset, workitem)]
+        dispatch.dispatch = dispatch_job
+        dispatch.render_all([small, big], observer.Observer())
+        # ties go to the tileset given first
+        self.assertEqual(order, [big, big, big, small, big, small, big])
+
+    def test_local_multiprocessing(self):
+        worker = FakeWorker(self.items)
+        obs = observer.Observer()
+        dispatch = dispatcher.LocalMultiprocessingDispatcher(local_procs=2, batch_size=2)
+        try:
+            dispatch.render_all([worker], obs)
+        finally:
+            dispatch.close()
+        self.assertEqual(obs.get_current_value(), len(self.items))
+        self.assertEqual(dispatch.cache_stats, [[], []])
+        self.assertEqual(dispatch.get_service_times().keys(), [(worker, 0)])
+
+    def test_lost_worker(self):
+        tmpdir = tempfile.mkdtemp(prefix="OVTEST")
+        try:
+            worker = CrashingWorker(self.items, tmpdir)
+            obs = observer.Observer()
+            dispatch = dispatcher.LocalMultiprocessingDispatcher(local_procs=2, batch_size=1)
+            try:
+                dispatch.render_all([worker], obs)
+            finally:
+                dispatch.close()
+            self.assertTrue(os.path.exists(worker.marker))
+        finally:
+            shutil.rmtree(tmpdir)
+        # the crashed worker's job was done again, and it was replaced
+        self.assertEqual(obs.get_current_value(), len(self.items))
+        self.assertEqual(len(dispatch.cache_stats), 2)
+        self.assertEqual(dispatch.failed_jobs, [])
+
+    def test_hung_worker(self):
+        tmpdir = tempfile.mkdtemp(prefix="OVTEST")
+        try:
+            worker = HangingWorker(self.items, tmpdir)
+            obs = observer.Observer()
+            dispatch = dispatcher.LocalMultiprocessingDispatcher(local_procs=2, batch_size=1)
+            dispatch.job_timeout = 0.5
+            dispatch.check_interval = 0.1
+            try:
+                dispatch.render_all([worker], obs)
+            finally:
+                dispatch.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(obs.get_current_value(), len(self.items))
+        self.assertEqual(dispatch.failed_jobs, [])
+
+    def test_failed_job(self):
+        worker = CrashingWorker(self.items, None)
+        obs = observer.Observer()
+        dispatch = dispatcher.LocalMultiprocessingDispatcher(local_procs=2, batch_size=4)
+        try:
+            dispatch.render_all([worker], obs)
+        finally:
+            dispatch.close()
+        # the job is given up on, along with the job that depends on it,
+        # and the render goes on without them
+        self.assertEqual(obs.get_current_value(), len(self.items) - 2)
+        self.assertEqual(dispatch.failed_jobs, [(worker, (2,))])
+        self.assertEqual(dispatch.job_failures[(0, (2,))], dispatch.max_job_failures)
+
+    def test_network(self):
+        worker = FakeWorker(self.items)
+        obs = observer.Observer()
+        dispatch = dispatcher.NetworkDispatcher(("localhost", 0), "secret", batch_size=2)
+        workers = multiprocessing.Process(target=dispatcher.NetworkDispatcher.start_workers,
+                args=(dispatch.address, "secret", 2))
+        workers.start()
+        try:
+            dispatch.render_all([worker], obs)
+        finally:
+            dispatch.close()
+            workers.join()
+        self.assertEqual(obs.get_current_value(), len(self.items))
+        self.assertEqual(dispatch.cache_stats, [[], []])
+
+    def test_parse_address(self):
+        self.assertEqual(dispatcher.parse_address("example.com:8123"), ("example.com", 8123))
+        self.assertEqual(dispatcher.parse_address(":8123"), ("0.0.0.0", 8123))
+        self.assertRaises(ValueError, dispatcher.parse_address, "example.com")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+import struct
+import zlib
+import StringIO
+import tempfile
+import os
+
+from overviewer_core import nbt
+
+# Helpers to build NBT data by hand
+def tag_string(s):
+    return struct.pack(">h", len(s)) + s
+
+def named(tagid, name, payload):
+    return chr(tagid) + tag_string(name) + payload
+
+def compound(*tags):
+    return "".join(tags) + chr(0)
+
+# An uncompressed chunk-like structure. Everything the renderer doesn't need
+# comes before and after the tags it does, so skipping has to get the
+# offsets right to read the rest.
+chunk_nbt = named(10, "", compound(
+    named(10, "Level", compound(
+        named(4, "LastUpdate", struct.pack(">q", 1234)),
+        named(9, "Entities", chr(10) + struct.pack(">i", 2) +
+            compound(named(8, "id", tag_string("Pig")),
+                     named(9, "Pos", chr(6) + struct.pack(">i", 3) +
+                         struct.pack(">3d", 1.0, 2.0, 3.0))) +
+            compound(named(8, "id", tag_string("Cow")))),
+        named(11, "HeightMap", struct.pack(">i", 4) + struct.pack(">4i", 1, 2, 3, 4)),
+        named(9, "Sections", chr(10) + struct.pack(">i", 1) +
+            compound(named(1, "Y", chr(0)),
+                     named(7, "Blocks", struct.pack(">i", 4) + "\x01\x02\x03\x04"))),
+        named(9, "TileTicks", chr(8) + struct.pack(">i", 2) +
+            tag_string("a") + tag_string("bc")),
+        named(7, "Biomes", struct.pack(">i", 2) + "\x05\x06"),
+        named(3, "xPos", struct.pack(">i", 7)),
+        )),
+    named(2, "DataVersion", struct.pack(">h", 3)),
+    ))
+
+class NBTReaderTest(unittest.TestCase):
+    def get_reader(self):
+        return nbt.NBTFileReader(StringIO.StringIO(zlib.compress(chunk_nbt)), is_gzip=False)
+
+    def test_read_all(self):
+        name, data = self.get_reader().read_all()
+        self.assertEquals(name, "")
+        level = data['Level']
+        self.assertEquals(level['LastUpdate'], 1234)
+        self.assertEquals([e['id'] for e in level['Entities']], ["Pig", "Cow"])
+        self.assertEquals(level['Entities'][0]['Pos'], [1.0, 2.0, 3.0])
+        self.assertEquals(level['HeightMap'], (1, 2, 3, 4))
+        self.assertEquals(level['TileTicks'], ["a", "bc"])
+        self.assertEquals(level['xPos'], 7)
+        self.assertEquals(data['DataVersion'], 3)
+
+    def test_tagpaths(self):
+        name, data = self.get_reader().read_all(["Level/Sections", "Level/Biomes"])
+        self.assertEquals(data.keys(), ['Level'])
+        level = data['Level']
+        self.assertEquals(sorted(level.keys()), ['Biomes', 'Sections'])
+        self.assertEquals(level['Biomes'], "\x05\x06")
+        self.assertEquals(level['Sections'], [{'Y': 0, 'Blocks': "\x01\x02\x03\x04"}])
+
+    def test_tagpaths_after_skipped(self):
+        # Tags following skipped lists and arrays still decode correctly
+        name, data = self.get_reader().read_all(["Level/xPos", "DataVersion"])
+        self.assertEquals(data, {'Level': {'xPos': 7}, 'DataVersion': 3})
+
+    def test_tagpaths_whole_subtree(self):
+        full = self.get_reader().read_all()[1]
+        name, data = self.get_reader().read_all(["Level/Sections", "Level"])
+        self.assertEquals(data, {'Level': full['Level']})
+
+def make_region(chunks):
+    """Builds region file data with the given {(x, z): (nbt, timestamp)}
+    chunks, one sector each"""
+    locations = [0] * 1024
+    timestamps = [0] * 1024
+    sectors = []
+    for (x, z), (data, timestamp) in sorted(chunks.items()):
+        compressed = zlib.compress(data)
+        payload = struct.pack(">IB", len(compressed) + 1, 2) + compressed
+        assert len(payload) <= 4096
+        locations[x + z * 32] = ((len(sectors) + 2) << 8) | 1
+        timestamps[x + z * 32] = timestamp
+        sectors.append(payload + "\0" * (4096 - len(payload)))
+    return struct.pack(">1024I", *locations) + struct.pack(">1024I", *timestamps) + "".join(sectors)
+
+class MCRReaderTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".mca")
+        os.write(fd, make_region({(1, 2): (chunk_nbt, 1000), (31, 0): (chunk_nbt, 2000)}))
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def check_region(self, region):
+        self.assertEquals(sorted(region.get_chunks()), [(1, 2), (31, 0)])
+        self.assertTrue(region.chunk_exists(33, 2))
+        self.assertFalse(region.chunk_exists(2, 1))
+        self.assertEquals(region.get_chunk_timestamp(-1, 0), 2000)
+        self.assertEquals(region.offsets.shape, (32, 32))
+        self.assertEquals(region.timestamps[2, 1], 1000)
+        x, z, mtime = region.get_chunk_arrays()
+        self.assertEquals(sorted(zip(x, z, mtime)), [(1, 2, 1000), (31, 0, 2000)])
+        self.assertEquals(region.load_chunk(2, 1), None)
+        name, data = region.load_chunk(1, 2, ["Level/xPos"])
+        self.assertEquals(data, {'Level': {'xPos': 7}})
+        name, data = region.load_chunk(31, 0)
+        self.assertEquals(data['Level']['LastUpdate'], 1234)
+
+    def test_mapped(self):
+        region = nbt.load_region(self.filename)
+        self.check_region(region)
+        region.close()
+
+    def test_fileobj(self):
+        # Not a real file, so can't be mapped
+        with open(self.filename, "rb") as f:
+            region = nbt.MCRFileReader(StringIO.StringIO(f.read()))
+        self.check_region(region)
+        region.close()
+
+    def test_truncated(self):
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        region = nbt.MCRFileReader(StringIO.StringIO(data[:-4096]))
+        self.assertRaises(nbt.CorruptRegionError, region.load_chunk, 31, 0)
+        self.assertRaises(nbt.CorruptRegionError, nbt.MCRFileReader, StringIO.StringIO(data[:5000]))
+
+if __name__ == "__main__":
+    unittest.main()
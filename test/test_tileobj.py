@@ -1,6 +1,6 @@
 import unittest
 
-from overviewer_core.tileset import iterate_base4, RenderTile
+from overviewer_core.tileset import iterate_base4, RenderTile, compute_paths
 
 items = [
         ((-4,-8), (0,0)),
@@ -36,6 +36,12 @@ class TileTest(unittest.TestCase):
             t2 = RenderTile.compute_path(col, row, depth)
             self.assertEqual(t1, t2)
 
+    def test_compute_paths(self):
+        """Tests that the array version of compute_path agrees with it"""
+        tiles = [RenderTile.from_path(path) for path in iterate_base4(5)]
+        paths = compute_paths([t.col for t in tiles], [t.row for t in tiles], 5)
+        self.assertEqual(paths, [t.path for t in tiles])
+
     def test_equality(self):
         t1 = RenderTile(-6, -20, (0,1,2,3))
         
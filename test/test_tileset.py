@@ -5,8 +5,13 @@ from collections import defaultdict
 import os
 import os.path
 import random
+import itertools
+import time
+import cPickle as pickle
 
-from overviewer_core import tileset
+import numpy
+
+from overviewer_core import tileset, dispatcher, rendermodes
 
 # Supporing data
 # chunks list: chunkx, chunkz mapping to chunkmtime
@@ -88,8 +93,15 @@ correct_tiles = [
 ######################
 
 class FakeRegionset(object):
+    _keys = itertools.count()
+
     def __init__(self, chunks):
         self.chunks = dict(chunks)
+        # Each instance has its own chunks
+        self.key = next(self._keys)
+
+    def get_transform_key(self):
+        return (self.key,)
 
     def get_chunk(self, x,z):
         return NotImplementedError()
@@ -98,6 +110,18 @@ class FakeRegionset(object):
         for (x,z),mtime in self.chunks.iteritems():
             yield x,z,mtime
 
+    def get_regions(self):
+        return list(set((x//32, z//32) for (x,z) in self.chunks))
+
+    def get_region_chunk_arrays(self, regionx, regionz):
+        items = [(x,z,mtime) for (x,z),mtime in self.chunks.iteritems()
+                if (x//32, z//32) == (regionx, regionz)]
+        return tuple(numpy.array(a, dtype=int) for a in zip(*items))
+
+    def iterate_chunk_arrays(self):
+        for regionx, regionz in self.get_regions():
+            yield self.get_region_chunk_arrays(regionx, regionz)
+
     def get_chunk_mtime(self, x, z):
         try:
             return self.chunks[x,z]
@@ -105,11 +129,12 @@ class FakeRegionset(object):
             return None
 
 class FakeAssetmanager(object):
-    def __init__(self, lastrendertime):
+    def __init__(self, lastrendertime, config=None):
         self.lrm = lastrendertime
+        self.config = config or {}
 
     def get_tileset_config(self, _):
-        return {'lastrendertime': self.lrm}
+        return dict(self.config, lastrendertime=self.lrm)
 
 def get_tile_set(chunks):
     """Given the dictionary mapping chunk coordinates their mtimes, returns a
@@ -155,6 +180,24 @@ def create_fakedir(outputdir, tiles):
 
 # The test cases
 ################
+class TilesByChunksTest(unittest.TestCase):
+    def test_get_tiles_by_chunks(self):
+        """Tests that the array version of get_tiles_by_chunk finds the same
+        tiles for each chunk"""
+        coords = [(col, row) for col in range(-5, 6) for row in range(-9, 10)]
+        tilecols, tilerows, chunkindex = tileset.get_tiles_by_chunks(
+                [c for c, r in coords], [r for c, r in coords])
+        found = defaultdict(set)
+        for c, r, i in zip(tilecols, tilerows, chunkindex):
+            found[coords[i]].add((c, r))
+        for col, row in coords:
+            self.assertEqual(found[col, row], set(tileset.get_tiles_by_chunk(col, row)))
+
+    def test_unique_tiles(self):
+        cols, rows, mtimes = tileset.unique_tiles(numpy.array([2, 0, 2, 2]),
+                numpy.array([4, 4, 4, 0]), numpy.array([1, 7, 5, 3]))
+        self.assertEqual(zip(cols, rows, mtimes), [(0, 4, 7), (2, 0, 3), (2, 4, 5)])
+
 class TilesetTest(unittest.TestCase):
     def setUp(self):
         # Set up the region set
@@ -188,10 +231,18 @@ class TilesetTest(unittest.TestCase):
                 'imgformat': 'png',
                 'optimizeimg': 0,
                 'rendermode': 'normal',
-                'rerenderprob': 0
+                'rerenderprob': 0,
+                'batchlevels': 0,
+                'name': 'testrender',
                 }
         defoptions.update(options)
-        ts = tileset.TileSet(self.rs, FakeAssetmanager(0), None, defoptions, outputdir)
+        ts = tileset.TileSet(None, self.rs, FakeAssetmanager(0), None, defoptions, outputdir)
+        # The expected tiles below are computed for a tree of depth 3, which
+        # is enough to hold the test chunks. The automatic sizing leaves extra
+        # room for tall chunks, so pin it down.
+        ts.treedepth = 3
+        ts.xradius = 2**3
+        ts.yradius = 2*2**3
         if preprocess:
             preprocess(ts)
         ts.do_preprocessing()
@@ -219,11 +270,193 @@ class TilesetTest(unittest.TestCase):
         for tilepath in expected.iterkeys():
             self.assertTrue(tilepath in paths, "%s was expected to be returned but wasn't: %s" % (tilepath, paths))
 
+    def test_preprocess_all(self):
+        """Tests that tilesets preprocessed together through a dispatcher
+        get the same tiles as when preprocessed on their own"""
+        defoptions = {
+                'bgcolor': '#000000',
+                'imgformat': 'png',
+                'optimizeimg': 0,
+                'rendermode': 'normal',
+                'rerenderprob': 0,
+                'batchlevels': 0,
+                'renderchecks': 2,
+                }
+        tilesets = []
+        for name in ("render1", "render2"):
+            ts = tileset.TileSet(None, self.rs, FakeAssetmanager(0), None,
+                    dict(defoptions, name=name), self.get_outputdir())
+            ts.treedepth = 3
+            ts.xradius = 2**3
+            ts.yradius = 2*2**3
+            tilesets.append(ts)
+        self.assertEqual(tilesets[0].get_preprocessing_key(), tilesets[1].get_preprocessing_key())
+
+        dispatch = dispatcher.Dispatcher()
+        dispatch.preprocess_all(tilesets)
+        for ts in tilesets:
+            self.compare_iterate_to_expected(ts, self.rs.chunks)
+
+    def test_shrunk_map(self):
+        """Tests that when the map shrank since the last render, the tiles
+        are re-arranged before the chunk scan, so that the check-tiles mode
+        this switches to keeps the tiles that didn't change"""
+        outputdir = self.get_outputdir()
+        # The last render had one more zoom level, with the tiles of the
+        # current tree in the inner quadrants
+        tiles = get_tile_set(self.rs.chunks)
+        create_fakedir(outputdir, dict(((p[0], 3-p[0]) + p[1:], 5)
+                for p in tiles if p))
+        self.rs.chunks[0, 0] = 6
+
+        ts = tileset.TileSet(None, self.rs, FakeAssetmanager(0), None, {
+                'bgcolor': '#000000',
+                'imgformat': 'png',
+                'optimizeimg': 0,
+                'rendermode': 'normal',
+                'rerenderprob': 0,
+                'batchlevels': 0,
+                'renderchecks': 0,
+                'name': 'testrender',
+                }, outputdir)
+        ts.config['zoomLevels'] = 4
+        ts.treedepth = 3
+        ts.xradius = 2**3
+        ts.yradius = 2*2**3
+        ts.last_rendertime = 5
+
+        dispatch = dispatcher.Dispatcher()
+        dispatch.preprocess_all([ts])
+        self.assertEqual(ts.options['renderchecks'], 1)
+        paths = set(x[0] for x in ts.iterate_work_items(0))
+        self.assertTrue(set(get_tile_set({(0, 0): 6})) <= paths)
+        for tilepath in tiles:
+            if len(tilepath) == 3:
+                self.assertTrue(os.path.exists(os.path.join(outputdir,
+                    *(str(x) for x in tilepath)) + ".png"), tilepath)
+
     def test_get_phase_length(self):
         ts = self.get_tileset({'renderchecks': 2}, self.get_outputdir())
         self.assertEqual(ts.get_num_phases(), 1)
         self.assertEqual(ts.get_phase_length(0), 41)
 
+    def test_batched_iterate(self):
+        """Tests that batching gives out the same tiles in the same order, and
+        that tiles above the batches depend on them"""
+        ts = self.get_tileset({'renderchecks': 2}, self.get_outputdir())
+        tiles = [x[0] for x in ts.iterate_work_items(0)]
+        ts.options['batchlevels'] = 2
+        items = list(ts.iterate_work_items(0))
+
+        flattened = []
+        for workitem, deps in items:
+            if isinstance(workitem, tileset.TileBatch):
+                self.assertEqual(len(workitem), 1)
+                self.assertEqual(workitem.tiles[-1], tuple(workitem))
+                self.assertEqual(deps, [])
+                flattened.extend(workitem.tiles)
+            else:
+                self.assertEqual(len(workitem), 0)
+                self.assertTrue(any(d in deps for d, _ in items[:-1]))
+                flattened.append(workitem)
+        self.assertEqual(flattened, tiles)
+        self.assertEqual(sum(getattr(w, "weight", 1) for w, _ in items), ts.get_phase_length(0))
+
+        # 2 is the default
+        del ts.options['batchlevels']
+        self.assertEqual([(w.tiles, d) for w, d in ts.iterate_work_items(0) if isinstance(w, tileset.TileBatch)],
+                [(w.tiles, d) for w, d in items if isinstance(w, tileset.TileBatch)])
+
+        batch = items[0][0]
+        copy = pickle.loads(pickle.dumps(batch, -1))
+        self.assertEqual((copy, copy.tiles), (batch, batch.tiles))
+
+    def test_streaming_iterate(self):
+        """Tests that with streaming, each composite-tile is given out once
+        all of its children finish, and every tile is given out once"""
+        for batchlevels in (0, 1):
+            ts = self.get_tileset({'renderchecks': 2, 'batchlevels': batchlevels}, self.get_outputdir())
+            todo = [w for w, _ in ts.iterate_work_items(0, streaming=True)]
+            self.assertTrue(all(len(w) == 3 or isinstance(w, tileset.TileBatch) for w in todo))
+            finished = []
+            while todo:
+                # finish them out of order
+                workitem = todo.pop(len(todo) // 2)
+                self.assertFalse(workitem in finished)
+                finished.append(workitem)
+                for newitem, deps in ts.finish_work_item(0, workitem):
+                    self.assertEqual(deps, [])
+                    children = [w for w in finished if tuple(w)[:-1] == newitem]
+                    self.assertEqual(sorted(children), [newitem + (i,) for i in range(4)
+                        if newitem + (i,) in correct_tiles])
+                    todo.append(newitem)
+            tiles = []
+            for w in finished:
+                tiles.extend(getattr(w, "tiles", [w]))
+            self.assertEqual(sorted(tiles), sorted(correct_tiles))
+
+    def test_resume(self):
+        """Tests that a render continued from the journal of an interrupted
+        one skips the tiles that were finished, except where chunks changed
+        since"""
+        outputdir = self.get_outputdir()
+        ts = self.get_tileset({'renderchecks': 2}, outputdir)
+        items = list(ts.iterate_work_items(0))
+        for workitem, deps in items[:20]:
+            ts.finish_work_item(0, workitem)
+        ts.close_journal(completed=False)
+
+        # a chunk changed after the interrupted render started. (A new
+        # regionset, so the scan isn't cached.)
+        self.rs = FakeRegionset(dict(self.rs.chunks))
+        self.rs.chunks[0, 0] = time.time() + 10
+        def resume(ts):
+            ts._resume_since = ts._read_journal_header()["started"]
+        ts = self.get_tileset({'renderchecks': 2}, outputdir, resume)
+        self.assertEqual(len(ts._resumed_tiles), 20)
+        paths = [x[0] for x in ts.iterate_work_items(0)]
+        expected = set(correct_tiles[20:]) | set(get_tile_set({(0, 0): 5}))
+        self.assertEqual(paths, [t for t in correct_tiles if t in expected])
+        self.assertEqual(ts.get_phase_length(0), len(paths))
+
+        ts.close_journal(completed=True)
+        self.assertFalse(os.path.exists(ts.journalpath))
+
+    def test_resume_options(self):
+        """Tests that an interrupted render is only continued in the same
+        rendercheck mode and with the same options"""
+        outputdir = self.get_outputdir()
+        options = {
+                'bgcolor': '#000000',
+                'imgformat': 'png',
+                'optimizeimg': 0,
+                'rendermode': 'normal',
+                'rerenderprob': 0,
+                'name': 'testrender',
+                }
+        am = FakeAssetmanager(0, {'render_in_progress': True})
+        ts = tileset.TileSet(None, self.rs, am, None, dict(options, renderchecks=2), outputdir)
+        ts._open_journal()
+        ts.close_journal(completed=False)
+
+        def get_resume_since(**changes):
+            return tileset.TileSet(None, self.rs, am, None, dict(options, **changes),
+                    outputdir)._resume_since
+        self.assertNotEqual(get_resume_since(), None)
+        self.assertNotEqual(get_resume_since(renderchecks=2), None)
+        self.assertEqual(get_resume_since(renderchecks=0), None)
+        self.assertEqual(get_resume_since(bgcolor='#FFFFFF'), None)
+        self.assertEqual(get_resume_since(rendermode='lighting'), None)
+
+        # render primitives are new objects on every run
+        def get_key(*rendermode):
+            ts.options['rendermode'] = list(rendermode)
+            return ts._get_options_key()
+        key = get_key(rendermodes.Base(), rendermodes.EdgeLines())
+        self.assertEqual(get_key(rendermodes.Base(), rendermodes.EdgeLines()), key)
+        self.assertNotEqual(get_key(rendermodes.Base(biomes=False), rendermodes.EdgeLines()), key)
+        self.assertEqual(tileset.canonical_option({'a': (1, object())}), [['a', [1, 'object']]])
+
     def test_forcerender_iterate(self):
         """Tests that a rendercheck mode 2 iteration returns every render-tile
         and upper-tile
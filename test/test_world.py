@@ -1,8 +1,14 @@
 import unittest
 
 import os
+import tempfile
+import shutil
 
-from overviewer_core import world
+import numpy
+
+from overviewer_core import world, cache
+
+from test_nbt import make_region, chunk_nbt
 
 class ExampleWorldTest(unittest.TestCase):
     @classmethod
@@ -31,8 +37,145 @@ class ExampleWorldTest(unittest.TestCase):
         self.assertEquals(regionset.get_chunk_mtime(5,0), 1316728905)
         self.assertEquals(regionset.get_chunk_mtime(-22,16), 1316786786)
 
-        
-         
+
+class ChunkArraysTest(unittest.TestCase):
+    def setUp(self):
+        self.regiondir = tempfile.mkdtemp(prefix="OVTEST")
+        regions = {
+                (0, 0): [(0, 0, 100), (5, 3, 200), (31, 31, 300)],
+                (-1, 0): [(31, 0, 400), (2, 7, 500)],
+                (3, -2): [(16, 16, 600)],
+                }
+        for (rx, rz), chunks in regions.iteritems():
+            data = make_region(dict(((x, z), (chunk_nbt, mtime)) for x, z, mtime in chunks))
+            with open(os.path.join(self.regiondir, "r.%d.%d.mca" % (rx, rz)), "wb") as f:
+                f.write(data)
+        self.rset = world.RegionSet(self.regiondir, "region")
+
+    def tearDown(self):
+        shutil.rmtree(self.regiondir)
+
+    def check_arrays(self, rset):
+        "Checks that the bulk chunk listing agrees with iterate_chunks()"
+        from_arrays = []
+        for x, z, mtime in rset.iterate_chunk_arrays():
+            from_arrays.extend(zip(x.tolist(), z.tolist(), mtime.tolist()))
+        self.assertEquals(sorted(from_arrays), sorted(rset.iterate_chunks()))
+        return sorted(from_arrays)
+
+    def test_regionset(self):
+        chunks = self.check_arrays(self.rset)
+        self.assertEquals(chunks, [(-32+2, 7, 500), (-32+31, 0, 400),
+            (0, 0, 100), (5, 3, 200), (31, 31, 300), (96+16, -64+16, 600)])
+
+    def test_wrappers(self):
+        for north_dir in range(4):
+            self.check_arrays(world.RotatedRegionSet(self.rset, north_dir))
+        cropped = world.CroppedRegionSet(self.rset, 0, 0, 16*31, 16*40)
+        self.assertEquals(self.check_arrays(cropped), [(0, 0, 100), (5, 3, 200), (31, 31, 300)])
+        self.assertEquals(sorted(cropped.get_regions()), [(0, 0)])
+        self.check_arrays(world.RotatedRegionSet(cropped, world.LOWER_LEFT))
+
+    def test_transform_key(self):
+        rotated = world.RotatedRegionSet(self.rset, world.UPPER_RIGHT)
+        cropped = world.CroppedRegionSet(self.rset, 0, 0, 100, 100)
+        keys = [self.rset.get_transform_key(), rotated.get_transform_key(),
+                cropped.get_transform_key(),
+                world.RotatedRegionSet(cropped, world.UPPER_RIGHT).get_transform_key(),
+                world.RotatedRegionSet(self.rset, world.LOWER_LEFT).get_transform_key()]
+        self.assertEquals(len(set(keys)), len(keys))
+        # Caching doesn't change the chunks
+        self.assertEquals(world.CachedRegionSet(self.rset, []).get_transform_key(), keys[0])
+        self.assertEquals(world.RotatedRegionSet(self.rset, world.UPPER_RIGHT).get_transform_key(), keys[1])
+
+class DecodeSectionTest(unittest.TestCase):
+    def make_section(self, add):
+        rand = numpy.random.RandomState(0)
+        section = {'Y': 2}
+        for name, size in (('Blocks', 4096), ('Add', 2048), ('Data', 2048),
+                           ('SkyLight', 2048), ('BlockLight', 2048)):
+            if name != 'Add' or add:
+                section[name] = rand.randint(0, 256, size).astype(numpy.uint8).tostring()
+        return section
+
+    def check_section(self, section, raw):
+        self.assertEquals(section['Y'], 2)
+        self.assertFalse('Add' in section)
+        blocks = section['Blocks']
+        self.assertEquals((blocks.shape, blocks.dtype), ((16,16,16), numpy.uint16))
+        # block x=3,y=5,z=7 is at 5*256 + 7*16 + 3, in the high nibble of
+        # the packed arrays
+        i = 5*256 + 7*16 + 3
+        add = (ord(raw['Add'][i // 2]) >> 4) if 'Add' in raw else 0
+        self.assertEquals(blocks[5,7,3], ord(raw['Blocks'][i]) + (add << 8))
+        for name in ('Data', 'SkyLight', 'BlockLight'):
+            self.assertEquals(section[name].shape, (16,16,16))
+            self.assertEquals(section[name][5,7,3], ord(raw[name][i // 2]) >> 4)
+            self.assertEquals(section[name][5,7,2], ord(raw[name][i // 2]) & 0x0F)
+
+    def test_decode(self):
+        for add in (False, True):
+            raw = self.make_section(add)
+            section = dict(raw)
+            world.decode_section(section)
+            self.check_section(section, raw)
+
+            # numpy gives the same arrays as the C extension
+            arrays = [numpy.empty((16,16,16), dtype=numpy.uint16)] + \
+                    [numpy.empty((16,16,16), dtype=numpy.uint8) for i in range(3)]
+            world._decode_section_numpy(raw, *arrays)
+            for name, array in zip(('Blocks', 'Data', 'SkyLight', 'BlockLight'), arrays):
+                self.assertTrue(numpy.array_equal(section[name], array))
+
+    def test_wrong_size(self):
+        section = self.make_section(False)
+        section['SkyLight'] = section['SkyLight'][:100]
+        self.assertRaises(ValueError, world.decode_section, section)
+
+class FakeRegionSet(object):
+    """Hands out a new copy of the same chunk every time"""
+    def get_chunk(self, x, z, entities=False):
+        blocks = numpy.arange(4096, dtype=numpy.uint16).reshape((16,16,16))
+        data = numpy.zeros((16,16,16), dtype=numpy.uint8)
+        chunk = {'Biomes': numpy.arange(256, dtype=numpy.uint8).reshape((16,16)),
+                'Sections': [{'Y': 0, 'Blocks': blocks, 'Data': data,
+                              'SkyLight': data, 'BlockLight': data}]}
+        if entities:
+            chunk['Entities'] = [{'id': 'Pig'}]
+        return chunk
+    def get_chunk_mtime(self, x, z):
+        return 100
+
+class RotatedRegionSetTest(unittest.TestCase):
+    def test_rotation(self):
+        rotated = world.RotatedRegionSet(FakeRegionSet(), world.UPPER_RIGHT)
+        chunk = rotated.get_chunk(3, -5)
+        blocks = chunk['Sections'][0]['Blocks']
+        # block x,z of the rotated chunk is block z,15-x of the original;
+        # the axes are Y,Z,X
+        self.assertEquals(blocks[2, 4, 6], 2*256 + (15-6)*16 + 4)
+        self.assertEquals(chunk['Biomes'][4, 6], (15-6)*16 + 4)
+
+    def test_unrotated(self):
+        inner = world.CachedRegionSet(FakeRegionSet(), [cache.LRUCache()])
+        rotated = world.RotatedRegionSet(world.RotatedRegionSet(inner, world.LOWER_RIGHT), world.LOWER_LEFT)
+        chunk, rotation = rotated.get_unrotated_chunk(3, -5)
+        # the same chunk is shared by every rotation
+        self.assertTrue(chunk is inner.get_chunk(-5, -3))
+        self.assertEquals(rotation, world.UPPER_RIGHT)
+        self.assertEquals(inner.get_unrotated_chunk(-5, -3), (chunk, 0))
+
+class CachedRegionSetTest(unittest.TestCase):
+    def test_entities(self):
+        # chunks with entities are cached apart from those without, through
+        # any wrappers
+        cached = world.CachedRegionSet(FakeRegionSet(), [cache.LRUCache()])
+        rset = world.RotatedRegionSet(world.CroppedRegionSet(cached, -100, -100, 100, 100),
+                world.UPPER_RIGHT)
+        self.assertFalse('Entities' in rset.get_chunk(3, -5))
+        self.assertEquals(rset.get_chunk(3, -5, entities=True)['Entities'], [{'id': 'Pig'}])
+        self.assertTrue(cached.get_chunk(-5, -3, entities=True) is cached.get_chunk(-5, -3, entities=True))
+        self.assertFalse('Entities' in cached.get_chunk(-5, -3))
 
 if __name__ == "__main__":
     unittest.main()